@@ -14,6 +14,25 @@ class Config:
     AZURE_FUNCTION_KEY = os.environ.get('AZURE_FUNCTIONS_HOST_KEY')
     # Initialize a local database for the example
     SQLALCHEMY_DATABASE_URI = os.environ.get("SQLALCHEMY_DATABASE_URI")
+    # Project money, fuel, drones and population to the current second on every read and settle them
+    # when a kingdom is locked, leaving the tick as a low frequency safety net that also resolves siphons
+    CONTINUOUS_INCOME = os.environ.get("CONTINUOUS_INCOME", "false").lower() == "true"
+    # Number of kingdoms refreshed concurrently during a tick
+    REFRESH_WORKERS = int(os.environ.get("REFRESH_WORKERS", 8))
+    # Seconds the state/galaxies/empires/kingdoms documents are cached in-process, 0 disables
+    SHARED_CACHE_TTL_SECONDS = float(os.environ.get("SHARED_CACHE_TTL_SECONDS", 5))
+    # "sql" shares locks across processes, "memory" is faster but only valid for a single process
+    LOCK_BACKEND = os.environ.get("LOCK_BACKEND", "sql")
+    # "sqlite" fans websocket notifications out across gunicorn workers, "memory" is for a single worker
+    NOTIFY_BACKEND = os.environ.get("NOTIFY_BACKEND", "memory")
+    # Shared by every worker on the host, defaults to notify.sqlite in the instance folder
+    NOTIFY_SQLITE_PATH = os.environ.get("NOTIFY_SQLITE_PATH")
+    # Protocol level pings, a client that misses a pong for this many seconds is disconnected
+    SOCK_SERVER_OPTIONS = {"ping_interval": int(os.environ.get("SOCK_PING_INTERVAL", 25))}
+    # "functions" calls the function app, "memory" and "sqlite" serve its routes in-process for a single process
+    STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "functions")
+    # Items kept by the "sqlite" storage backend, defaults to storage.sqlite in the instance folder
+    STORAGE_SQLITE_PATH = os.environ.get("STORAGE_SQLITE_PATH")
 
 class TestingConfig(Config):
     SECRET_KEY="12345"
@@ -28,4 +47,13 @@ class TestingConfig(Config):
     AZURE_FUNCTION_ENDPOINT = "http://localhost:7071/api"
     AZURE_FUNCTION_KEY = ""
     # Initialize a local database for the example
-    SQLALCHEMY_DATABASE_URI = "sqlite:///pytest.db"
\ No newline at end of file
+    SQLALCHEMY_DATABASE_URI = "sqlite:///pytest.db"
+    REFRESH_WORKERS = 1
+    SHARED_CACHE_TTL_SECONDS = 0
+    LOCK_BACKEND = "memory"
+    NOTIFY_BACKEND = "memory"
+    STORAGE_BACKEND = "memory"
+
+class SimulationConfig(TestingConfig):
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    RATELIMIT_ENABLED = False
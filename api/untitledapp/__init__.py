@@ -23,8 +23,6 @@ mail = Mail()
 
 REQUESTS_SESSION = requests.Session()
 
-SOCK_HANDLERS = {}
-
 # A generic user model that might be used by an app powered by flask-praetorian
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -94,6 +92,10 @@ def before_start_required(f):
     return decorated_function
 
 import untitledapp.getters as uag
+import untitledapp.locks as ualk
+import untitledapp.notify as uan
+import untitledapp.storage as uast
+from untitledapp.cache import TTLCache
 
 def _custom_limit_key_func():
     try:
@@ -102,6 +104,32 @@ def _custom_limit_key_func():
         token = get_remote_address()
     return token
 
+# Longest a listener waits for outgoing notifications before checking for client messages
+LISTEN_SEND_POLL_SECONDS = 0.25
+LISTENER_KD_ID_TTL_SECONDS = 300
+LISTENER_KD_IDS = TTLCache(max_entries=4096)
+
+def _listener_kd_id(json_data):
+    """Resolve a listener's JWT message to its kd_id, cached so keepalives skip the database"""
+    jwt = json_data.get('jwt', None)
+    if not jwt:
+        return None
+    cached, kd_id = LISTENER_KD_IDS.get(jwt, LISTENER_KD_ID_TTL_SECONDS)
+    if cached:
+        return kd_id
+
+    id = guard.extract_jwt_token(jwt)["id"]
+    try:
+        user = db.session.query(User).filter_by(id=id).one_or_none()
+        kd_id = user.kd_id if user is not None else None
+    finally:
+        # Listeners live for the whole connection, don't hold a session open between messages
+        db.session.remove()
+    # Kingdoms are created after sign up, so only remember a JWT once it has one
+    if kd_id is not None:
+        LISTENER_KD_IDS.set(jwt, kd_id)
+    return kd_id
+
 def create_app(config_class='config.Config'):
     # Initialize flask app for the example
     app = flask.Flask(__name__, static_folder='../../build', static_url_path=None)
@@ -115,6 +143,21 @@ def create_app(config_class='config.Config'):
     app.extensions["praetorian"] = guard
 
     db.init_app(app)
+    app.extensions["lock_manager"] = ualk.create_lock_manager(app.config.get("LOCK_BACKEND", "sql"))
+    notify_sqlite_path = app.config.get("NOTIFY_SQLITE_PATH") or os.path.join(app.instance_path, "notify.sqlite")
+    if app.config.get("NOTIFY_BACKEND", "memory") == "sqlite":
+        os.makedirs(os.path.dirname(notify_sqlite_path), exist_ok=True)
+    app.extensions["notify_hub"] = uan.create_hub(app.config.get("NOTIFY_BACKEND", "memory"), notify_sqlite_path)
+    storage_sqlite_path = app.config.get("STORAGE_SQLITE_PATH") or os.path.join(app.instance_path, "storage.sqlite")
+    if app.config.get("STORAGE_BACKEND", "functions") == "sqlite":
+        os.makedirs(os.path.dirname(storage_sqlite_path), exist_ok=True)
+    storage = uast.create_storage(app.config.get("STORAGE_BACKEND", "functions"), storage_sqlite_path)
+    if storage is not None:
+        app.config["AZURE_FUNCTION_ENDPOINT"] = app.config.get("AZURE_FUNCTION_ENDPOINT") or uast.EMBEDDED_ENDPOINT
+        # Routes import untitledapp and tests import api.untitledapp, each with its own session
+        for session in {REQUESTS_SESSION, uag.REQUESTS_SESSION}:
+            session.mount(app.config["AZURE_FUNCTION_ENDPOINT"], storage)
+    app.extensions["storage"] = storage
 
     # Initializes CORS so that the api_tool can talk to the example app
     cors.init_app(app)
@@ -199,28 +242,33 @@ def create_app(config_class='config.Config'):
     @sock.route('/ws/listen')
     # @flask_praetorian.auth_required
     def listen(ws):
-        while True:
-            try:
-                data = ws.receive()
-                json_data = json.loads(data)
-
-                sock.app.logger.info('Got data %s', str(data))
-                jwt = json_data.get('jwt', None)
-                if jwt:
-                    id = guard.extract_jwt_token(jwt)["id"]
-                    query = db.session.query(User).filter_by(id=id).all()
-                    user = query[0]
-                    sock.app.logger.info('Added %s to listeners', user.kd_id)
-                    SOCK_HANDLERS[user.kd_id] = ws
-
-                sock.app.logger.info('Current handlers %s', SOCK_HANDLERS)
-            except ConnectionClosed:
-                sock.app.logger.info('Breaking handler')
-                break
-            except Exception as e:
-                sock.app.logger.warning('Error handling listener %s', str(e))
-
-            time.sleep(5)
+        # This thread owns the connection: it reads the client's JWT messages and
+        # writes whatever the hub has queued for it, so publishers never block on it
+        hub = app.extensions["notify_hub"]
+        kd_id = None
+        connection = None
+        try:
+            while True:
+                data = ws.receive(timeout=0 if connection is not None else None)
+                if data is not None:
+                    try:
+                        listener_kd_id = _listener_kd_id(json.loads(data))
+                    except Exception as e:
+                        sock.app.logger.warning('Error handling listener %s', str(e))
+                        listener_kd_id = None
+                    if listener_kd_id is not None and listener_kd_id != kd_id:
+                        if connection is not None:
+                            hub.unregister(kd_id, connection)
+                        kd_id = listener_kd_id
+                        connection = hub.register(kd_id, ws)
+                        sock.app.logger.info('Added %s to listeners', kd_id)
+                if connection is not None:
+                    connection.send_queued(timeout=LISTEN_SEND_POLL_SECONDS)
+        except (ConnectionClosed, ConnectionError, OSError):
+            sock.app.logger.info('Breaking handler')
+        finally:
+            if connection is not None:
+                hub.unregister(kd_id, connection)
 
 
     @app.route('/', defaults={'path': ''})
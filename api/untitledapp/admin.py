@@ -1,3 +1,5 @@
+import csv
+import io
 import json
 import os
 
@@ -5,7 +7,12 @@ import flask
 import flask_praetorian
 
 import untitledapp.account as uaa
+import untitledapp.getters as uag
+import untitledapp.history as uah
 import untitledapp.misc as uam
+import untitledapp.notify as uan
+import untitledapp.refresh as uar
+import untitledapp.shared as uas
 from untitledapp import guard, db, User, REQUESTS_SESSION
 
 bp = flask.Blueprint("admin", __name__)
@@ -39,6 +46,12 @@ def update_state():
     app = flask.current_app
     req = flask.request.get_json(force=True)
 
+    if "speed" in req:
+        try:
+            req["speed"] = uas.parse_game_speed(req["speed"])
+        except (TypeError, ValueError):
+            return flask.jsonify({"message": f"Speed must be a multiplier above 0 and at most {uas.MAX_GAME_SPEED} or one of {', '.join(uas.GAME_SPEEDS)}"}), 400
+
     if "game_start" in req:
         create_response = REQUESTS_SESSION.post(
             app.config['AZURE_FUNCTION_ENDPOINT'] + f'/createitem',
@@ -60,12 +73,16 @@ def update_state():
                 },
             }),
         )        
+        uag._memo_invalidate('/empires')
     
     update_response = REQUESTS_SESSION.patch(
         app.config['AZURE_FUNCTION_ENDPOINT'] + f'/updatestate',
         headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
         data=json.dumps(req)
     )
+    uag._memo_invalidate('/state')
+    if "speed" in req:
+        uas.apply_game_speed(req["speed"])
     return flask.jsonify(update_response.text), 200
 
 
@@ -95,6 +112,7 @@ def create_state():
             "active_policies": [],
         })
     )
+    uag._memo_invalidate('/state')
     return flask.jsonify(update_response.text), 200
 
 @bp.route('/api/resetstate', methods=["POST"])
@@ -109,6 +127,7 @@ def reset_state():
         app.config['AZURE_FUNCTION_ENDPOINT'] + f'/resetstate',
         headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
     )
+    uag._memo_invalidate()
     query = db.session.query(User).all()
     for user in query:
         user.kd_id = None
@@ -116,4 +135,80 @@ def reset_state():
         user.kd_death_date = None
     db.session.commit()
     uaa._update_accounts()
-    return flask.jsonify(create_response.text), 200
\ No newline at end of file
+    return flask.jsonify(create_response.text), 200
+
+@bp.route('/api/admin/cachestats', methods=["GET"])
+@flask_praetorian.roles_required('admin')
+def cache_stats():
+    """
+    Hit ratio and staleness of the in-process shared document cache
+    """
+    return flask.jsonify(uag.SHARED_CACHE.stats()), 200
+
+@bp.route('/api/admin/lockstats', methods=["GET"])
+@flask_praetorian.roles_required('admin')
+def lock_stats():
+    """
+    Wait and hold time percentiles per lock pattern, with attempts that timed out,
+    that found the lock busy without waiting and that ended in a busy response
+    """
+    return flask.jsonify(uam._get_lock_stats()), 200
+
+@bp.route('/api/admin/notifystats', methods=["GET"])
+@flask_praetorian.roles_required('admin')
+def notify_stats():
+    """
+    Published, dropped and delivered websocket notifications for this worker
+    """
+    return flask.jsonify(uan.hub().stats()), 200
+
+@bp.route('/api/admin/tickstats', methods=["GET"])
+@flask_praetorian.roles_required('admin')
+def tick_stats():
+    """
+    Target cadence, lag and duration percentiles and coalesced ticks for this worker
+    """
+    return flask.jsonify(uar._get_tick_stats()), 200
+
+@bp.route('/api/admin/historyexport', methods=["GET"])
+@flask_praetorian.roles_required('admin')
+def history_export():
+    """
+    Every kingdom's history as long-format CSV, one row per time and kingdom.
+    "metrics" picks the columns and "points" downsamples to a shared time grid
+    """
+    app = flask.current_app
+    metrics = flask.request.args.get('metrics', ','.join(uas.HISTORY_METRICS)).split(',')
+    if any(metric not in uas.HISTORY_METRICS for metric in metrics):
+        return (flask.jsonify({"message": f"metrics must be from {', '.join(uas.HISTORY_METRICS)}"}), 400)
+    points = flask.request.args.get('points', type=int)
+    if points is not None and points < 1:
+        return (flask.jsonify({"message": "points must be positive"}), 400)
+
+    kingdoms = uag._get_kingdoms()
+    histories_response = REQUESTS_SESSION.post(
+        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/histories',
+        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
+        data=json.dumps({"kingdoms": list(kingdoms)}),
+    )
+    histories = json.loads(histories_response.text)["histories"]
+    rows = uah.export_rows(
+        {
+            kd_id: uah.series_by_metric(series)
+            for kd_id, series in histories.items()
+            if series is not None
+        },
+        kingdoms,
+        metrics,
+        points,
+    )
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["time", "kdId", "name"] + metrics)
+    writer.writerows(rows)
+    return flask.Response(
+        output.getvalue(),
+        mimetype="text/csv",
+        headers={"Content-Disposition": "attachment; filename=history.csv"},
+    )
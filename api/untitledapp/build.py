@@ -11,8 +11,9 @@ from flask_sock import Sock, ConnectionClosed
 
 import untitledapp.misc as uam
 import untitledapp.getters as uag
+import untitledapp.queues as uaq
 import untitledapp.shared as uas
-from untitledapp import alive_required, REQUESTS_SESSION, SOCK_HANDLERS
+from untitledapp import alive_required, REQUESTS_SESSION
 
 bp = flask.Blueprint("build", __name__)
 
@@ -34,6 +35,10 @@ def _make_time_splits(min_time, max_time, num_splits):
         splits_middle_out.append(middle_out_low_end[i])
     return splits_middle_out
 
+def _queue_time(completion_time):
+    """Isoformat completion time, rounded up to the queue bucket so orders landing together share an entry"""
+    return uaq.bucket_time(completion_time, uas.GAME_CONFIG["BASE_QUEUE_BUCKET_SECONDS"]).isoformat()
+
 def _divide_across_splits(splits, amount):
     len_splits = len(splits)
     remainder = amount % len_splits
@@ -71,7 +76,7 @@ def _get_new_recruits(recruits_input, is_conscription, start_time):
     )
     input_splits = _divide_across_splits(time_splits, recruits_input)
 
-    min_time = (
+    min_time = _queue_time(
         start_time
         + datetime.timedelta(
             seconds=uag._calc_recruit_time(
@@ -79,10 +84,10 @@ def _get_new_recruits(recruits_input, is_conscription, start_time):
                 min(input_splits.keys()),
             )
         )
-    ).isoformat()
+    )
     new_recruits = [
         {
-            "time": (
+            "time": _queue_time(
                 start_time
                 + datetime.timedelta(
                     seconds=uag._calc_recruit_time(
@@ -90,7 +95,7 @@ def _get_new_recruits(recruits_input, is_conscription, start_time):
                         time_multiplier,
                     )
                 )
-            ).isoformat(),
+            ),
             "recruits": amount,
         }
         for time_multiplier, amount in input_splits.items()
@@ -203,17 +208,17 @@ def _get_new_mobis(mobis_request, start_time):
         for time_multiplier, amt_split in split_amt_mobi.items():
             mobis_request_split[time_multiplier][key_mobi] = amt_split
     
-    min_mobi_time = (
+    min_mobi_time = _queue_time(
         start_time
         + datetime.timedelta(seconds=uas.GAME_CONFIG["BASE_EPOCH_SECONDS"] * min(mobis_request_split.keys()))
-    ).isoformat()
+    )
 
     new_mobis = [
         {
-            "time": (
+            "time": _queue_time(
                 start_time
                 + datetime.timedelta(seconds=uas.GAME_CONFIG["BASE_EPOCH_SECONDS"] * time_multiplier)
-            ).isoformat(),
+            ),
             **time_mobis,
         }
         for time_multiplier, time_mobis in mobis_request_split.items()
@@ -461,17 +466,17 @@ def _get_new_structures(structures_request, start_time):
         for time_multiplier, amt_split in split_amt_structure.items():
             structures_request_split[time_multiplier][key_structure] = amt_split
     
-    min_structure_time = (
+    min_structure_time = _queue_time(
         start_time
         + datetime.timedelta(seconds=uas.GAME_CONFIG["BASE_EPOCH_SECONDS"] * min(structures_request_split.keys()))
-    ).isoformat()
+    )
 
     new_structures = [
         {
-            "time": (
+            "time": _queue_time(
                 start_time
                 + datetime.timedelta(seconds=uas.GAME_CONFIG["BASE_EPOCH_SECONDS"] * time_multiplier)
-            ).isoformat(),
+            ),
             **time_structures,
         }
         for time_multiplier, time_structures in structures_request_split.items()
@@ -510,7 +515,7 @@ def build_structures():
 
         current_price = uag._get_structure_price(kd_info_parse)
         current_structures = kd_info_parse["structures"]
-        building_structures = structures_info_parse["structures"]
+        building_structures = uaq.BuildQueue.from_document(structures_info_parse, "structures")
 
         state = uag._get_state()
 
@@ -686,7 +691,7 @@ def _get_new_settles(kd_info_parse, settle_input, start_time):
     )
     settle_splits = _divide_across_splits(settle_time_splits, settle_input)
 
-    min_settle_time = (
+    min_settle_time = _queue_time(
         start_time
         + datetime.timedelta(
             seconds=uag._get_settle_time(
@@ -694,10 +699,10 @@ def _get_new_settles(kd_info_parse, settle_input, start_time):
                 min(settle_splits.keys()),
             )
         )
-    ).isoformat()
+    )
     new_settles = [
         {
-            "time": (
+            "time": _queue_time(
                 start_time
                 + datetime.timedelta(
                     seconds=uag._get_settle_time(
@@ -705,7 +710,7 @@ def _get_new_settles(kd_info_parse, settle_input, start_time):
                         time_multiplier,
                     )
                 )
-            ).isoformat(),
+            ),
             "amount": amount,
         }
         for time_multiplier, amount in settle_splits.items()
@@ -864,7 +869,7 @@ def build_missiles():
             datetime.datetime.fromisoformat(state["state"]["game_start"]).astimezone(datetime.timezone.utc)
         )
 
-        missiles_time = (start_time + datetime.timedelta(seconds=uas.GAME_CONFIG["BASE_EPOCH_SECONDS"] * uas.GAME_CONFIG["BASE_MISSILE_TIME_MULTIPLER"])).isoformat()
+        missiles_time = _queue_time(start_time + datetime.timedelta(seconds=uas.GAME_CONFIG["BASE_EPOCH_SECONDS"] * uas.GAME_CONFIG["BASE_MISSILE_TIME_MULTIPLER"]))
         next_resolve = kd_info_parse["next_resolve"]
         next_resolve["missiles"] = min(next_resolve["missiles"], missiles_time)
         kd_payload = {
@@ -912,18 +917,18 @@ def _get_new_engineers(engineers_input, start_time):
     )
     input_splits = _divide_across_splits(time_splits, engineers_input)
 
-    min_time = (
+    min_time = _queue_time(
         start_time
         + datetime.timedelta(seconds=uas.GAME_CONFIG["BASE_EPOCH_SECONDS"] * min(input_splits.keys()))
-    ).isoformat()
+    )
     new_engineers = [
         {
-            "time": (
+            "time": _queue_time(
                 start_time
                 + datetime.timedelta(
                     seconds=uas.GAME_CONFIG["BASE_EPOCH_SECONDS"] * time_multiplier,
                 )
-            ).isoformat(),
+            ),
             "amount": amount,
         }
         for time_multiplier, amount in input_splits.items()
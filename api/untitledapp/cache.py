@@ -0,0 +1,78 @@
+import collections
+import copy
+import threading
+import time
+
+
+class TTLCache:
+    """Process-wide LRU cache whose entries expire after a TTL
+
+    Entries are deep copied in and out so callers can mutate what they get back.
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "invalidations": 0,
+            "evictions": 0,
+            "hit_age_total": 0.0,
+            "hit_age_max": 0.0,
+        }
+
+    def get(self, key, ttl):
+        """Return (True, value) for a live entry, otherwise (False, None)"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return False, None
+            stored_at, value = entry
+            age = now - stored_at
+            if age > ttl:
+                del self._entries[key]
+                self._stats["misses"] += 1
+                self._stats["expired"] += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            self._stats["hit_age_total"] += age
+            self._stats["hit_age_max"] = max(self._stats["hit_age_max"], age)
+        return True, copy.deepcopy(value)
+
+    def set(self, key, value):
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def invalidate(self, *keys):
+        """Drop the given keys. With no keys, drop everything"""
+        with self._lock:
+            if not keys:
+                keys = list(self._entries.keys())
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self._stats["invalidations"] += 1
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            stats = dict(self._stats)
+            ages = {
+                key: now - stored_at
+                for key, (stored_at, _) in self._entries.items()
+            }
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        stats["hit_age_mean"] = stats.pop("hit_age_total") / stats["hits"] if stats["hits"] else 0.0
+        stats["entry_ages"] = ages
+        return stats
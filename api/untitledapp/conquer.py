@@ -1,3 +1,4 @@
+import copy
 import datetime
 import json
 import math
@@ -9,10 +10,13 @@ import flask
 import flask_praetorian
 from flask_sock import Sock, ConnectionClosed
 
+import untitledapp.events as uae
 import untitledapp.misc as uam
 import untitledapp.getters as uag
+import untitledapp.notify as uan
 import untitledapp.shared as uas
-from untitledapp import alive_required, start_required, REQUESTS_SESSION, SOCK_HANDLERS
+import untitledapp.unitofwork as uauow
+from untitledapp import alive_required, start_required, REQUESTS_SESSION
 
 bp = flask.Blueprint("conquer", __name__)
 
@@ -99,30 +103,6 @@ def reveal_random_galaxy():
 
     return (flask.jsonify({"message": f"Reveavled galaxy {galaxy_to_reveal}", "status": "success"}), 200)
 
-def _add_aggression(
-    source_empire,
-    target_empire,
-    aggression_increase,
-    empires_info=None,
-):
-    app = flask.current_app
-    if not empires_info:
-        empires_info = uag._get_empire_info()
-    
-    try:
-        empires_info["empires"][source_empire]["aggression"][target_empire] += aggression_increase
-    except KeyError:
-        empires_info["empires"][source_empire]["aggression"][target_empire] = aggression_increase
-
-    empires_payload = {
-        "empires": empires_info["empires"],
-    }
-    empires_patch_response = REQUESTS_SESSION.patch(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/empires',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-        data=json.dumps(empires_payload),
-    )    
-
 def _validate_attack_request(
     attacker_raw_values,
     kd_info,
@@ -669,8 +649,8 @@ def _attack(req, kd_id, target_kd):
         f'/kingdom/{target_kd}/news',
         f'/galaxy/{attacker_galaxy}/news',
         f'/galaxy/{defender_galaxy}/news',
-        '/empires',
     ]
+    read_ids = [f"kingdom_{kd_id}", f"kingdom_{target_kd}"]
     shared = uag._get_shared(kd_id)["shared"]
     if target_kd in shared:
         cut = shared[target_kd]["cut"]
@@ -679,6 +659,10 @@ def _attack(req, kd_id, target_kd):
             f'/kingdom/{sharer}',
             f'/kingdom/{sharer}/news'
         ])
+        read_ids.append(f"kingdom_{sharer}")
+    else:
+        cut = 0
+        sharer = None
     if attacker_galaxy != defender_galaxy:
         kds_revealed_to = galaxy_info[defender_galaxy]
         base_locks.extend(
@@ -689,28 +673,24 @@ def _attack(req, kd_id, target_kd):
             f'/kingdom/{kd_revealed_to}'
             for kd_revealed_to in kds_revealed_to
         )
+        read_ids.extend(f"kingdom_{kd_revealed_to}" for kd_revealed_to in kds_revealed_to)
     if not uam.acquire_locks(base_locks, request_id=request_id):
         return (flask.jsonify({"message": "Server is busy"}), 400)
 
-    else:
-        cut = 0
-        sharer = None
+    uow = uauow.UnitOfWork()
     try:
-        kd_info = REQUESTS_SESSION.get(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-        )
-        
-        kd_info_parse = json.loads(kd_info.text)
+        kd_infos = uow.read(read_ids)
+        kd_info_parse = kd_infos[f"kingdom_{kd_id}"]
         current_bonuses = {
             project: project_dict.get("max_bonus", 0) * min(kd_info_parse["projects_points"][project] / kd_info_parse["projects_max_points"][project], 1.0)
             for project, project_dict in uas.PROJECTS.items()
             if "max_bonus" in project_dict
         }
 
-        target_kd_info = uag._get_kd_info(target_kd)
+        target_kd_info = kd_infos[f"kingdom_{target_kd}"]
         if target_kd_info["status"].lower() == "dead":
             return kd_info_parse, {"message": "You can't attack this kingdom because they are dead!"}, 400
+        old_target_kd_info = copy.deepcopy(target_kd_info)
         target_current_bonuses = {
             project: project_dict.get("max_bonus", 0) * min(target_kd_info["projects_points"][project] / target_kd_info["projects_max_points"][project], 1.0)
             for project, project_dict in uas.PROJECTS.items()
@@ -864,12 +844,8 @@ def _attack(req, kd_id, target_kd):
                     "from": kd_id,
                     "news": sharer_message,
                 }
-                sharer_news_patch_response = REQUESTS_SESSION.patch(
-                    app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{sharer}/news',
-                    headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-                    data=json.dumps(sharer_news),
-                )
-                uam._add_notifs(sharer, ["news_kingdom"])
+                uow.append_log(f"news_{sharer}", "news", sharer_news)
+                uow.add_notifs(sharer, ["news_kingdom"])
             else:
                 sharer_spoils_values = {}
 
@@ -938,7 +914,8 @@ def _attack(req, kd_id, target_kd):
             target_kd_info["projects_max_points"][key_project] = project_max_func(target_kd_info["stars"])
 
         if sharer and sharer_spoils_values:
-            sharer_kd_info = uag._get_kd_info(sharer)
+            sharer_kd_info = kd_infos[f"kingdom_{sharer}"]
+            old_sharer_kd_info = copy.deepcopy(sharer_kd_info)
             for key_spoil, value_spoil in sharer_spoils_values.items():
                 if key_spoil != "funding":
                     if key_spoil != "money":
@@ -962,68 +939,42 @@ def _attack(req, kd_id, target_kd):
                             sharer_kd_info["money"] += value_funding * (1 - pct_allocated)
                         else:
                             sharer_kd_info["money"] += value_funding
-            sharer_patch_response = REQUESTS_SESSION.patch(
-                app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{sharer}',
-                headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-                data=json.dumps(sharer_kd_info),
-            )
-            try:
-                ws = SOCK_HANDLERS[sharer]
-                ws.send(json.dumps({
-                    "message": f"You have gained {sharer_spoils_values['stars']} from an attack by your galaxymate {kd_info_parse['name']}",
-                    "status": "info",
-                    "category": "Galaxy",
-                    "delay": 15000,
-                    "update": [],
-                }))
-            except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-                pass
+            uow.merge(f"kingdom_{sharer}", sharer_kd_info)
+            uow.after_commit(uae.publish_kingdom_event, sharer, kingdom=uae.kingdom_changes(old_sharer_kd_info, sharer_kd_info))
+            uow.after_commit(uan.publish, sharer, {
+                "message": f"You have gained {sharer_spoils_values['stars']} from an attack by your galaxymate {kd_info_parse['name']}",
+                "status": "info",
+                "category": "Galaxy",
+                "delay": 15000,
+                "update": [],
+            })
         
         if target_kd_info["stars"] <= 0:
             target_kd_info["status"] = "Dead"
-            uam._mark_kingdom_death(target_kd)
-        target_patch_response = REQUESTS_SESSION.patch(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{target_kd}',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-            data=json.dumps(target_kd_info),
-        )
+            uow.after_commit(uam._mark_kingdom_death, target_kd)
+        uow.merge(f"kingdom_{target_kd}", target_kd_info)
+        uow.merge(f"kingdom_{kd_id}", kd_info_parse)
+        uow.after_commit(uae.publish_kingdom_event, target_kd, kingdom=uae.kingdom_changes(old_target_kd_info, target_kd_info))
         target_news = {
             "time": time_now.isoformat(),
             "from": kd_id,
             "news": defender_message,
         }
-        try:
-            ws = SOCK_HANDLERS[target_kd]
-            ws.send(json.dumps({
-                "message": defender_message,
-                "status": "warning",
-                "category": "Attack",
-                "delay": 60000,
-                "update": ["news", "galaxynews"],
-            }))
-        except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-            pass
-        target_news_patch_response = REQUESTS_SESSION.patch(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{target_kd}/news',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-            data=json.dumps(target_news),
-        )
-        uam._add_notifs(target_kd, ["news_kingdom"])
-        kd_patch_response = REQUESTS_SESSION.patch(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-            data=json.dumps(kd_info_parse, default=str),
-        )
+        uow.after_commit(uan.publish, target_kd, {
+            "message": defender_message,
+            "status": "warning",
+            "category": "Attack",
+            "delay": 60000,
+            "update": ["news", "galaxynews"],
+        })
+        uow.append_log(f"news_{target_kd}", "news", target_news)
+        uow.add_notifs(target_kd, ["news_kingdom"])
         kd_attack_history = {
             "time": time_now.isoformat(),
             "to": target_kd,
             "news": attacker_message,
         }
-        kd_attack_history_patch_response = REQUESTS_SESSION.patch(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/attackhistory',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-            data=json.dumps(kd_attack_history, default=str),
-        )
+        uow.append_log(f"attack_history_{kd_id}", "attack_history", kd_attack_history)
 
         kds_to_reveal = galaxy_info[attacker_galaxy]
 
@@ -1062,65 +1013,65 @@ def _attack(req, kd_id, target_kd):
 
             defender_galaxy_payload["news"] = f"{target_kd_info['name']} successfully defended an attack by {kd_info_parse['name']}."
 
-        REQUESTS_SESSION.patch(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/galaxy/{attacker_galaxy}/news',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-            data=json.dumps(attacker_galaxy_payload),
-        )
-        REQUESTS_SESSION.patch(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/galaxy/{defender_galaxy}/news',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-            data=json.dumps(defender_galaxy_payload),
-        )
+        uow.append_log(f"galaxy_news_{attacker_galaxy}", "news", attacker_galaxy_payload)
+        uow.append_log(f"galaxy_news_{defender_galaxy}", "news", defender_galaxy_payload)
         if attacker_galaxy != defender_galaxy:
             kds_revealed_to = galaxy_info[defender_galaxy]
+            kds_revealed_to_patches = {}
             for kd_revealed_to in kds_revealed_to:
-                reveal_galaxy_response = REQUESTS_SESSION.patch(
-                    app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_revealed_to}/revealed',
-                    headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-                    data=json.dumps(payload),
-                )
-                kd_revealed_to_info = uag._get_kd_info(kd_revealed_to)
+                uow.reveal(kd_revealed_to, payload)
+                if kd_revealed_to == target_kd:
+                    kd_revealed_to_info = target_kd_info
+                else:
+                    kd_revealed_to_info = kd_infos[f"kingdom_{kd_revealed_to}"]
                 if revealed_until < kd_revealed_to_info["next_resolve"]["revealed"]:
                     kd_revealed_to_next_resolve = kd_revealed_to_info["next_resolve"]
                     kd_revealed_to_next_resolve["revealed"] = revealed_until
-                    kd_revealed_to_patch_payload = {
+                    kds_revealed_to_patches[f"kingdom_{kd_revealed_to}"] = {
                         "next_resolve": kd_revealed_to_next_resolve
                     }
-                    REQUESTS_SESSION.patch(
-                        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_revealed_to}',
-                        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-                        data=json.dumps(kd_revealed_to_patch_payload),
-                    )
+                    uow.merge(f"kingdom_{kd_revealed_to}", kds_revealed_to_patches[f"kingdom_{kd_revealed_to}"])
                 if kd_revealed_to != target_kd:
-                    try:
-                        ws = SOCK_HANDLERS[kd_revealed_to]
-                        ws.send(json.dumps({
-                            "message": f"Your galaxymate {target_kd_info['name']} was attacked by {kd_info_parse['name']}. Galaxy {attacker_galaxy} will be revealed for {uas.GAME_CONFIG['BASE_EPOCH_SECONDS'] * uas.GAME_CONFIG['BASE_REVEAL_DURATION_MULTIPLIER'] / 3600} hours",
-                            "status": "info",
-                            "category": "Galaxy",
-                            "delay": 15000,
-                            "update": ["galaxynews"],
-                        }))
-                    except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-                        pass
+                    uow.after_commit(uan.publish, kd_revealed_to, {
+                        "message": f"Your galaxymate {target_kd_info['name']} was attacked by {kd_info_parse['name']}. Galaxy {attacker_galaxy} will be revealed for {uas.GAME_CONFIG['BASE_EPOCH_SECONDS'] * uas.GAME_CONFIG['BASE_REVEAL_DURATION_MULTIPLIER'] / 3600} hours",
+                        "status": "info",
+                        "category": "Galaxy",
+                        "delay": 15000,
+                        "update": ["galaxynews"],
+                    })
+            for kd_revealed_to in kds_revealed_to:
+                uow.after_commit(
+                    uae.publish_kingdom_event,
+                    kd_revealed_to,
+                    kingdom=kds_revealed_to_patches.get(f"kingdom_{kd_revealed_to}"),
+                    update=["revealed"],
+                )
         for defender_galaxy_kd in galaxy_info[defender_galaxy]:
-            uam._add_notifs(defender_galaxy_kd, ["news_galaxy"])
+            uow.add_notifs(defender_galaxy_kd, ["news_galaxy"])
 
         if attacker_empire is not None and defender_empire is not None and attacker_empire != defender_empire:
-            _add_aggression(
+            uow.after_commit(
+                uam._add_aggression,
                 attacker_empire,
                 defender_empire,
                 uas.GAME_CONFIG["AGGRO_PER_ATTACK"],
-                empires_info,
             )
 
         attack_results = {
             "status": attack_status,
             "message": attacker_message,
         }
+        failed = uow.commit()
+        if failed:
+            app.logger.error('Could not write %s for the attack by %s on %s', failed, kd_id, target_kd)
+    except uauow.PartialCommitError as e:
+        app.logger.error('Attack by %s on %s was applied in part: %s', kd_id, target_kd, e)
+        return kd_info_parse, {"message": "The attack was only partly applied"}, 500
+    except uauow.CommitError:
+        return kd_info_parse, {"message": "The attack could not be applied, please try again"}, 400
     finally:
         uam.release_locks_by_id(request_id)
+    uow.run_after_commit()
     return kd_info_parse, attack_results, 200
 
 @bp.route('/api/attack/<target_kd>', methods=['POST'])
@@ -1688,7 +1639,6 @@ def _spy(req, kd_id, target_kd):
         f'/kingdom/{target_kd}/siphonsout',
         f'/kingdom/{target_kd}/revealed',
         f'/kingdom/{target_kd}/news',
-        '/empires',
     ]
     if req.get("share_to_galaxy", False):
         galaxies_inverted, galaxies = uag._get_galaxies_inverted()
@@ -1934,6 +1884,7 @@ def _spy(req, kd_id, target_kd):
                 headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
                 data=json.dumps(target_patch_payload, default=str),
             )
+            uae.publish_kingdom_event(target_kd, kingdom=target_patch_payload)
         history_payload = {
             "time": time_now.isoformat(),
             "to": target_kd,
@@ -1957,17 +1908,13 @@ def _spy(req, kd_id, target_kd):
             data=json.dumps(target_news_payload),
         )
         uam._add_notifs(target_kd, ["news_kingdom"])
-        try:
-            ws = SOCK_HANDLERS[target_kd]
-            ws.send(json.dumps({
-                "message": target_message,
-                "status": "warning",
-                "category": "Spy",
-                "delay": 15000,
-                "update": ["news"],
-            }))
-        except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-            pass
+        uan.publish(target_kd, {
+            "message": target_message,
+            "status": "warning",
+            "category": "Spy",
+            "delay": 15000,
+            "update": ["news"],
+        })
 
         if success and operation in uas.REVEAL_OPERATIONS:
             share_to_galaxy = req.get("share_to_galaxy", False)
@@ -1991,11 +1938,10 @@ def _spy(req, kd_id, target_kd):
             and (attacker_empire != defender_empire)
             and (operation in uas.AGGRO_OPERATIONS)
         ):
-            _add_aggression(
+            uam._add_aggression(
                 attacker_empire,
                 defender_empire,
                 uas.GAME_CONFIG["AGGRO_PER_AGGRO_SPY"],
-                empires_info,
             )
 
         new_kd_info = {
@@ -2688,6 +2634,7 @@ def _launch_missiles(req, kd_id, target_kd):
             headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
             data=json.dumps(defender_patch_payload, default=str),
         )
+        uae.publish_kingdom_event(target_kd, kingdom=defender_patch_payload)
         time_now = datetime.datetime.now(datetime.timezone.utc)
         target_news_payload = {
             "time": time_now.isoformat(),
@@ -2735,17 +2682,13 @@ def _launch_missiles(req, kd_id, target_kd):
             headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
             data=json.dumps(defender_galaxy_payload),
         )
-        try:
-            ws = SOCK_HANDLERS[target_kd]
-            ws.send(json.dumps({
-                "message": defender_message,
-                "status": "warning",
-                "category": "Missiles",
-                "delay": 30000,
-                "update": [],
-            }))
-        except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-            pass
+        uan.publish(target_kd, {
+            "message": defender_message,
+            "status": "warning",
+            "category": "Missiles",
+            "delay": 30000,
+            "update": [],
+        })
 
         new_kd_info = {
             **kd_info_parse,
@@ -2822,17 +2765,13 @@ def accept_shared():
             data=json.dumps(revealed_payload),
         )
         
-        try:
-            ws = SOCK_HANDLERS[shared_from_kd]
-            ws.send(json.dumps({
-                "message": f"{kingdoms[kd_id]} accepted intel {shared_info['shared'][accepted_kd]['shared_stat']} for target {kingdoms[accepted_kd]}",
-                "status": "info",
-                "category": "Galaxy",
-                "delay": 15000,
-                "update": [],
-            }))
-        except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-            pass
+        uan.publish(shared_from_kd, {
+            "message": f"{kingdoms[kd_id]} accepted intel {shared_info['shared'][accepted_kd]['shared_stat']} for target {kingdoms[accepted_kd]}",
+            "status": "info",
+            "category": "Galaxy",
+            "delay": 15000,
+            "update": [],
+        })
     finally:
         uam.release_locks_by_id(request_id)
     return (flask.jsonify(shared_info_response.text), 200)
@@ -2919,27 +2858,26 @@ def _offer_shared(req, kd_id):
         uam._add_notifs(kd_to_update, ["shared"])
 
         shared_to_kd_info = uag._get_kd_info(kd_to_update)
+        shared_to_patch_payload = {}
         if shared_resolve_time < shared_to_kd_info["next_resolve"]["shared"]:
             shared_to_next_resolve = shared_to_kd_info["next_resolve"]
             shared_to_next_resolve["shared"] = shared_resolve_time
+            shared_to_patch_payload = {"next_resolve": shared_to_next_resolve}
             REQUESTS_SESSION.patch(
                 app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_to_update}',
                 headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-                data=json.dumps({"next_resolve": shared_to_next_resolve}),
+                data=json.dumps(shared_to_patch_payload),
             )
+        uae.publish_kingdom_event(kd_to_update, kingdom=shared_to_patch_payload, update=["shared"])
 
         
-        try:
-            ws = SOCK_HANDLERS[kd_to_update]
-            ws.send(json.dumps({
-                "message": f"{kingdoms[kd_id]} offered intel {shared_stat} for target {kingdoms[shared_kd]} with a cut of {cut:.1%}",
-                "status": "info",
-                "category": "Galaxy",
-                "delay": 15000,
-                "update": [],
-            }))
-        except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-            pass
+        uan.publish(kd_to_update, {
+            "message": f"{kingdoms[kd_id]} offered intel {shared_stat} for target {kingdoms[shared_kd]} with a cut of {cut:.1%}",
+            "status": "info",
+            "category": "Galaxy",
+            "delay": 15000,
+            "update": [],
+        })
     
     your_shared_info_response = REQUESTS_SESSION.post(
         app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/shared',
@@ -0,0 +1,37 @@
+import untitledapp.notify as uan
+
+
+def current_version(kd_id):
+    return uan.hub().current_version(kd_id)
+
+def kingdom_changes(old_kd_info, new_kd_info):
+    """Return the top-level kingdom fields that differ between two copies of the kingdom"""
+    return {
+        key: value
+        for key, value in new_kd_info.items()
+        if key not in old_kd_info or old_kd_info[key] != value
+    }
+
+def publish_kingdom_event(kd_id, kingdom=None, resolved=None, update=None):
+    """Push a change event to the kingdom's listener
+
+    kingdom holds the changed kingdom fields, resolved the queue categories that
+    resolved and update any other views to refetch. Each event takes the next
+    version for the kingdom whether or not anyone is listening, so a client that
+    sees a version gap or a new stream has missed events and should resync.
+    """
+    kingdom = kingdom or {}
+    resolved = list(resolved or [])
+    update = list(update or [])
+    if not (kingdom or resolved or update):
+        return None
+
+    version = uan.hub().next_version(kd_id)
+    uan.publish(kd_id, {
+        "event": "kingdom",
+        **version,
+        "kingdom": kingdom,
+        "resolved": resolved,
+        "update": update,
+    })
+    return version["version"]
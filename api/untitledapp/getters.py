@@ -3,24 +3,140 @@ import datetime
 import json
 import math
 import os
+import urllib.parse
 
 import flask
 import flask_praetorian
 from flask_sock import Sock, ConnectionClosed
 
+import untitledapp.events as uae
+import untitledapp.history as uah
+import untitledapp.income as uai
+import untitledapp.queues as uaq
 import untitledapp.shared as uas
-from untitledapp import alive_required, start_required, REQUESTS_SESSION, SOCK_HANDLERS
+from untitledapp.cache import TTLCache
+from untitledapp.leaderboard import Leaderboard
+from untitledapp import alive_required, start_required, REQUESTS_SESSION
 
 bp = flask.Blueprint("getters", __name__)
 
-def _get_state():
+MEMO_PATHS = {"/state", "/galaxies", "/empires", "/kingdoms"}
+SHARED_CACHE = TTLCache()
+
+SCORES_TOP_K = 100
+# Redacted leaderboards per viewer, keyed on everything the redaction depends on
+SCORES_REDACTED_TTL_SECONDS = 300
+SCORES_REDACTED_CACHE = TTLCache(max_entries=1024)
+LEADERBOARD = Leaderboard()
+
+# News, messages and action histories are paged in the backend, newest first. The
+# head item always holds at least LOG_DEFAULT_LIMIT entries when the log is that long
+LOG_DEFAULT_LIMIT = 100
+LOG_MAX_LIMIT = 1000
+
+# Charts get a fixed number of points however long the round has run
+HISTORY_CHART_POINTS = 500
+HISTORY_MAX_POINTS = 5000
+
+def _memo_get(path):
+    """GET a shared backend document, memoized on flask.g for the current context"""
+    app = flask.current_app
+    memo = flask.g.setdefault("backend_memo", {})
+    memo_stats = flask.g.setdefault("backend_memo_stats", {"hits": 0, "misses": 0})
+    if path in memo:
+        memo_stats["hits"] += 1
+        return copy.deepcopy(memo[path])
+
+    memo_stats["misses"] += 1
+    ttl = app.config.get("SHARED_CACHE_TTL_SECONDS", 0)
+    cached, value = SHARED_CACHE.get(path, ttl) if ttl else (False, None)
+    if not cached:
+        get_response = REQUESTS_SESSION.get(
+            app.config['AZURE_FUNCTION_ENDPOINT'] + path,
+            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
+        )
+        value = json.loads(get_response.text)
+        if ttl:
+            SHARED_CACHE.set(path, value)
+    memo[path] = value
+    return copy.deepcopy(value)
+
+def _memo_invalidate(*paths):
+    """Drop memoized and cached documents after a write. With no paths, drop everything
+
+    Values memoized under a path, like /empires/aggression/{id} under /empires, are dropped with it
+    """
+    SHARED_CACHE.invalidate(*paths)
+    memo = flask.g.get("backend_memo")
+    if not memo:
+        return
+    if not paths:
+        memo.clear()
+    for memo_path in [
+        memo_path
+        for memo_path in memo
+        if any(memo_path == path or memo_path.startswith(f'{path}/') for path in paths)
+    ]:
+        memo.pop(memo_path)
+
+def _snapshot_get(path):
+    """GET a backend document, shared across views while a bootstrap snapshot is active"""
+    snapshot = flask.g.get("backend_snapshot")
+    if snapshot is not None and path in snapshot:
+        return copy.deepcopy(snapshot[path])
+
     app = flask.current_app
     get_response = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/state',
+        app.config['AZURE_FUNCTION_ENDPOINT'] + path,
         headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
     )
-    get_response_json = json.loads(get_response.text)
-    return get_response_json
+    value = json.loads(get_response.text)
+    if snapshot is None:
+        return value
+    snapshot[path] = value
+    return copy.deepcopy(value)
+
+def _get_log(path, key):
+    """The newest entries of a paged backend log, taking limit and before cursors from the request
+
+    before is the seq of the oldest entry already shown. The first page is sliced
+    from the head item, which a bootstrap snapshot already holds.
+    """
+    limit = min(max(flask.request.args.get('limit', LOG_DEFAULT_LIMIT, type=int), 1), LOG_MAX_LIMIT)
+    before = flask.request.args.get('before', type=int)
+    if before is None and limit <= LOG_DEFAULT_LIMIT:
+        return _snapshot_get(path)[key][:limit]
+    params = {"limit": limit}
+    if before is not None:
+        params["before"] = before
+    return _snapshot_get(f'{path}?{urllib.parse.urlencode(params)}')[key]
+
+@bp.after_app_request
+def _log_memo_stats(response):
+    memo_stats = flask.g.get("backend_memo_stats")
+    if memo_stats:
+        flask.current_app.logger.debug(
+            'Backend memo for %s: %s hits, %s misses',
+            flask.request.path,
+            memo_stats["hits"],
+            memo_stats["misses"],
+        )
+    return response
+
+def _get_state():
+    state = _memo_get('/state')
+    uas.apply_game_speed(state["state"].get("speed"))
+    return state
+
+@bp.before_app_request
+def _apply_game_speed():
+    """Every duration scales with the round's speed, so pick it up before any view computes one"""
+    if not flask.request.path.startswith('/api/'):
+        return
+    try:
+        _get_state()
+    except Exception:
+        flask.current_app.logger.exception('Could not read the round speed from state')
 
 @bp.route('/api/state', methods=["GET"])
 # @flask_praetorian.roles_required('verified')
@@ -62,54 +178,42 @@ def get_state():
     }), 200
 
 def _get_scores():
-    app = flask.current_app
-    get_response = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/scores',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-    )
-    get_response_json = json.loads(get_response.text)
+    get_response_json = _snapshot_get(f'/scores')
     return get_response_json
 
 
-def _get_scores_redacted(revealed, kd_id, galaxies_inverted):
+def _get_scores_redacted(revealed, kd_id, galaxies_inverted, limit=None):
     scores = _get_scores()
+    LEADERBOARD.sync(scores)
+
+    galaxy = galaxies_inverted.get(kd_id)
+    revealed_stats = frozenset(
+        revealed_kd
+        for revealed_kd, revealed_kd_stats in revealed["revealed"].items()
+        if "stats" in revealed_kd_stats
+    )
+    # Without last_update there is nothing to tell two versions of the scores apart
+    cache_key = (kd_id, LEADERBOARD.last_update, galaxy, revealed_stats, limit) if LEADERBOARD.last_update else None
+    cached, payload = SCORES_REDACTED_CACHE.get(cache_key, SCORES_REDACTED_TTL_SECONDS) if cache_key else (False, None)
+    if cached:
+        return payload
+
+    def _redact(rows, use_revealed):
+        return [
+            row
+            if row[0] == kd_id or galaxies_inverted.get(row[0]) == galaxy or (use_revealed and row[0] in revealed_stats)
+            else ("", row[1])
+            for row in rows
+        ]
 
-    top_nw = sorted(scores["networth"].items(), key=lambda item: -item[1])
-    top_stars = sorted(scores["stars"].items(), key=lambda item: -item[1])
-    top_points = sorted(scores["points"].items(), key=lambda item: -item[1])
-
-    top_nw_redacted = []
-    top_stars_redacted = []
-    top_points_redacted = []
-    for item in top_nw:
-        if "stats" in revealed["revealed"].get(item[0], {}) or item[0] == kd_id or galaxies_inverted[item[0]] == galaxies_inverted[kd_id]:
-            top_nw_redacted.append(item)
-        else:
-            top_nw_redacted.append(
-                ("", item[1])
-            )
-    for item in top_stars:
-        if "stats" in revealed["revealed"].get(item[0], {}) or item[0] == kd_id or galaxies_inverted[item[0]] == galaxies_inverted[kd_id]:
-            top_stars_redacted.append(item)
-        else:
-            top_stars_redacted.append(
-                ("", item[1])
-            )
-    for item in top_points:
-        if item[0] == kd_id or galaxies_inverted[item[0]] == galaxies_inverted[kd_id]:
-            top_points_redacted.append(item)
-        else:
-            top_points_redacted.append(
-                ("", item[1])
-            )
-        
-    top_galaxy_networth = sorted(scores["galaxy_networth"].items(), key=lambda x: -x[1])
     payload = {
-        "networth": top_nw_redacted,
-        "stars": top_stars_redacted,
-        "points": top_points_redacted,
-        "galaxy_networth": top_galaxy_networth,
+        "networth": _redact(LEADERBOARD.top("networth", limit), True),
+        "stars": _redact(LEADERBOARD.top("stars", limit), True),
+        "points": _redact(LEADERBOARD.top("points", limit), False),
+        "galaxy_networth": LEADERBOARD.top("galaxy_networth", limit),
     }
+    if cache_key:
+        SCORES_REDACTED_CACHE.set(cache_key, payload)
     return payload
 
 @bp.route('/api/scores', methods=["GET"])
@@ -118,9 +222,10 @@ def _get_scores_redacted(revealed, kd_id, galaxies_inverted):
 def get_scores():
     
     kd_id = flask_praetorian.current_user().kd_id
+    limit = flask.request.args.get("limit", SCORES_TOP_K, type=int)
     revealed = _get_revealed(kd_id)
     galaxies_inverted, _ = _get_galaxies_inverted()
-    scores_redacted = _get_scores_redacted(revealed, kd_id, galaxies_inverted)
+    scores_redacted = _get_scores_redacted(revealed, kd_id, galaxies_inverted, limit)
     return flask.jsonify(scores_redacted), 200
 
 @bp.route('/api/kingdomid')
@@ -138,15 +243,9 @@ def kingdomid():
 @flask_praetorian.auth_required
 # @flask_praetorian.roles_required('verified')
 def kingdom():
-    app = flask.current_app
     kd_id = flask_praetorian.current_user().kd_id
 
-    kd_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    kd_info_parse = json.loads(kd_info.text)
+    kd_info_parse = _get_kd_info(kd_id)
     return (flask.jsonify(kd_info_parse), 200)
 
 
@@ -179,40 +278,22 @@ def shields():
 @flask_praetorian.auth_required
 # @flask_praetorian.roles_required('verified')
 def news():
-    app = flask.current_app
     kd_id = flask_praetorian.current_user().kd_id
     
-    news = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/news',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    news_parse = json.loads(news.text)
-    return (flask.jsonify(news_parse["news"]), 200)
+    news = _get_log(f'/kingdom/{kd_id}/news', "news")
+    return (flask.jsonify(news), 200)
 
 @bp.route('/api/messages')
 @flask_praetorian.auth_required
 # @flask_praetorian.roles_required('verified')
 def messages():
-    app = flask.current_app
     kd_id = flask_praetorian.current_user().kd_id
     
-    messages = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/messages',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    messages_parse = json.loads(messages.text)
-    return (flask.jsonify(messages_parse["messages"]), 200)
+    messages = _get_log(f'/kingdom/{kd_id}/messages', "messages")
+    return (flask.jsonify(messages), 200)
 
 def _get_kingdoms():
-    app = flask.current_app
-    kd_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdoms',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    kd_info_parse = json.loads(kd_info.text)
+    kd_info_parse = _memo_get('/kingdoms')
     return kd_info_parse["kingdoms"]
 
 @bp.route('/api/kingdoms')
@@ -223,12 +304,7 @@ def kingdoms():
     return (flask.jsonify(kingdoms), 200)
 
 def _get_galaxy_info():
-    app = flask.current_app
-    galaxy_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/galaxies',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    galaxy_info_parse = json.loads(galaxy_info.text)
+    galaxy_info_parse = _memo_get('/galaxies')
     
     return galaxy_info_parse["galaxies"]
 
@@ -258,16 +334,64 @@ def galaxies_inverted():
     galaxies_inverted, _ = _get_galaxies_inverted()
     return (flask.jsonify(galaxies_inverted), 200)
 
-def _get_empire_info():
+EMPIRE_AGGRESSION_MEMO = '/empires/aggression'
+
+def _empire_aggression_memo_path(empire_id):
+    return f'{EMPIRE_AGGRESSION_MEMO}/{empire_id}'
+
+def _get_empire_aggression(empire_ids):
+    """Read the per-empire aggression items, memoized on flask.g per empire for the current context
+
+    Empires without an aggression item yet are read through the aggression route,
+    which first moves their legacy aggression off the empires item
+    """
     app = flask.current_app
-    empire_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/empires',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    empire_info_parse = json.loads(empire_info.text)
-    
+    empire_ids = list(empire_ids)
+    memo = flask.g.setdefault("backend_memo", {})
+    missing_ids = [
+        empire_id
+        for empire_id in empire_ids
+        if _empire_aggression_memo_path(empire_id) not in memo
+    ]
+    aggression_items = _batch_read([
+        f'empire_aggression_{empire_id}'
+        for empire_id in missing_ids
+    ])
+    for empire_id in missing_ids:
+        aggression_item = aggression_items.get(f'empire_aggression_{empire_id}')
+        if aggression_item is None:
+            get_response = REQUESTS_SESSION.get(
+                app.config['AZURE_FUNCTION_ENDPOINT'] + f'/empire/{empire_id}/aggression',
+                headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
+            )
+            aggression_item = json.loads(get_response.text)
+        memo[_empire_aggression_memo_path(empire_id)] = aggression_item["aggression"]
+    return {
+        empire_id: copy.deepcopy(memo[_empire_aggression_memo_path(empire_id)])
+        for empire_id in empire_ids
+    }
+
+def _get_empire_info():
+    empire_info_parse = _memo_get('/empires')
+    empire_aggression = _get_empire_aggression(empire_info_parse["empires"].keys())
+    for empire_id, empire_info in empire_info_parse["empires"].items():
+        empire_info["aggression"] = empire_aggression[empire_id]
     return empire_info_parse
 
+def _empires_payload(empires):
+    """The empires map to PATCH back to /empires, without the aggression _get_empire_info merged in
+
+    Aggression lives on each empire's own item and is only written through uam._update_aggression
+    """
+    return {
+        empire_id: {
+            key: value
+            for key, value in empire_info.items()
+            if key != "aggression"
+        }
+        for empire_id, empire_info in empires.items()
+    }
+
 
 def _get_empires_inverted():
     empire_infos = _get_empire_info()
@@ -302,12 +426,7 @@ def empires_inverted():
     return (flask.jsonify(payload), 200)
 
 def _get_empire_politics(empire_id):
-    app = flask.current_app
-    empire_politics = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/empire/{empire_id}/politics',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    empire_politics_parse = json.loads(empire_politics.text)
+    empire_politics_parse = _snapshot_get(f'/empire/{empire_id}/politics')
     
     return empire_politics_parse
 
@@ -328,26 +447,19 @@ def empire_politics():
 @flask_praetorian.auth_required
 # @flask_praetorian.roles_required('verified')
 def galaxy_news():
-    app = flask.current_app
     kd_id = flask_praetorian.current_user().kd_id
     
     galaxies_inverted, _ = _get_galaxies_inverted()
     galaxy = galaxies_inverted[kd_id]
     
-    news = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/galaxy/{galaxy}/news',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    news_parse = json.loads(news.text)
-    return (flask.jsonify(news_parse["news"]), 200)
+    news = _get_log(f'/galaxy/{galaxy}/news', "news")
+    return (flask.jsonify(news), 200)
 
 
 @bp.route('/api/empirenews')
 @flask_praetorian.auth_required
 # @flask_praetorian.roles_required('verified')
 def empire_news():
-    app = flask.current_app
     kd_id = flask_praetorian.current_user().kd_id
     
     empires_inverted, _, _, _ = _get_empires_inverted()
@@ -356,27 +468,16 @@ def empire_news():
     except KeyError:
         return (flask.jsonify([]), 200)
     
-    news = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/empire/{kd_empire}/news',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    news_parse = json.loads(news.text)
-    return (flask.jsonify(news_parse["news"]), 200)
+    news = _get_log(f'/empire/{kd_empire}/news', "news")
+    return (flask.jsonify(news), 200)
 
 
 @bp.route('/api/universenews')
 @flask_praetorian.auth_required
 # @flask_praetorian.roles_required('verified')
 def universe_news():
-    app = flask.current_app
-    news = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/universenews',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    news_parse = json.loads(news.text)
-    return (flask.jsonify(news_parse["news"]), 200)
+    news = _get_log(f'/universenews', "news")
+    return (flask.jsonify(news), 200)
 
 
 
@@ -384,48 +485,30 @@ def universe_news():
 @flask_praetorian.auth_required
 # @flask_praetorian.roles_required('verified')
 def attack_history():
-    app = flask.current_app
     kd_id = flask_praetorian.current_user().kd_id
     
-    history = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/attackhistory',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    history_parse = json.loads(history.text)
-    return (flask.jsonify(history_parse["attack_history"]), 200)
+    history = _get_log(f'/kingdom/{kd_id}/attackhistory', "attack_history")
+    return (flask.jsonify(history), 200)
 
 
 @bp.route('/api/spyhistory')
 @flask_praetorian.auth_required
 # @flask_praetorian.roles_required('verified')
 def spy_history():
-    app = flask.current_app
     kd_id = flask_praetorian.current_user().kd_id
     
-    history = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/spyhistory',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    history_parse = json.loads(history.text)
-    return (flask.jsonify(history_parse["spy_history"]), 200)
+    history = _get_log(f'/kingdom/{kd_id}/spyhistory', "spy_history")
+    return (flask.jsonify(history), 200)
 
 
 @bp.route('/api/missilehistory')
 @flask_praetorian.auth_required
 # @flask_praetorian.roles_required('verified')
 def missile_history():
-    app = flask.current_app
     kd_id = flask_praetorian.current_user().kd_id
     
-    history = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/missilehistory',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    history_parse = json.loads(history.text)
-    return (flask.jsonify(history_parse["missile_history"]), 200)
+    history = _get_log(f'/kingdom/{kd_id}/missilehistory', "missile_history")
+    return (flask.jsonify(history), 200)
 
 
 def _calc_units(
@@ -450,21 +533,10 @@ def _calc_units(
 
     units["current_total"] = current_total
 
+    mobis_queue = uaq.as_queue(mobis_units)
     for hours in [1, 2, 4, 8, 24]:
-        hour_units = {
-            key: 0
-            for key in uas.UNITS.keys()
-        }
-        max_time = start_time + datetime.timedelta(hours=hours)
-        for mobi in mobis_units:
-            
-            
-            
-            if datetime.datetime.fromisoformat(mobi["time"]).astimezone(datetime.timezone.utc) < max_time:
-                for key_unit in hour_units.keys():
-                    hour_units[key_unit] += mobi.get(key_unit, 0)
-
-        units[f"hour_{hours}"] = hour_units
+        max_time = start_time + datetime.timedelta(hours=hours / uas.GAME_CONFIG["GAME_SPEED"])
+        units[f"hour_{hours}"] = mobis_queue.totals_before(max_time.timestamp(), uas.UNITS.keys())
     return units
 
 def _calc_max_offense(
@@ -587,25 +659,13 @@ def _get_units_adjusted_costs(state):
     return units_desc
 
 def _get_mobis_queue(kd_id):
-    app = flask.current_app
-    mobis_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/mobis',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    mobis_info_parse = json.loads(mobis_info.text)
-    return mobis_info_parse["mobis"]
+    mobis_info_parse = _snapshot_get(f'/kingdom/{kd_id}/mobis')
+    return uaq.BuildQueue.from_document(mobis_info_parse, "mobis")
 
 def _get_mobis(kd_id):
     
 
-    app = flask.current_app
-    kd_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    kd_info_parse = json.loads(kd_info.text)
+    kd_info_parse = _get_kd_info(kd_id)
 
     mobis_info_parse = _get_mobis_queue(kd_id)
     current_units = kd_info_parse["units"]
@@ -621,10 +681,7 @@ def _get_mobis(kd_id):
     units = _calc_units(start_time, current_units, generals_units, mobis_units)
     maxes = _calc_maxes(units, kd_info_parse)
 
-    top_queue = sorted(
-        mobis_info_parse,
-        key=lambda queue: queue["time"],
-    )[:10]
+    top_queue = mobis_info_parse.top(10)
     len_queue = len(mobis_info_parse)
 
     galaxies_inverted, _ = _get_galaxies_inverted()
@@ -671,19 +728,11 @@ def _calc_structures(
         "current": {k: current_structures.get(k, 0) for k in uas.STRUCTURES}
     }
 
+    structures_queue = uaq.as_queue(building_structures)
     for hours in epochs:
         epoch_seconds = hours * uas.GAME_CONFIG["BASE_EPOCH_SECONDS"]
-        hour_structures = {
-            key: 0
-            for key in uas.STRUCTURES
-        }
         max_time = start_time + datetime.timedelta(seconds=epoch_seconds)
-        for building_structure in building_structures:
-            if datetime.datetime.fromisoformat(building_structure["time"]).astimezone(datetime.timezone.utc) < max_time:
-                for key_structure in hour_structures.keys():
-                    hour_structures[key_structure] += building_structure.get(key_structure, 0)
-
-        structures[f"hour_{hours}"] = hour_structures
+        structures[f"hour_{hours}"] = structures_queue.totals_before(max_time.timestamp(), uas.STRUCTURES)
     return structures
 
 def _get_structure_price(kd_info):
@@ -705,30 +754,16 @@ def _calc_available_structures(structure_price, kd_info, structures_info):
 
 def _get_structures_info(kd_id):
     
-    app = flask.current_app
-    structures_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/structures',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    structures_info_parse = json.loads(structures_info.text)
+    structures_info_parse = _snapshot_get(f'/kingdom/{kd_id}/structures')
+    building_structures = uaq.BuildQueue.from_document(structures_info_parse, "structures")
 
-    kd_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    kd_info_parse = json.loads(kd_info.text)
+    kd_info_parse = _get_kd_info(kd_id)
 
-    top_queue = sorted(
-        structures_info_parse["structures"],
-        key=lambda queue: queue["time"],
-    )[:10]
-    len_queue = len(structures_info_parse["structures"])
+    top_queue = building_structures.top(10)
+    len_queue = len(building_structures)
 
     current_price = _get_structure_price(kd_info_parse)
     current_structures = kd_info_parse["structures"]
-    building_structures = structures_info_parse["structures"]
 
     state = _get_state()
 
@@ -761,19 +796,198 @@ def structures():
     return (flask.jsonify(payload), 200)
 
 
-def _get_kd_info(kd_id):
+def _project_kd_info(kd_info_parse, mobis_queue=None):
+    """Bring a kingdom's accruing values up to now when CONTINUOUS_INCOME is on"""
+    if not flask.current_app.config.get("CONTINUOUS_INCOME", False):
+        return kd_info_parse
+    if kd_info_parse.get("status", "").lower() == "dead" or "last_income" not in kd_info_parse:
+        return kd_info_parse
+    state = _get_state()
+    time_now = datetime.datetime.now(datetime.timezone.utc)
+    if time_now < datetime.datetime.fromisoformat(state["state"]["game_start"]).astimezone(datetime.timezone.utc):
+        return kd_info_parse
+    if mobis_queue is None:
+        mobis_queue = _get_mobis_queue(kd_info_parse["kdId"])
+    units_training = _calc_units(time_now, {}, [], mobis_queue)["hour_24"]
+    return uai.project_kingdom(kd_info_parse, state, time_now, units_training)
+
+def _get_kd_info(kd_id, project=True):
+    """The kingdom as of now, or as last written with project False"""
+    kd_info_parse = _snapshot_get(f'/kingdom/{kd_id}')
+    if project:
+        return _project_kd_info(kd_info_parse)
+    return kd_info_parse
+
+BOOTSTRAP_KEYS = [
+    'kingdomid', 'kingdom', 'state', 'shields', 'kingdoms', 'galaxies', 'galaxies_inverted',
+    'siphonsout', 'empires', 'empires_inverted', 'empirepolitics', 'news', 'galaxynews',
+    'empirenews', 'universenews', 'settle', 'structures', 'mobis', 'missiles', 'engineers',
+    'projects', 'revealed', 'shared', 'pinned', 'galaxypolitics', 'universepolitics',
+    'attackhistory', 'spyhistory', 'missilehistory', 'messages', 'scores', 'notifs',
+]
+# Kingdom items behind each bootstrap key, by item id prefix
+BOOTSTRAP_ITEMS = {
+    'kingdom': ['kingdom'],
+    'siphonsout': ['siphons_out'],
+    'news': ['news'],
+    'settle': ['kingdom', 'settles'],
+    'structures': ['kingdom', 'structures'],
+    'mobis': ['kingdom', 'mobis'],
+    'missiles': ['kingdom', 'missiles'],
+    'engineers': ['kingdom', 'engineers'],
+    'projects': ['kingdom'],
+    'revealed': ['revealed'],
+    'shared': ['shared'],
+    'pinned': ['pinned'],
+    'attackhistory': ['attack_history'],
+    'spyhistory': ['spy_history'],
+    'missilehistory': ['missile_history'],
+    'messages': ['messages'],
+    'scores': ['revealed'],
+    'notifs': ['notifs'],
+}
+KINGDOM_ITEM_PATHS = {
+    'kingdom': '',
+    'siphons_out': '/siphonsout',
+    'news': '/news',
+    'settles': '/settles',
+    'structures': '/structures',
+    'mobis': '/mobis',
+    'missiles': '/missiles',
+    'engineers': '/engineers',
+    'revealed': '/revealed',
+    'shared': '/shared',
+    'pinned': '/pinned',
+    'attack_history': '/attackhistory',
+    'spy_history': '/spyhistory',
+    'missile_history': '/missilehistory',
+    'messages': '/messages',
+    'notifs': '/notifs',
+}
+
+@bp.route('/api/bootstrap', methods=['POST'])
+@flask_praetorian.auth_required
+# @flask_praetorian.roles_required('verified')
+def bootstrap():
+    """Return several GET views in one response
+
+    The kingdom's backing items are batch read up front and every view reads
+    from the same snapshot, so each document is fetched once. events is the
+    kingdom's change event version the data is current as of.
+    """
+    app = flask.current_app
+    req = flask.request.get_json(force=True)
+    keys = [key for key in req.get("keys", []) if key in BOOTSTRAP_KEYS]
+    kd_id = flask_praetorian.current_user().kd_id
+
+    # Taken before anything is read, so an event that lands mid-bootstrap is
+    # newer than events and is replayed by the client, not skipped
+    events = uae.current_version(kd_id) if kd_id is not None else None
+    snapshot = flask.g.setdefault("backend_snapshot", {})
+    if kd_id is not None:
+        item_prefixes = sorted({
+            item_prefix
+            for key in keys
+            for item_prefix in BOOTSTRAP_ITEMS.get(key, [])
+        })
+        snapshot_items = _batch_read([f'{item_prefix}_{kd_id}' for item_prefix in item_prefixes])
+        for item_prefix in item_prefixes:
+            item = snapshot_items.get(f'{item_prefix}_{kd_id}')
+            if item is not None:
+                snapshot[f'/kingdom/{kd_id}{KINGDOM_ITEM_PATHS[item_prefix]}'] = item
+
+    url_adapter = app.url_map.bind('')
+    payload = {}
+    failed = []
+    for key in keys:
+        try:
+            endpoint, view_args = url_adapter.match(f'/api/{key}', method='GET')
+            view_response = app.make_response(app.view_functions[endpoint](**view_args))
+        except Exception:
+            app.logger.exception('Bootstrap view %s failed', key)
+            failed.append(key)
+            continue
+        if view_response.status_code >= 400:
+            failed.append(key)
+            continue
+        payload[key] = view_response.get_json()
+    return flask.jsonify({"data": payload, "failed": failed, "events": events}), 200
+
+def _get_due_kingdoms(time_due):
+    """Kingdoms with queued or scheduled work due by time_due, or None if the schedule is unavailable"""
     app = flask.current_app
-    kd_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
+    due_response = REQUESTS_SESSION.get(
+        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/resolveschedule',
+        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
+        params={"before": time_due.isoformat()},
     )
-    
-    kd_info_parse = json.loads(kd_info.text)
-    return kd_info_parse
+    if due_response.status_code != 200:
+        return None
+    return set(json.loads(due_response.text)["kingdoms"])
 
+def _batch_read(item_ids):
+    """Read several backend items in one request, keyed by item id"""
+    app = flask.current_app
+    if not item_ids:
+        return {}
+    batch_info = REQUESTS_SESSION.post(
+        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/batch/read',
+        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
+        data=json.dumps({"items": list(item_ids)}),
+    )
+    batch_info_parse = json.loads(batch_info.text)
+    return batch_info_parse["items"]
 
-def _get_max_kd_info(other_kd_id, kd_id, revealed_info, max=False, galaxies_inverted=None):
+BATCH_PATCH_RETRIES = 2
+
+def _batch_patch(patches, retries=0):
+    """Merge top-level keys into several backend items in one request
+
+    patches maps item id to the keys to merge into that item. Items that fail
+    are sent again up to retries more times, which is safe as merging the same
+    keys twice writes the same values. Returns the ids that still failed
+    """
+    app = flask.current_app
+    failed = []
+    for _ in range(retries + 1):
+        if not patches:
+            break
+        batch_response = REQUESTS_SESSION.post(
+            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/batch/patch',
+            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
+            data=json.dumps(
+                {
+                    "items": [
+                        {"id": item_id, "merge": merge}
+                        for item_id, merge in patches.items()
+                    ]
+                },
+                default=str,
+            ),
+        )
+        failed = json.loads(batch_response.text)["failed"]
+        patches = {
+            item_id: patches[item_id]
+            for item_id in failed
+        }
+    return failed
+
+def _patch_item(item_id, operations):
+    """Apply add, set, replace, remove and incr operations to a backend item
+
+    Each operation is {"op", "path", "value"} with a JSON pointer path, so only
+    the change is sent rather than the whole document. Returns the patched item.
+    """
     app = flask.current_app
+    patch_response = REQUESTS_SESSION.patch(
+        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/item/{item_id}',
+        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
+        data=json.dumps({"operations": operations}, default=str),
+    )
+    return json.loads(patch_response.text)
+
+
+def _get_max_kd_info(other_kd_id, kd_id, revealed_info, max=False, galaxies_inverted=None, kd_info_parse=None):
     if galaxies_inverted == None:
         galaxies_inverted, _ = _get_galaxies_inverted()
     always_allowed_keys = {"name", "race", "status", "coordinate"}
@@ -786,12 +1000,8 @@ def _get_max_kd_info(other_kd_id, kd_id, revealed_info, max=False, galaxies_inve
         "projects": ["projects_points", "projects_max_points", "projects_assigned", "completed_projects"],
         "drones": ["drones", "spy_attempts"],
     }
-    kd_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{other_kd_id}',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    kd_info_parse = json.loads(kd_info.text)
+    if kd_info_parse is None:
+        kd_info_parse = _snapshot_get(f'/kingdom/{other_kd_id}')
     if max:
         return kd_info_parse
 
@@ -859,14 +1069,8 @@ def galaxy(galaxy):
     return (flask.jsonify(galaxy_kd_info), 200)
 
 def _get_settle_queue(kd_id):
-    app = flask.current_app
-    settle_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/settles',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    settle_info_parse = json.loads(settle_info.text)
-    return settle_info_parse["settles"]
+    settle_info_parse = _snapshot_get(f'/kingdom/{kd_id}/settles')
+    return uaq.BuildQueue.from_document(settle_info_parse, "settles")
 
 
 def _get_settle_price(kd_info, is_expansionist):
@@ -907,19 +1111,10 @@ def _get_available_settle(kd_info, settle_info, is_expansionist):
 
 def _get_settle(kd_id):
     
-    app = flask.current_app
-    kd_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    kd_info_parse = json.loads(kd_info.text)
+    kd_info_parse = _get_kd_info(kd_id)
     settle_info = _get_settle_queue(kd_id)
 
-    top_queue = sorted(
-        settle_info,
-        key=lambda queue: queue["time"],
-    )[:10]
+    top_queue = settle_info.top(10)
     len_queue = len(settle_info)
 
     galaxies_inverted, _ = _get_galaxies_inverted()
@@ -957,14 +1152,8 @@ def get_settle():
 
 
 def _get_missiles_info(kd_id):
-    app = flask.current_app
-    missiles_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/missiles',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    missiles_info_parse = json.loads(missiles_info.text)
-    return missiles_info_parse["missiles"]
+    missiles_info_parse = _snapshot_get(f'/kingdom/{kd_id}/missiles')
+    return uaq.BuildQueue.from_document(missiles_info_parse, "missiles")
 
 def _get_missiles_building(missiles_info):
     missiles_building = {
@@ -982,21 +1171,12 @@ def _get_missiles_building(missiles_info):
 @flask_praetorian.auth_required
 # @flask_praetorian.roles_required('verified')
 def missiles():
-    app = flask.current_app
     kd_id = flask_praetorian.current_user().kd_id
     
-    kd_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    kd_info_parse = json.loads(kd_info.text)
+    kd_info_parse = _get_kd_info(kd_id)
 
     missiles_info = _get_missiles_info(kd_id)
-    top_queue = sorted(
-        missiles_info,
-        key=lambda queue: queue["time"],
-    )[:10]
+    top_queue = missiles_info.top(10)
     len_queue = len(missiles_info)
     missiles_building = _get_missiles_building(missiles_info)
 
@@ -1030,14 +1210,8 @@ def missiles():
 
 
 def _get_engineers_queue(kd_id):
-    app = flask.current_app
-    engineers_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/engineers',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    engineers_info_parse = json.loads(engineers_info.text)
-    return engineers_info_parse["engineers"]
+    engineers_info_parse = _snapshot_get(f'/kingdom/{kd_id}/engineers')
+    return uaq.BuildQueue.from_document(engineers_info_parse, "engineers")
 
 def _calc_workshop_capacity(kd_info, engineers_building):
     max_workshop_capacity = math.floor(kd_info["structures"]["workshops"]) * math.floor(
@@ -1070,22 +1244,13 @@ def _calc_max_engineers(kd_info, engineers_building, max_workshop_capacity):
 def _get_engineers(kd_id):
     
 
-    app = flask.current_app
-    kd_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    kd_info_parse = json.loads(kd_info.text)
+    kd_info_parse = _get_kd_info(kd_id)
 
     engineers_info = _get_engineers_queue(kd_id)
     engineers_building = sum([training["amount"] for training in engineers_info])
     max_workshop_capacity, current_workshop_capacity = _calc_workshop_capacity(kd_info_parse, engineers_building)
     max_available_engineers, current_available_engineers = _calc_max_engineers(kd_info_parse, engineers_building, max_workshop_capacity)
-    top_queue = sorted(
-        engineers_info,
-        key=lambda queue: queue["time"],
-    )[:10]
+    top_queue = engineers_info.top(10)
     len_queue = len(engineers_info)
 
     payload = {
@@ -1120,16 +1285,10 @@ def engineers():
 @flask_praetorian.auth_required
 # @flask_praetorian.roles_required('verified')
 def projects():
-    app = flask.current_app
     kd_id = flask_praetorian.current_user().kd_id
     
 
-    kd_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    kd_info_parse = json.loads(kd_info.text)
+    kd_info_parse = _get_kd_info(kd_id)
 
     max_bonuses = {
         project: project_dict.get("max_bonus", 0)
@@ -1152,13 +1311,7 @@ def projects():
 
 
 def _get_revealed(kd_id):
-    app = flask.current_app
-    revealed_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/revealed',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    revealed_info_parse = json.loads(revealed_info.text)
+    revealed_info_parse = _snapshot_get(f'/kingdom/{kd_id}/revealed')
     return revealed_info_parse
 
 @bp.route('/api/revealed', methods=['GET'])
@@ -1171,13 +1324,7 @@ def revealed():
     return (flask.jsonify(revealed_info), 200)
 
 def _get_shared(kd_id):
-    app = flask.current_app
-    shared_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/shared',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    shared_info_parse = json.loads(shared_info.text)
+    shared_info_parse = _snapshot_get(f'/kingdom/{kd_id}/shared')
     return shared_info_parse
 
 @bp.route('/api/shared', methods=['GET'])
@@ -1190,13 +1337,7 @@ def shared():
     return (flask.jsonify(shared_info), 200)
 
 def _get_pinned(kd_id):
-    app = flask.current_app
-    pinned_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/pinned',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    pinned_info_parse = json.loads(pinned_info.text)
+    pinned_info_parse = _snapshot_get(f'/kingdom/{kd_id}/pinned')
     return pinned_info_parse
 
 @bp.route('/api/pinned', methods=['GET'])
@@ -1211,9 +1352,16 @@ def pinned():
 def _get_max_kingdoms(kd_id, kingdoms):
     revealed_info = _get_revealed(kd_id)
     galaxies_inverted, _ = _get_galaxies_inverted()
+    kd_infos = _batch_read([f"kingdom_{other_kd_id}" for other_kd_id in kingdoms])
 
     payload = {
-        other_kd_id: _get_max_kd_info(other_kd_id, kd_id, revealed_info, galaxies_inverted=galaxies_inverted)
+        other_kd_id: _get_max_kd_info(
+            other_kd_id,
+            kd_id,
+            revealed_info,
+            galaxies_inverted=galaxies_inverted,
+            kd_info_parse=kd_infos.get(f"kingdom_{other_kd_id}"),
+        )
         for other_kd_id in kingdoms
     }
     return payload
@@ -1231,16 +1379,10 @@ def max_kingdoms():
     return (flask.jsonify(payload), 200)
 
 def _get_galaxy_politics(kd_id, galaxy_id=None):
-    app = flask.current_app
     if not galaxy_id:
         galaxies_inverted, _ = _get_galaxies_inverted()
         galaxy_id = galaxies_inverted[kd_id]
-    galaxy_politics_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/galaxy/{galaxy_id}/politics',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    galaxy_politics_info_parse = json.loads(galaxy_politics_info.text)
+    galaxy_politics_info_parse = _snapshot_get(f'/galaxy/{galaxy_id}/politics')
     return galaxy_politics_info_parse, galaxy_id
 
 @bp.route('/api/galaxypolitics', methods=['GET'])
@@ -1257,13 +1399,7 @@ def galaxy_politics():
     return (flask.jsonify(payload), 200)
 
 def _get_universe_politics():
-    app = flask.current_app
-    universe_politics_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/universevotes',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    universe_politics_info_parse = json.loads(universe_politics_info.text)
+    universe_politics_info_parse = _snapshot_get(f'/universevotes')
     return universe_politics_info_parse
 
 
@@ -1296,23 +1432,11 @@ def universe_politics():
     return (flask.jsonify(payload), 200)
 
 def _get_siphons_in(kd_id):
-    app = flask.current_app
-    siphons_in_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/siphonsin',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    siphons_in_info_parse = json.loads(siphons_in_info.text)
+    siphons_in_info_parse = _snapshot_get(f'/kingdom/{kd_id}/siphonsin')
     return siphons_in_info_parse["siphons_in"]
     
 def _get_siphons_out(kd_id):
-    app = flask.current_app
-    siphons_out_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/siphonsout',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    siphons_out_info_parse = json.loads(siphons_out_info.text)
+    siphons_out_info_parse = _snapshot_get(f'/kingdom/{kd_id}/siphonsout')
     return siphons_out_info_parse["siphons_out"]
 
 @bp.route('/api/siphonsout', methods=['GET'])
@@ -1331,23 +1455,47 @@ def get_siphons_out():
     ]
     return flask.jsonify(siphons_out_redacted), 200
     
-def _get_history(kd_id):
-    app = flask.current_app
-    history_info = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/history',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-    )
-    
-    history_info_parse = json.loads(history_info.text)
-    return history_info_parse["history"]
+def _get_history(kd_id, since=None, before=None):
+    """History Series per metric, limited to [since, before) when given as datetimes"""
+    params = {
+        key: value.isoformat()
+        for key, value in {"since": since, "before": before}.items()
+        if value is not None
+    }
+    path = f'/kingdom/{kd_id}/history'
+    if params:
+        path += f'?{urllib.parse.urlencode(params)}'
+    history_info_parse = _snapshot_get(path)
+    return uah.series_by_metric(history_info_parse["series"])
 
 @bp.route('/api/history', methods=['GET'])
 @flask_praetorian.auth_required
 def get_history():
+    """Each metric downsampled to at most "points" points between "since" and "before"
+
+    Points carry the last value in their bucket along with the bucket's min and max.
+    """
     kd_id = flask_praetorian.current_user().kd_id
+    try:
+        since, before = (
+            datetime.datetime.fromisoformat(flask.request.args[key]) if key in flask.request.args else None
+            for key in ["since", "before"]
+        )
+    except ValueError:
+        return (flask.jsonify({"message": "since and before must be ISO times"}), 400)
+    points = min(max(flask.request.args.get('points', HISTORY_CHART_POINTS, type=int), 1), HISTORY_MAX_POINTS)
 
-    history = _get_history(kd_id)
-    return flask.jsonify(history), 200
+    history = _get_history(kd_id, since=since, before=before)
+    payload = {
+        metric: uah.chart_points(
+            series,
+            points,
+            since=since.timestamp() if since else None,
+            before=before.timestamp() if before else None,
+        )
+        for metric, series in history.items()
+    }
+    return flask.jsonify(payload), 200
 
     
 @bp.route('/api/time')
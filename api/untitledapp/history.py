@@ -0,0 +1,115 @@
+import collections
+import datetime
+
+import numpy as np
+
+
+class Series:
+    """One metric's points as parallel arrays of epoch seconds and values, sorted by time"""
+
+    def __init__(self, times=(), values=()):
+        self.times = np.asarray(times, dtype=float)
+        self.values = np.asarray(values, dtype=float)
+
+    @classmethod
+    def from_columns(cls, columns):
+        return cls(columns.get("time", []), columns.get("value", []))
+
+    def __len__(self):
+        return len(self.times)
+
+    def window(self, since=None, before=None):
+        """Index range of the points at or after since and before before"""
+        i_start = int(np.searchsorted(self.times, since)) if since is not None else 0
+        i_end = int(np.searchsorted(self.times, before)) if before is not None else len(self.times)
+        return i_start, max(i_end, i_start)
+
+    def downsample(self, points, since=None, before=None):
+        """Split the window into points equal time buckets and return (time, min, max, last) per bucket
+
+        time is that of the last point in the bucket and empty buckets are skipped,
+        so a window with no more than points points comes back unchanged.
+        """
+        i_start, i_end = self.window(since, before)
+        times = self.times[i_start:i_end]
+        values = self.values[i_start:i_end]
+        if len(times) <= points:
+            return list(zip(times, values, values, values))
+
+        start = times[0] if since is None else since
+        end = times[-1] if before is None else before
+        width = (end - start) / points or 1
+        i_buckets = np.minimum(((times - start) / width).astype(int), points - 1)
+        # Times are sorted, so each non-empty bucket is one run of points
+        i_firsts = np.flatnonzero(np.diff(i_buckets, prepend=-1))
+        i_lasts = np.append(i_firsts[1:], len(times)) - 1
+        return list(zip(
+            times[i_lasts],
+            np.minimum.reduceat(values, i_firsts),
+            np.maximum.reduceat(values, i_firsts),
+            values[i_lasts],
+        ))
+
+
+def _isoformat(time):
+    return datetime.datetime.fromtimestamp(time, datetime.timezone.utc).isoformat()
+
+def _number(value):
+    return int(value) if value.is_integer() else value
+
+def series_by_metric(columns_by_metric):
+    return {
+        metric: Series.from_columns(columns)
+        for metric, columns in columns_by_metric.items()
+    }
+
+def chart_points(series, points, since=None, before=None):
+    """Downsampled points as {time, value, min, max} dicts, value being the bucket's last"""
+    return [
+        {
+            "time": _isoformat(time),
+            "value": _number(last),
+            "min": _number(value_min),
+            "max": _number(value_max),
+        }
+        for time, value_min, value_max, last in series.downsample(points, since, before)
+    ]
+
+def export_rows(series_by_kd, names, metrics, points=None):
+    """Long-format rows of [time, kdId, name, metric values...] for every kingdom
+
+    With points, the range shared by all kingdoms is split into points equal
+    buckets and each row holds the last value per bucket at the bucket's start,
+    so rows from different kingdoms line up.
+    """
+    all_series = [
+        series
+        for kd_series in series_by_kd.values()
+        for series in kd_series.values()
+        if len(series)
+    ]
+    if not all_series:
+        return []
+    since = min(series.times[0] for series in all_series)
+    end = max(series.times[-1] for series in all_series)
+    width = (end - since) / points if points else 0
+
+    rows = []
+    for kd_id, kd_series in series_by_kd.items():
+        values_by_time = collections.defaultdict(dict)
+        for metric in metrics:
+            series = kd_series.get(metric, Series())
+            for time, value in zip(series.times, series.values):
+                if width:
+                    time = since + min(int((time - since) / width), points - 1) * width
+                values_by_time[time][metric] = value
+        for time, values in values_by_time.items():
+            rows.append(
+                [_isoformat(time), kd_id, names.get(kd_id, "")]
+                + [
+                    _number(values[metric]) if metric in values else None
+                    for metric in metrics
+                ]
+            )
+    rows.sort(key=lambda row: (row[0], row[1]))
+    return rows
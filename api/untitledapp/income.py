@@ -0,0 +1,351 @@
+import copy
+import datetime
+
+import numpy as np
+
+import untitledapp.shared as uas
+
+SHIELD_COST_KEYS = {
+    "military": "BASE_MILITARY_SHIELDS_COST_PER_LAND_PER_PCT",
+    "spy": "BASE_SPY_SHIELDS_COST_PER_LAND_PER_PCT",
+    "spy_radar": "BASE_SPY_RADAR_COST_PER_LAND_PER_PCT",
+    "missiles": "BASE_MISSILES_SHIELDS_COST_PER_LAND_PER_PCT",
+}
+# Kingdom fields written when accrued income is settled outside the tick
+ACCRUED_KEYS = [
+    "money", "fuel", "drones", "population", "funding", "projects_points",
+    "structures", "shields", "income", "networth", "last_income", "last_siphons",
+]
+
+
+def current_bonuses(kd_info):
+    return {
+        project: project_dict.get("max_bonus", 0) * min(kd_info["projects_points"][project] / kd_info["projects_max_points"][project], 1.0)
+        for project, project_dict in uas.PROJECTS.items()
+        if "max_bonus" in project_dict
+    }
+
+def _total_units(kd_info):
+    total_units = {
+        k: v
+        for k, v in kd_info["units"].items()
+    }
+    for general in kd_info["generals_out"]:
+        for key_unit, value_unit in general.items():
+            if key_unit == "return_time":
+                continue
+            total_units[key_unit] += value_unit
+    return total_units
+
+def _column(kd_infos, get_value):
+    return np.array([get_value(kd_info) for kd_info in kd_infos], dtype=float)
+
+def calc_income_batch(
+    kd_infos,
+    current_bonuses,
+    state,
+    time_now,
+    siphons_out_total=None,
+    siphons_in_total=None,
+    units_training=None,
+):
+    """Compute income for many kingdoms at once, one array entry per kingdom
+
+    This is the arithmetic of refresh._kingdom_with_income with the backend reads
+    taken as inputs: the siphon totals and the units training in the next 24 hours,
+    keyed like uas.UNITS, for each kingdom.
+    """
+    config = uas.GAME_CONFIG
+    n_kds = len(kd_infos)
+    unit_keys = list(uas.UNITS.keys())
+    if siphons_out_total is None:
+        siphons_out_total = np.zeros(n_kds)
+    if siphons_in_total is None:
+        siphons_in_total = np.zeros(n_kds)
+    if units_training is None:
+        units_training = [{} for _ in kd_infos]
+
+    time_last_income = _column(
+        kd_infos,
+        lambda kd_info: datetime.datetime.fromisoformat(kd_info["last_income"]).astimezone(datetime.timezone.utc).timestamp(),
+    )
+    epoch_elapsed = (time_now.timestamp() - time_last_income) / config["BASE_EPOCH_SECONDS"]
+
+    stars = _column(kd_infos, lambda kd_info: kd_info["stars"])
+    population = _column(kd_infos, lambda kd_info: kd_info["population"])
+    fuel = _column(kd_infos, lambda kd_info: kd_info["fuel"])
+    is_vult = _column(kd_infos, lambda kd_info: kd_info["race"] == "Vult")
+    is_lumina = _column(kd_infos, lambda kd_info: kd_info["race"] == "Lumina")
+    structures = {
+        key_structure: _column(kd_infos, lambda kd_info: kd_info["structures"].get(key_structure, 0))
+        for key_structure in uas.STRUCTURES
+    }
+    count_structures = _column(kd_infos, lambda kd_info: sum(kd_info["structures"].values()))
+    total_units = np.array(
+        [
+            [kd_total_units.get(key_unit, 0) for key_unit in unit_keys]
+            for kd_total_units in map(_total_units, kd_infos)
+        ],
+        dtype=float,
+    ).reshape(n_kds, len(unit_keys))
+    training = np.array(
+        [
+            [kd_training.get(key_unit, 0) for key_unit in unit_keys]
+            for kd_training in units_training
+        ],
+        dtype=float,
+    ).reshape(n_kds, len(unit_keys))
+
+    is_isolationist = "Isolationist" in state["state"]["active_policies"]
+    is_free_trade = "Free Trade" in state["state"]["active_policies"]
+
+    money_mines = np.floor(structures["mines"]) * config["BASE_MINES_INCOME_PER_EPOCH"]
+    money_population = np.floor(population) * config["BASE_POP_INCOME_PER_EPOCH"]
+    money_bonus = (
+        np.array([bonuses["money_bonus"] for bonuses in current_bonuses], dtype=float)
+        - is_isolationist * config["BASE_ISOLATIONIST_DECREASE"]
+        + is_free_trade * config["BASE_FREE_TRADE_INCREASE"]
+    )
+    money_gross = (money_mines + money_population) * (1 + money_bonus)
+    siphons_out = np.minimum(money_gross * config["BASE_MAX_SIPHON"], siphons_out_total)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        siphons_in = siphons_in_total / epoch_elapsed
+    money_net = money_gross + siphons_in - siphons_out
+    new_income = money_net * epoch_elapsed
+
+    fuel_plants = np.floor(structures["fuel_plants"]) * config["BASE_FUEL_PLANTS_INCOME_PER_EPOCH"]
+    fuel_bonus = (
+        np.array([bonuses["fuel_bonus"] for bonuses in current_bonuses], dtype=float)
+        + is_lumina * config["LUMINA_FUEL_PRODUCTION_INCREASE"]
+    )
+    fuel_units = total_units * np.array([uas.UNITS[key_unit]["fuel"] for key_unit in unit_keys], dtype=float)
+    fuel_population = population * config["BASE_POP_FUEL_CONSUMPTION_PER_EPOCH"]
+    fuel_shields = {
+        key_shield: _column(kd_infos, lambda kd_info: kd_info["shields"][key_shield]) * 100 * stars * config[cost_key]
+        for key_shield, cost_key in SHIELD_COST_KEYS.items()
+    }
+    fuel_net = (
+        fuel_plants * (1 + fuel_bonus)
+        - fuel_units.sum(axis=1)
+        - sum(fuel_shields.values())
+        - fuel_population
+    )
+    max_fuel = np.floor(structures["fuel_plants"]) * config["BASE_FUEL_PLANTS_CAPACITY"]
+    min_fuel = uas.GAME_FUNCS["BASE_NEGATIVE_FUEL_CAP"](stars)
+    new_fuel = np.maximum(np.minimum(max_fuel, fuel + fuel_net * epoch_elapsed), min_fuel)
+
+    drones_income = (
+        np.floor(structures["drone_factories"])
+        * config["BASE_DRONE_FACTORIES_PRODUCTION_PER_EPOCH"]
+        * (1 + is_vult * config["VULT_DRONE_PRODUCTION_INCREASE"])
+    )
+
+    is_fuelless = fuel <= 0
+    max_hangar_capacity = np.floor(structures["hangars"]) * config["BASE_HANGAR_CAPACITY"]
+    current_hangar_capacity = (total_units + training) @ np.array(
+        [uas.UNITS[key_unit]["hangar_capacity"] for key_unit in unit_keys],
+        dtype=float,
+    )
+    overflow = np.maximum(current_hangar_capacity - max_hangar_capacity, 0)
+    pop_capacity = np.floor(
+        structures["homes"]
+        * config["BASE_HOMES_CAPACITY"]
+        * (
+            1
+            - is_fuelless * config["BASE_FUELLESS_POP_CAP_REDUCTION"]
+            - is_vult * config["VULT_POPULATION_REDUCTION"]
+        )
+    )
+    pop_difference = np.maximum(pop_capacity - overflow, 0) - population
+    pop_loss = np.maximum(
+        config["BASE_PCT_POP_LOSS_PER_EPOCH"] * population * epoch_elapsed,
+        config["BASE_POP_LOSS_PER_STAR_PER_EPOCH"] * stars * epoch_elapsed,
+    )
+    pop_gain = np.maximum(
+        config["BASE_PCT_POP_GROWTH_PER_EPOCH"] * population * epoch_elapsed,
+        config["BASE_POP_GROWTH_PER_STAR_PER_EPOCH"] * stars * epoch_elapsed,
+    ) * (1 - is_fuelless * config["BASE_FUELLESS_POP_GROWTH_REDUCTION"])
+    pop_change = np.where(
+        pop_difference < 0,
+        -np.minimum(pop_loss, np.abs(pop_difference)),
+        np.where(pop_difference > 0, np.minimum(pop_gain, pop_difference), 0.0),
+    )
+
+    excess_structures = count_structures - stars
+    reduce_structures = excess_structures > 0
+    structures_reduction = np.maximum(
+        excess_structures * config["BASE_STRUCTURES_LOSS_RETURN_RATE"] * epoch_elapsed,
+        np.minimum.reduce([
+            stars * config["BASE_STRUCTURES_LOSS_PER_STAR_PER_EPOCH"] * epoch_elapsed,
+            excess_structures,
+            count_structures,
+        ]),
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        structures_loss = {
+            key_structure: np.where(
+                reduce_structures & (count_structures != 0),
+                structures[key_structure] / count_structures * structures_reduction,
+                0.0,
+            )
+            for key_structure in uas.STRUCTURES
+        }
+
+    pct_allocated = _column(
+        kd_infos,
+        lambda kd_info: sum(kd_info["auto_spending"].values()) if kd_info["auto_spending_enabled"] else 0,
+    )
+    new_money = _column(kd_infos, lambda kd_info: kd_info["money"]) + new_income * (1 - pct_allocated)
+    new_funding_total = _column(kd_infos, lambda kd_info: sum(kd_info["funding"].values())) + new_income * pct_allocated
+
+    networth_values = config["NETWORTH_VALUES"]
+    networth = np.floor(
+        stars * networth_values["stars"]
+        + count_structures * networth_values["structures"]
+        + (new_money + new_funding_total) * networth_values["money"]
+        + total_units @ np.array([networth_values[key_unit] for key_unit in unit_keys], dtype=float)
+    )
+
+    return {
+        "epoch_elapsed": epoch_elapsed,
+        "money_mines": money_mines,
+        "money_population": money_population,
+        "money_bonus": money_bonus,
+        "money_gross": money_gross,
+        "siphons_out": siphons_out,
+        "siphons_in": siphons_in,
+        "money_net": money_net,
+        "new_income": new_income,
+        "money": new_money,
+        "fuel_plants": fuel_plants,
+        "fuel_bonus": fuel_bonus,
+        "fuel_units": fuel_units,
+        "fuel_population": fuel_population,
+        "fuel_shields": fuel_shields,
+        "fuel_net": fuel_net,
+        "fuel": new_fuel,
+        "drones_income": drones_income,
+        "drones": _column(kd_infos, lambda kd_info: kd_info["drones"]) + drones_income * epoch_elapsed,
+        "population_change": pop_change,
+        "population": population + pop_change,
+        "reduce_structures": reduce_structures,
+        "structures_loss": structures_loss,
+        "networth": networth,
+    }
+
+def kingdoms_with_income(
+    kd_infos,
+    current_bonuses,
+    state,
+    time_now,
+    siphons_out=None,
+    siphons_in=None,
+    units_training=None,
+):
+    """Return updated copies of kd_infos shaped like refresh._kingdom_with_income
+
+    siphons_out and siphons_in are each kingdom's siphon lists. Completing projects
+    and marking dead kingdoms are left to the caller.
+    """
+    if siphons_out is None:
+        siphons_out = [[] for _ in kd_infos]
+    if siphons_in is None:
+        siphons_in = [[] for _ in kd_infos]
+    batch = calc_income_batch(
+        kd_infos,
+        current_bonuses,
+        state,
+        time_now,
+        siphons_out_total=np.array([sum(siphon["siphon"] for siphon in kd_siphons) for kd_siphons in siphons_out], dtype=float),
+        siphons_in_total=np.array([sum(siphon["siphon"] for siphon in kd_siphons) for kd_siphons in siphons_in], dtype=float),
+        units_training=units_training,
+    )
+    unit_keys = list(uas.UNITS.keys())
+
+    new_kd_infos = []
+    for i_kd, kd_info in enumerate(kd_infos):
+        new_kd_info = copy.deepcopy(kd_info)
+        epoch_elapsed = float(batch["epoch_elapsed"][i_kd])
+        new_income = float(batch["new_income"][i_kd])
+        for key_project, assigned_engineers in kd_info["projects_assigned"].items():
+            new_kd_info["projects_points"][key_project] += assigned_engineers * uas.GAME_CONFIG["BASE_ENGINEER_PROJECT_POINTS_PER_EPOCH"] * epoch_elapsed
+        if new_kd_info["auto_spending_enabled"]:
+            for key_spending, pct_spending in new_kd_info["auto_spending"].items():
+                new_kd_info["funding"][key_spending] += pct_spending * new_income
+
+        new_kd_info["money"] = float(batch["money"][i_kd])
+        new_kd_info["fuel"] = float(batch["fuel"][i_kd])
+        new_kd_info["drones"] = float(batch["drones"][i_kd])
+        new_kd_info["population"] = float(batch["population"][i_kd])
+        new_kd_info["last_income"] = time_now.isoformat()
+        new_kd_info["last_siphons"] = time_now.isoformat()
+        new_kd_info["income"] = {
+            "money": {
+                "mines": float(batch["money_mines"][i_kd]),
+                "population": float(batch["money_population"][i_kd]),
+                "bonus": float(batch["money_bonus"][i_kd]),
+                "gross": float(batch["money_gross"][i_kd]),
+                "siphons_out": float(batch["siphons_out"][i_kd]),
+                "siphons_in": float(batch["siphons_in"][i_kd]),
+                "net": float(batch["money_net"][i_kd]),
+            },
+            "fuel": {
+                "fuel_plants": float(batch["fuel_plants"][i_kd]),
+                "bonus": float(batch["fuel_bonus"][i_kd]),
+                "units": {
+                    key_unit: float(batch["fuel_units"][i_kd][unit_keys.index(key_unit)])
+                    for key_unit in _total_units(kd_info)
+                },
+                "population": float(batch["fuel_population"][i_kd]),
+                "shields": {
+                    key_shield: float(fuel_shield[i_kd])
+                    for key_shield, fuel_shield in batch["fuel_shields"].items()
+                },
+                "net": float(batch["fuel_net"][i_kd]),
+            },
+            "drones": float(batch["drones_income"][i_kd]),
+            "population": float(batch["population_change"][i_kd]) / epoch_elapsed,
+        }
+        new_kd_info["networth"] = int(batch["networth"][i_kd])
+        new_kd_info["siphons"] = siphons_in[i_kd]
+
+        if new_kd_info["population"] <= 0:
+            new_kd_info["status"] = "Dead"
+        if batch["reduce_structures"][i_kd]:
+            new_kd_info["structures"] = {
+                k: v - float(batch["structures_loss"].get(k, np.zeros(len(kd_infos)))[i_kd])
+                for k, v in new_kd_info["structures"].items()
+            }
+        if new_kd_info["fuel"] <= 0:
+            new_kd_info["shields"] = {
+                k: 0
+                for k in new_kd_info["shields"]
+            }
+        new_kd_infos.append(new_kd_info)
+    return new_kd_infos
+
+def project_kingdom(kd_info, state, time_now, units_training=None):
+    """Return a copy of kd_info with its income accrued from last_income up to time_now
+
+    The formulas are those of the tick. Siphons move money between kingdoms and
+    are settled by the tick from last_siphons, and deaths and completed projects
+    are left to the tick too, so the stored rates for siphons are carried over.
+    """
+    time_last_income = datetime.datetime.fromisoformat(kd_info["last_income"]).astimezone(datetime.timezone.utc)
+    if time_now <= time_last_income:
+        return copy.deepcopy(kd_info)
+    new_kd_info = kingdoms_with_income(
+        [kd_info],
+        [current_bonuses(kd_info)],
+        state,
+        time_now,
+        units_training=[units_training or {}],
+    )[0]
+    new_kd_info["status"] = kd_info["status"]
+    new_kd_info["siphons"] = kd_info.get("siphons", [])
+    new_kd_info["last_siphons"] = kd_info.get("last_siphons", kd_info["last_income"])
+    money_income = new_kd_info["income"]["money"]
+    for key_siphon in ["siphons_out", "siphons_in"]:
+        money_income[key_siphon] = kd_info.get("income", {}).get("money", {}).get(key_siphon, 0)
+    money_income["net"] = money_income["gross"] + money_income["siphons_in"] - money_income["siphons_out"]
+    return new_kd_info
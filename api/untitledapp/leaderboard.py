@@ -0,0 +1,67 @@
+import bisect
+import threading
+
+SCORE_CATEGORIES = ["networth", "stars", "points", "galaxy_networth"]
+
+
+class SortedIndex:
+    """Ids ordered by descending value, repositioned one id at a time"""
+
+    def __init__(self):
+        self._values = {}
+        self._order = []
+
+    def __len__(self):
+        return len(self._order)
+
+    def update(self, key, value):
+        """Move key to its position for value. Returns False when the value is unchanged"""
+        old_value = self._values.get(key)
+        if old_value == value and key in self._values:
+            return False
+        if key in self._values:
+            del self._order[bisect.bisect_left(self._order, (-old_value, key))]
+        self._values[key] = value
+        bisect.insort(self._order, (-value, key))
+        return True
+
+    def remove(self, key):
+        if key in self._values:
+            del self._order[bisect.bisect_left(self._order, (-self._values.pop(key), key))]
+
+    def top(self, k=None):
+        return [(key, -neg_value) for neg_value, key in self._order[:k]]
+
+    def sync(self, values):
+        """Reposition only the ids whose value differs from values. Returns how many moved"""
+        for key in [key for key in self._values if key not in values]:
+            self.remove(key)
+        return sum(self.update(key, value) for key, value in values.items())
+
+
+class Leaderboard:
+    """A SortedIndex per score category, kept in step with the scores document
+
+    Syncing is skipped while the document's last_update is unchanged, so reads
+    between ticks only slice the top of each index.
+    """
+
+    def __init__(self):
+        self.indexes = {category: SortedIndex() for category in SCORE_CATEGORIES}
+        self.last_update = None
+        self._lock = threading.Lock()
+
+    def sync(self, scores):
+        with self._lock:
+            if scores.get("last_update") is not None and scores.get("last_update") == self.last_update:
+                return 0
+            moved = sum(
+                self.indexes[category].sync(scores.get(category, {}))
+                for category in SCORE_CATEGORIES
+            )
+            self.last_update = scores.get("last_update")
+            return moved
+
+    def top(self, category, k=None):
+        with self._lock:
+            return self.indexes[category].top(k)
@@ -0,0 +1,242 @@
+import abc
+import collections
+import datetime
+import threading
+import time
+import uuid
+
+import flask
+
+from untitledapp import Locks
+
+
+class LockManager(abc.ABC):
+    """Acquire and release named locks as a set
+
+    lock_names are acquired all-or-nothing. wait is how long to wait for the set
+    in seconds and lease is how long the locks are held before they expire.
+    """
+
+    @abc.abstractmethod
+    def acquire(self, lock_names, wait=0, lease=20, request_id=None):
+        pass
+
+    @abc.abstractmethod
+    def release_names(self, lock_names):
+        pass
+
+    @abc.abstractmethod
+    def release_id(self, request_id):
+        pass
+
+
+class InProcessLockManager(LockManager):
+    """Locks held in memory, only valid when the API runs as a single process
+
+    Waiters sleep on a condition variable and are woken on release. A waiter is
+    only granted its set once no earlier waiter wants any of the same locks, so
+    waiters are served first-in first-out per lock.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._held = {}
+        self._waiters = collections.deque()
+
+    def _is_free(self, lock_names, now):
+        for lock_name in lock_names:
+            holder = self._held.get(lock_name)
+            if holder is not None and holder[1] > now:
+                return False
+        return True
+
+    def _is_next(self, ticket, lock_names):
+        for other_ticket, other_lock_names in self._waiters:
+            if other_ticket is ticket:
+                return True
+            if not lock_names.isdisjoint(other_lock_names):
+                return False
+        return True
+
+    def _next_expiry(self, lock_names, now):
+        expiries = [
+            self._held[lock_name][1] - now
+            for lock_name in lock_names
+            if lock_name in self._held
+        ]
+        return min(expiries, default=None)
+
+    def acquire(self, lock_names, wait=0, lease=20, request_id=None):
+        if request_id is None:
+            request_id = str(uuid.uuid4())
+        lock_names = frozenset(lock_names)
+        deadline = time.monotonic() + wait
+        ticket = object()
+        with self._cond:
+            self._waiters.append((ticket, lock_names))
+            try:
+                while True:
+                    now = time.monotonic()
+                    if self._is_next(ticket, lock_names) and self._is_free(lock_names, now):
+                        for lock_name in sorted(lock_names):
+                            self._held[lock_name] = (request_id, now + lease)
+                        return True
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        return False
+                    next_expiry = self._next_expiry(lock_names, now)
+                    if next_expiry is not None:
+                        remaining = min(remaining, max(next_expiry, 0.001))
+                    self._cond.wait(remaining)
+            finally:
+                for i_waiter, (waiter_ticket, _) in enumerate(self._waiters):
+                    if waiter_ticket is ticket:
+                        del self._waiters[i_waiter]
+                        break
+                self._cond.notify_all()
+
+    def release_names(self, lock_names):
+        with self._cond:
+            for lock_name in lock_names:
+                self._held.pop(lock_name, None)
+            self._cond.notify_all()
+
+    def release_id(self, request_id):
+        with self._cond:
+            for lock_name in [name for name, holder in self._held.items() if holder[0] == request_id]:
+                del self._held[lock_name]
+            self._cond.notify_all()
+
+
+class SqlLockManager(LockManager):
+    """Locks stored as rows of the Locks table so they are shared across processes"""
+
+    def _acquire_one(self, lock_name, lease, request_id):
+        db = flask.current_app.extensions["sqlalchemy"]
+        try:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            expiration_time = (now + datetime.timedelta(seconds=lease)).isoformat()
+
+            # Check if the lock is available or expired
+            lock = db.session.query(Locks).filter(Locks.lock_name == lock_name).one_or_none()
+
+            if lock is None or lock.expires_at <= now.isoformat():
+                # Acquire or update the lock
+                db.session.merge(Locks(lock_name=lock_name, request_id=request_id, expires_at=expiration_time))
+                db.session.commit()
+                return True
+
+            # Lock is already held and not expired
+            return False
+        except Exception:
+            flask.current_app.logger.exception("Failed to acquire lock %s", lock_name)
+            db.session.rollback()
+            return False
+
+    def acquire(self, lock_names, wait=0, lease=20, request_id=None):
+        if request_id is None:
+            request_id = str(uuid.uuid4())
+        lock_names = sorted(set(lock_names))
+        if len(lock_names) == 1 and wait == 0:
+            return self._acquire_one(lock_names[0], lease, request_id)
+
+        db = flask.current_app.extensions["sqlalchemy"]
+        try:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            lock_expiration_time = (now + datetime.timedelta(seconds=lease)).isoformat()
+            timeout_time = (now + datetime.timedelta(seconds=wait)).isoformat()
+
+            # Check existing locks
+            existing_locks = db.session.query(Locks).filter(Locks.lock_name.in_(lock_names)).all()
+            new_locks = set(lock_names) - set([lock.lock_name for lock in existing_locks])
+
+            # Reserve locks while trying to acquire active locks
+            for lock_name in sorted(new_locks):
+                db.session.add(Locks(lock_name=lock_name, request_id=request_id, expires_at=lock_expiration_time))
+            if new_locks:
+                db.session.commit()
+
+            # Determine if any lock is already held and not expired
+            expired_locks = []
+            active_locks = []
+            for lock in existing_locks:
+                if lock.expires_at > str(now):
+                    active_locks.append(lock.lock_name)
+                else:
+                    expired_locks.append(lock.lock_name)
+
+            for lock_name in expired_locks:
+                db.session.merge(Locks(lock_name=lock_name, request_id=request_id, expires_at=lock_expiration_time))
+            if expired_locks:
+                db.session.commit()
+
+            db.session.expunge_all()
+            before_timeout = True
+            while active_locks and before_timeout:
+                now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+                existing_locks = db.session.query(Locks).filter(Locks.lock_name.in_(active_locks)).all()
+
+                new_locks = set(active_locks) - set([lock.lock_name for lock in existing_locks])
+                for lock_name in sorted(new_locks):
+                    db.session.add(Locks(lock_name=lock_name, request_id=request_id, expires_at=lock_expiration_time))
+                if new_locks:
+                    db.session.commit()
+
+                expired_locks = [
+                    lock.lock_name
+                    for lock in existing_locks
+                    if lock.expires_at < now
+                ]
+                for lock_name in expired_locks:
+                    db.session.merge(Locks(lock_name=lock_name, request_id=request_id, expires_at=lock_expiration_time))
+                if expired_locks:
+                    db.session.commit()
+
+                active_locks = set(active_locks) - set(new_locks) - set(expired_locks)
+
+                if now > timeout_time:
+                    before_timeout = False
+                    self.release_id(request_id)
+                    return False
+                time.sleep(0.01)
+
+            return True
+        except Exception:
+            flask.current_app.logger.exception("Failed to acquire locks %s", lock_names)
+            db.session.rollback()
+            return False
+
+    def release_names(self, lock_names):
+        db = flask.current_app.extensions["sqlalchemy"]
+        try:
+            # Delete all specified locks in a single query
+            db.session.query(Locks).filter(Locks.lock_name.in_(list(lock_names))).delete(
+                synchronize_session=False
+            )
+            db.session.commit()
+        except Exception:
+            flask.current_app.logger.exception("Failed to release locks %s", lock_names)
+            db.session.rollback()
+
+    def release_id(self, request_id):
+        db = flask.current_app.extensions["sqlalchemy"]
+        try:
+            db.session.query(Locks).filter(Locks.request_id == request_id).delete(
+                synchronize_session=False
+            )
+            db.session.commit()
+        except Exception:
+            flask.current_app.logger.exception("Failed to release locks of request %s", request_id)
+            db.session.rollback()
+
+
+LOCK_BACKENDS = {
+    "memory": InProcessLockManager,
+    "sql": SqlLockManager,
+}
+
+def create_lock_manager(backend):
+    try:
+        return LOCK_BACKENDS[backend]()
+    except KeyError:
+        raise ValueError(f"Unknown lock backend {backend}")
@@ -2,8 +2,10 @@ import collections
 import datetime
 import json
 import os
+import re
 import time
 import random
+import threading
 import uuid
 
 import flask
@@ -11,9 +13,13 @@ import flask_praetorian
 from flask_sock import Sock, ConnectionClosed
 
 import untitledapp.account as uaa
+import untitledapp.events as uae
+import untitledapp.income as uai
+import untitledapp.notify as uan
 import untitledapp.shared as uas
 import untitledapp.getters as uag
-from untitledapp import User, Locks, REQUESTS_SESSION, SOCK_HANDLERS, before_start_required, alive_required
+import untitledapp.queues as uaq
+from untitledapp import User, REQUESTS_SESSION, before_start_required, alive_required
 
 bp = flask.Blueprint("misc", __name__)
 
@@ -23,6 +29,7 @@ def _create_galaxy(galaxy_id):
         app.config['AZURE_FUNCTION_ENDPOINT'] + f'/galaxy/{galaxy_id}',
         headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
     )
+    uag._memo_invalidate('/galaxies')
     return create_galaxy_response.text
 
 def _validate_kingdom_name(
@@ -75,6 +82,7 @@ def create_initial_kingdom():
             headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
             data=json.dumps({"kingdom_name": req["kdName"], "galaxy": chosen_galaxy}),
         )
+        uag._memo_invalidate('/kingdoms', '/galaxies')
         if create_kd_response.status_code != 201:
             return (flask.jsonify({"message": "Error creating kingdom"}), 400)
         
@@ -370,17 +378,13 @@ def send_message(target_kd):
             data=json.dumps(payload_to)
         )
         _add_notifs(target_kd, ["messages"])
-        try:
-            ws = SOCK_HANDLERS[target_kd]
-            ws.send(json.dumps({
-                "message": f"New message from {kingdoms[kd_id]}!",
-                "status": "info",
-                "category": "Message",
-                "delay": 30000,
-                "update": ["messages"],
-            }))
-        except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-            pass
+        uan.publish(target_kd, {
+            "message": f"New message from {kingdoms[kd_id]}!",
+            "status": "info",
+            "category": "Message",
+            "delay": 30000,
+            "update": ["messages"],
+        })
     finally:
         release_locks_by_id(request_id)
     return (flask.jsonify({"message": "Message sent!", "status": "success"}), 200)
@@ -562,6 +566,7 @@ def _add_notifs(kd_id, categories):
         headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
         data=json.dumps({"add_categories": categories}),
     )
+    uae.publish_kingdom_event(kd_id, update=["notifs"])
 
 def _clear_notifs(kd_id, categories):
     app = flask.current_app
@@ -572,12 +577,7 @@ def _clear_notifs(kd_id, categories):
     )
 
 def _get_notifs(kd_id):
-    app = flask.current_app
-    get_notifs_response = REQUESTS_SESSION.get(
-        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/notifs',
-        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-    )
-    get_notifs_response_json = json.loads(get_notifs_response.text)
+    get_notifs_response_json = uag._snapshot_get(f'/kingdom/{kd_id}/notifs')
     return get_notifs_response_json
 
 
@@ -608,47 +608,209 @@ def _mark_kingdom_death(kd_id):
     user.kd_death_date = datetime.datetime.now(datetime.timezone.utc).isoformat()
     db.session.commit()
     uaa._update_accounts()
-    try:
-        ws = SOCK_HANDLERS[kd_id]
-        ws.send(json.dumps({
-            "message": f"You died!",
-            "status": "warning",
-            "category": "Dead",
-            "delay": 999999,
-            "update": [],
-        }))
-    except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-        pass
+    uan.publish(kd_id, {
+        "message": f"You died!",
+        "status": "warning",
+        "category": "Dead",
+        "delay": 999999,
+        "update": [],
+    })
     return flask.jsonify(str(user.__dict__))
 
-def acquire_lock(lock_name, timeout=10):
+def _update_aggression(empire_id, deltas=None, set_values=None, decay=0, last_update=None):
+    """Apply aggression changes to one empire without locking /empires
+
+    The backend applies set_values, then deltas, then decay atomically against the
+    empire's own aggression item and returns the updated item
+    """
+    app = flask.current_app
+    payload = {
+        "set": set_values or {},
+        "deltas": deltas or {},
+        "decay": decay,
+    }
+    if last_update is not None:
+        payload["last_update"] = last_update
+    aggression_response = REQUESTS_SESSION.patch(
+        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/empire/{empire_id}/aggression',
+        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
+        data=json.dumps(payload, default=str),
+    )
+    uag._memo_invalidate(uag._empire_aggression_memo_path(empire_id))
+    return json.loads(aggression_response.text)
+
+def _add_aggression(source_empire, target_empire, aggression_increase):
+    return _update_aggression(source_empire, deltas={target_empire: aggression_increase})
+
+KINGDOM_LOCK_RE = re.compile(r'^/kingdom/([^/]+)$')
+
+def _settle_locked_kingdoms(lock_names):
+    """Write the income kingdoms accrued since last_income once they are locked
+
+    With CONTINUOUS_INCOME the stored kingdom lags its projected values, so the
+    holder of a kingdom lock reads and patches settled values rather than ones
+    that would accrue the same income twice. Returns False if any kingdom could
+    not be settled, as the lock must not be held then.
+    """
+    if not flask.has_app_context() or not flask.current_app.config.get("CONTINUOUS_INCOME", False):
+        return True
+    kd_ids = [
+        match.group(1)
+        for match in map(KINGDOM_LOCK_RE.match, lock_names)
+        if match is not None
+    ]
+    if not kd_ids:
+        return True
+    items = uag._batch_read([
+        f'{item_prefix}_{kd_id}'
+        for kd_id in kd_ids
+        for item_prefix in ["kingdom", "mobis"]
+    ])
+    kd_patches = {}
+    for kd_id in kd_ids:
+        kd_info_parse = items.get(f'kingdom_{kd_id}')
+        if kd_info_parse is None or items.get(f'mobis_{kd_id}') is None:
+            continue
+        projected_kd_info = uag._project_kd_info(
+            kd_info_parse,
+            mobis_queue=uaq.BuildQueue.from_document(items[f'mobis_{kd_id}'], "mobis"),
+        )
+        if projected_kd_info.get("last_income") == kd_info_parse.get("last_income"):
+            continue
+        kd_patches[f'kingdom_{kd_id}'] = {
+            key: projected_kd_info[key]
+            for key in uai.ACCRUED_KEYS
+            if key in projected_kd_info
+        }
+    failed = uag._batch_patch(kd_patches, retries=uag.BATCH_PATCH_RETRIES)
+    snapshot = flask.g.get("backend_snapshot")
+    if snapshot is not None:
+        for kd_id in kd_ids:
+            snapshot.pop(f'/kingdom/{kd_id}', None)
+    if failed:
+        flask.current_app.logger.warning('Could not settle %s before locking', failed)
+        return False
+    return True
+
+def _drop_cached_locked(lock_names):
+    """Reads made under a lock must not come from a cached copy of the same document"""
+    cached_paths = [lock_name for lock_name in lock_names if lock_name in uag.MEMO_PATHS]
+    if cached_paths:
+        uag._memo_invalidate(*cached_paths)
+
+LOCK_TELEMETRY_WINDOW = 1024
+LOCK_PATTERN_RE = re.compile(r'^/(kingdom|galaxy|empire)/[^/]+')
+_LOCK_TELEMETRY_LOCK = threading.Lock()
+_LOCK_TELEMETRY = {}
+_LOCK_ACQUIRED_AT = {}
+_LOCK_REQUEST_NAMES = {}
+
+def _lock_pattern(lock_name):
+    return LOCK_PATTERN_RE.sub(lambda match: f"/{match.group(1)}/{{id}}", lock_name)
+
+def _lock_pattern_stats(pattern):
+    if pattern not in _LOCK_TELEMETRY:
+        _LOCK_TELEMETRY[pattern] = {
+            "wait": collections.deque(maxlen=LOCK_TELEMETRY_WINDOW),
+            "hold": collections.deque(maxlen=LOCK_TELEMETRY_WINDOW),
+            "acquired": 0,
+            "timeouts": 0,
+            "busy": 0,
+            "busy_responses": 0,
+        }
+    return _LOCK_TELEMETRY[pattern]
+
+def _record_lock_acquire(lock_names, acquired, wait_seconds, wait, request_id=None):
+    """Count an acquire attempt. One that failed without waiting found the lock busy, not timed out"""
+    now = time.monotonic()
+    patterns = {_lock_pattern(lock_name) for lock_name in lock_names}
+    with _LOCK_TELEMETRY_LOCK:
+        for pattern in patterns:
+            pattern_stats = _lock_pattern_stats(pattern)
+            pattern_stats["wait"].append(wait_seconds)
+            if acquired:
+                pattern_stats["acquired"] += 1
+            elif wait:
+                pattern_stats["timeouts"] += 1
+            else:
+                pattern_stats["busy"] += 1
+        if acquired:
+            for lock_name in lock_names:
+                _LOCK_ACQUIRED_AT[lock_name] = now
+            if request_id is not None:
+                _LOCK_REQUEST_NAMES[request_id] = list(lock_names)
+    if not acquired and flask.has_request_context():
+        flask.g.failed_lock_patterns = patterns
+
+def _record_lock_release(lock_names):
+    now = time.monotonic()
+    with _LOCK_TELEMETRY_LOCK:
+        for lock_name in lock_names:
+            acquired_at = _LOCK_ACQUIRED_AT.pop(lock_name, None)
+            if acquired_at is not None:
+                _lock_pattern_stats(_lock_pattern(lock_name))["hold"].append(now - acquired_at)
+
+def _percentiles(values):
+    """Count, p50, p90, p99 and max of values, shared by the lock and tick stats"""
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50": values[int(0.50 * (len(values) - 1))],
+        "p90": values[int(0.90 * (len(values) - 1))],
+        "p99": values[int(0.99 * (len(values) - 1))],
+        "max": values[-1],
+    }
+
+def _get_lock_stats():
+    with _LOCK_TELEMETRY_LOCK:
+        return {
+            pattern: {
+                "acquired": pattern_stats["acquired"],
+                "timeouts": pattern_stats["timeouts"],
+                "busy": pattern_stats["busy"],
+                "busy_responses": pattern_stats["busy_responses"],
+                "wait": _percentiles(pattern_stats["wait"]),
+                "hold": _percentiles(pattern_stats["hold"]),
+            }
+            for pattern, pattern_stats in _LOCK_TELEMETRY.items()
+        }
+
+@bp.after_app_request
+def _record_busy_response(response):
+    failed_lock_patterns = flask.g.get("failed_lock_patterns")
+    if failed_lock_patterns and response.status_code == 400:
+        payload = response.get_json(silent=True) or {}
+        if payload.get("message") == "Server is busy":
+            with _LOCK_TELEMETRY_LOCK:
+                for pattern in failed_lock_patterns:
+                    _lock_pattern_stats(pattern)["busy_responses"] += 1
+    return response
+
+def _lock_manager():
+    return flask.current_app.extensions["lock_manager"]
+
+def acquire_lock(lock_name, timeout=10, wait=0, settle=True):
     """
     Try to acquire a lock with a given name.
     
     :param lock_name: Name of the lock
     :param timeout: Expiry time for the lock in seconds
+    :param wait: Seconds to wait for the lock if it is held
+    :param settle: Settle a locked kingdom's continuous income, off for the tick which accrues it itself
     :return: True if the lock was acquired, False otherwise
     """
-    db = flask.current_app.extensions["sqlalchemy"]
-    try:
-        now = datetime.datetime.now(datetime.timezone.utc)
-        expiration_time = (now + datetime.timedelta(seconds=timeout)).isoformat()
-
-        # Check if the lock is available or expired
-        lock = db.session.query(Locks).filter(Locks.lock_name == lock_name).one_or_none()
-
-        if lock is None or lock.expires_at <= now.isoformat():
-            # Acquire or update the lock
-            db.session.merge(Locks(lock_name=lock_name, request_id=str(uuid.uuid4()), expires_at=expiration_time))
-            db.session.commit()
-            return True
-
-        # Lock is already held and not expired
-        return False
-    except Exception as e:
-        print(f"Failed to acquire lock: {e}")
-        db.session.rollback()
-        return False
+    wait_start = time.monotonic()
+    acquired = _lock_manager().acquire([lock_name], wait=wait, lease=timeout)
+    _record_lock_acquire([lock_name], acquired, time.monotonic() - wait_start, wait)
+    if acquired:
+        _drop_cached_locked([lock_name])
+        if settle and not _settle_locked_kingdoms([lock_name]):
+            # Fields patched under the lock would accrue the unsettled income a second time
+            release_lock(lock_name)
+            return False
+    return acquired
 
 def release_lock(lock_name):
     """
@@ -656,98 +818,31 @@ def release_lock(lock_name):
     
     :param lock_name: Name of the lock
     """
-    db = flask.current_app.extensions["sqlalchemy"]
-    try:
-        # Delete the lock
-        db.session.query(Locks).filter(Locks.lock_name == lock_name).delete()
-        db.session.commit()
-    except Exception as e:
-        print(f"Failed to release lock: {e}")
-        db.session.rollback()
+    _lock_manager().release_names([lock_name])
+    _record_lock_release([lock_name])
 
-def acquire_locks(lock_names, timeout=10, lock_timeout=20, request_id=None) -> bool:
+def acquire_locks(lock_names, timeout=10, lock_timeout=20, request_id=None, settle=True) -> bool:
     """
     Try to acquire multiple locks.
     
     :param lock_names: List of lock names to acquire.
-    :param timeout: Expiry time for each lock in seconds.
+    :param timeout: Seconds to wait for all of the locks.
+    :param lock_timeout: Expiry time for each lock in seconds.
+    :param settle: Settle the continuous income of locked kingdoms.
     :return: True if all locks were acquired, False otherwise.
     """
-    db = flask.current_app.extensions["sqlalchemy"]
     if request_id is None:
         request_id = str(uuid.uuid4())
-    try:
-        now = datetime.datetime.now(datetime.timezone.utc)
-        lock_expiration_time = (now + datetime.timedelta(seconds=lock_timeout)).isoformat()
-        timeout_time = (now + datetime.timedelta(seconds=timeout)).isoformat()
-
-        # Check existing locks
-        existing_locks = db.session.query(Locks).filter(Locks.lock_name.in_(lock_names)).all()
-        print("existing_locks:", existing_locks)
-        new_locks = set(lock_names) - set([lock.lock_name for lock in existing_locks])
-        print("new_locks:", new_locks)
-                
-        # Reserve locks while trying to acquire active locks
-        for lock_name in new_locks:
-            db.session.add(Locks(lock_name=lock_name, request_id=request_id, expires_at=lock_expiration_time))
-        if new_locks:
-            db.session.commit()
-
-        # Determine if any lock is already held and not expired
-        expired_locks = []
-        active_locks = []
-        for lock in existing_locks:
-            if lock.expires_at > str(now):
-                active_locks.append(lock.lock_name)
-            else:
-                expired_locks.append(lock.lock_name)
-        print("active_locks:", active_locks)
-        print("expired_locks:", expired_locks)
-        
-        for lock_name in expired_locks:
-            db.session.merge(Locks(lock_name=lock_name, request_id=request_id, expires_at=lock_expiration_time))
-        if expired_locks:
-            db.session.commit()
-
-        db.session.expunge_all()
-        before_timeout = True
-        while active_locks and before_timeout:
-            now = datetime.datetime.now(datetime.timezone.utc).isoformat()
-            existing_locks = db.session.query(Locks).filter(Locks.lock_name.in_(active_locks)).all()
-
-            new_locks = set(active_locks) - set([lock.lock_name for lock in existing_locks])
-            for lock_name in new_locks:
-                db.session.add(Locks(lock_name=lock_name, request_id=request_id, expires_at=lock_expiration_time))
-            if new_locks:
-                print("new_locks (loop):", new_locks)
-                db.session.commit()
-            
-            expired_locks = [
-                lock.lock_name
-                for lock in existing_locks
-                if lock.expires_at < now
-            ]
-            for lock_name in expired_locks:
-                db.session.merge(Locks(lock_name=lock_name, request_id=request_id, expires_at=lock_expiration_time))
-            if expired_locks:
-                print("expired_locks (loop):", expired_locks)
-                db.session.commit()
-
-            active_locks = set(active_locks) - set(new_locks) - set(expired_locks)
-            if new_locks or expired_locks:
-                print("active_locks (loop):", active_locks)
-
-            if now > timeout_time:
-                before_timeout = False
-                release_locks_by_id(request_id)
-                return False
-            time.sleep(0.01)
-        
-        return True
-    except Exception as e:
-        print(f"Failed to acquire locks: {e}")
-        db.session.rollback()
-        return False
+    wait_start = time.monotonic()
+    acquired = _lock_manager().acquire(lock_names, wait=timeout, lease=lock_timeout, request_id=request_id)
+    _record_lock_acquire(lock_names, acquired, time.monotonic() - wait_start, timeout, request_id=request_id)
+    if acquired:
+        _drop_cached_locked(lock_names)
+        if settle and not _settle_locked_kingdoms(lock_names):
+            # Fields patched under the locks would accrue the unsettled income a second time
+            release_locks_by_id(request_id)
+            return False
+    return acquired
 
 def release_locks_by_name(lock_names):
     """
@@ -755,24 +850,11 @@ def release_locks_by_name(lock_names):
 
     :param lock_names: List of lock names to release.
     """
-    db = flask.current_app.extensions["sqlalchemy"]
-    try:
-        # Delete all specified locks in a single query
-        db.session.query(Locks).filter(Locks.lock_name.in_(lock_names)).delete(
-            synchronize_session=False
-        )
-        db.session.commit()
-    except Exception as e:
-        print(f"Failed to release locks: {e}")
-        db.session.rollback()
+    _lock_manager().release_names(lock_names)
+    _record_lock_release(lock_names)
 
 def release_locks_by_id(request_id):
-    db = flask.current_app.extensions["sqlalchemy"]
-    try:
-        db.session.query(Locks).filter(Locks.request_id == request_id).delete(
-            synchronize_session=False
-        )
-        db.session.commit()
-    except Exception as e:
-        print(f"Failed to release locks: {e}")
-        db.session.rollback()
\ No newline at end of file
+    _lock_manager().release_id(request_id)
+    with _LOCK_TELEMETRY_LOCK:
+        lock_names = _LOCK_REQUEST_NAMES.pop(request_id, [])
+    _record_lock_release(lock_names)
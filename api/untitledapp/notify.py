@@ -0,0 +1,316 @@
+import abc
+import collections
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+import flask
+
+logger = logging.getLogger(__name__)
+
+# Toasts still queued after this many seconds are dropped rather than shown late
+TOAST_MAX_AGE_SECONDS = 30
+
+
+class Backplane(abc.ABC):
+    """Carries published notifications to every process that holds websockets
+
+    start is called once per process with the hub's deliver callback, which must
+    then be called for every notification published by any process. Event
+    versions are numbered here too so every process agrees on them.
+    """
+
+    @abc.abstractmethod
+    def start(self, deliver):
+        pass
+
+    @abc.abstractmethod
+    def publish(self, kd_id, data):
+        pass
+
+    @abc.abstractmethod
+    def next_version(self, kd_id):
+        pass
+
+    @abc.abstractmethod
+    def current_version(self, kd_id):
+        pass
+
+
+class InProcessBackplane(Backplane):
+    """Delivers straight back to this process, only valid for a single worker"""
+
+    def __init__(self):
+        # Versions restart with the process, so they are numbered within a stream
+        self.stream = str(uuid.uuid4())
+        self._versions = collections.defaultdict(int)
+        self._versions_lock = threading.Lock()
+
+    def start(self, deliver):
+        self._deliver = deliver
+
+    def publish(self, kd_id, data):
+        self._deliver(kd_id, data)
+
+    def next_version(self, kd_id):
+        with self._versions_lock:
+            self._versions[kd_id] += 1
+            return {"stream": self.stream, "version": self._versions[kd_id]}
+
+    def current_version(self, kd_id):
+        with self._versions_lock:
+            return {"stream": self.stream, "version": self._versions[kd_id]}
+
+
+class SqliteBackplane(Backplane):
+    """Notifications appended to a shared SQLite file and tailed by each process
+
+    Every process polls for rows newer than the last it saw. Rows are only kept
+    for retention seconds, long enough for every poller to pick them up.
+    """
+
+    def __init__(self, path, poll_interval=0.05, retention=60):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS notifications ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, kd_id TEXT, data TEXT, created REAL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS event_versions (kd_id TEXT PRIMARY KEY, version INTEGER)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('stream', ?)", (str(uuid.uuid4()),))
+            self._local.conn = conn
+        return conn
+
+    def _stream(self, conn):
+        return conn.execute("SELECT value FROM meta WHERE key = 'stream'").fetchone()[0]
+
+    def start(self, deliver):
+        last_id = self._connect().execute("SELECT COALESCE(MAX(id), 0) FROM notifications").fetchone()[0]
+        thread = threading.Thread(target=self._poll, args=(deliver, last_id), name="notify-sqlite-poll", daemon=True)
+        thread.start()
+
+    def publish(self, kd_id, data):
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT INTO notifications (kd_id, data, created) VALUES (?, ?, ?)",
+            (kd_id, data, now),
+        )
+        conn.execute("DELETE FROM notifications WHERE created < ?", (now - self.retention,))
+
+    def next_version(self, kd_id):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO event_versions (kd_id, version) VALUES (?, 1) "
+                "ON CONFLICT(kd_id) DO UPDATE SET version = version + 1",
+                (kd_id,),
+            )
+            version = conn.execute("SELECT version FROM event_versions WHERE kd_id = ?", (kd_id,)).fetchone()[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return {"stream": self._stream(conn), "version": version}
+
+    def current_version(self, kd_id):
+        conn = self._connect()
+        row = conn.execute("SELECT version FROM event_versions WHERE kd_id = ?", (kd_id,)).fetchone()
+        return {"stream": self._stream(conn), "version": row[0] if row else 0}
+
+    def _poll(self, deliver, last_id):
+        while True:
+            try:
+                rows = self._connect().execute(
+                    "SELECT id, kd_id, data FROM notifications WHERE id > ? ORDER BY id",
+                    (last_id,),
+                ).fetchall()
+                for row_id, kd_id, data in rows:
+                    last_id = row_id
+                    deliver(kd_id, data)
+            except Exception:
+                logger.exception("Failed to poll notifications")
+            time.sleep(self.poll_interval)
+
+
+class Connection:
+    """A websocket and its bounded queue of outgoing notifications
+
+    offer never blocks. When the queue is full the oldest toast is dropped to
+    make room, then the oldest event. A dropped event shows up as a version gap,
+    which makes the client resync. The queue is drained by send_queued on the
+    connection's own listener thread, so a slow client only delays itself.
+    """
+
+    def __init__(self, ws, max_queued=64):
+        self.ws = ws
+        self.max_queued = max_queued
+        self.dropped = 0
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+
+    def offer(self, data, is_toast):
+        with self._cond:
+            if len(self._queue) >= self.max_queued:
+                self._drop_oldest()
+            self._queue.append((time.monotonic(), data, is_toast))
+            self._cond.notify()
+
+    def _drop_oldest(self):
+        for i_queued, (_, _, is_toast) in enumerate(self._queue):
+            if is_toast:
+                del self._queue[i_queued]
+                break
+        else:
+            self._queue.popleft()
+        self.dropped += 1
+
+    def send_queued(self, timeout):
+        """Wait up to timeout for notifications and send everything queued"""
+        with self._cond:
+            if not self._queue:
+                self._cond.wait(timeout)
+            queued = list(self._queue)
+            self._queue.clear()
+        now = time.monotonic()
+        for queued_at, data, is_toast in queued:
+            if is_toast and now - queued_at > TOAST_MAX_AGE_SECONDS:
+                self.dropped += 1
+                continue
+            self.ws.send(data)
+        return len(queued)
+
+
+class NotificationHub:
+    """Websocket connections by kingdom, fed by a non-blocking publish queue
+
+    publish never waits on a socket. Notifications are queued, handed to the
+    backplane on a sender thread, and offered to every connection the kingdom
+    has in whichever process receives them. Notifications are dropped, and
+    counted, when the queue is full.
+    """
+
+    def __init__(self, backplane, max_pending=10000):
+        self.backplane = backplane
+        self._connections = collections.defaultdict(set)
+        self._lock = threading.Lock()
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._started_pid = None
+        # Counted from request, sender and poll threads alike
+        self._stats_lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so start lazily in the process that uses the hub
+        if self._started_pid == os.getpid():
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self.backplane.start(self.deliver)
+            threading.Thread(target=self._send_pending, name="notify-publish", daemon=True).start()
+            self._started_pid = os.getpid()
+
+    def register(self, kd_id, ws):
+        self._ensure_started()
+        connection = Connection(ws)
+        with self._lock:
+            self._connections[kd_id].add(connection)
+        return connection
+
+    def unregister(self, kd_id, connection):
+        with self._lock:
+            connections = self._connections.get(kd_id)
+            if connections is not None:
+                connections.discard(connection)
+                if not connections:
+                    del self._connections[kd_id]
+        self._count("dropped_by_connections", connection.dropped)
+
+    def connection_count(self, kd_id=None):
+        with self._lock:
+            if kd_id is not None:
+                return len(self._connections.get(kd_id, ()))
+            return sum(len(connections) for connections in self._connections.values())
+
+    def publish(self, kd_id, message):
+        self._ensure_started()
+        try:
+            self._pending.put_nowait((kd_id, json.dumps(message, default=str)))
+            self._count("published")
+        except queue.Full:
+            self._count("dropped")
+
+    def _send_pending(self):
+        while True:
+            kd_id, data = self._pending.get()
+            try:
+                self.backplane.publish(kd_id, data)
+            except Exception:
+                self._count("backplane_errors")
+                logger.exception("Failed to publish notification")
+            finally:
+                self._pending.task_done()
+
+    def deliver(self, kd_id, data):
+        with self._lock:
+            connections = list(self._connections.get(kd_id, ()))
+        if not connections:
+            return
+        is_toast = "event" not in json.loads(data)
+        for connection in connections:
+            connection.offer(data, is_toast)
+        self._count("delivered", len(connections))
+
+    def next_version(self, kd_id):
+        return self.backplane.next_version(kd_id)
+
+    def current_version(self, kd_id):
+        return self.backplane.current_version(kd_id)
+
+    def flush(self):
+        """Block until everything published so far has been handed to the backplane"""
+        self._pending.join()
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        return {
+            **stats,
+            "pending": self._pending.qsize(),
+            "connections": self.connection_count(),
+        }
+
+
+def create_hub(backend, sqlite_path=None):
+    if backend == "memory":
+        return NotificationHub(InProcessBackplane())
+    if backend == "sqlite":
+        return NotificationHub(SqliteBackplane(sqlite_path))
+    raise ValueError(f"Unknown notify backend {backend}")
+
+def hub():
+    return flask.current_app.extensions["notify_hub"]
+
+def publish(kd_id, message):
+    """Queue a notification for every websocket the kingdom has open"""
+    hub().publish(kd_id, message)
@@ -14,7 +14,7 @@ import flask_praetorian
 import untitledapp.misc as uam
 import untitledapp.getters as uag
 import untitledapp.shared as uas
-from untitledapp import alive_required, start_required, REQUESTS_SESSION, SOCK_HANDLERS
+from untitledapp import alive_required, start_required, REQUESTS_SESSION
 
 bp = flask.Blueprint("politics", __name__)
 
@@ -157,6 +157,7 @@ def create_empire():
             headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
             data=json.dumps(empire_payload)
         )
+        uag._memo_invalidate('/empires')
     finally:
         uam.release_lock('/empires')
 
@@ -305,7 +306,7 @@ def accept_empire_invite(target_empire):
         
         empires_info["empires"][target_empire]["galaxies"].append(kd_galaxy)
         empires_payload = {
-            "empires": empires_info["empires"]
+            "empires": uag._empires_payload(empires_info["empires"])
         }
 
         empires_response = REQUESTS_SESSION.patch(
@@ -313,6 +314,7 @@ def accept_empire_invite(target_empire):
             headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
             data=json.dumps(empires_payload)
         )
+        uag._memo_invalidate('/empires')
 
         target_empire_politics = uag._get_empire_politics(target_empire)
         new_empire_requests = set(target_empire_politics["empire_invitations"])
@@ -512,6 +514,7 @@ def accept_galaxy_request(target_galaxy):
             headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
             data=json.dumps(empires_payload)
         )
+        uag._memo_invalidate('/empires')
 
         new_empire_requests = set(empire_politics["empire_join_requests"])
         new_empire_requests.remove(target_galaxy)
@@ -585,6 +588,7 @@ def leave_empire():
             headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
             data=json.dumps(empires_payload)
         )
+        uag._memo_invalidate('/empires')
 
         if len(empires_info[kd_empire]["galaxies"]) > 0 and empire_politics["leader"] == kd_galaxy_id:
             kd_empire_payload = {
@@ -648,10 +652,7 @@ def denounce(target_empire):
         empires_info["empires"][kd_empire]["denounced_expires"] = time_denounce_expires.isoformat()
 
         aggression_increase = empires_info["empires"][kd_empire]["aggression_max"] * uas.GAME_CONFIG["DENOUNCE_AGGRO_METER_INCREASE"]
-        try:
-            empires_info["empires"][kd_empire]["aggression"][target_empire] += aggression_increase
-        except KeyError:
-            empires_info["empires"][kd_empire]["aggression"][target_empire] = aggression_increase
+        uam._add_aggression(kd_empire, target_empire, aggression_increase)
 
         news_payload = {
             "news": {
@@ -666,13 +667,14 @@ def denounce(target_empire):
         )
 
         empires_payload = {
-            "empires": empires_info["empires"],
+            "empires": uag._empires_payload(empires_info["empires"]),
         }
         update_response = REQUESTS_SESSION.patch(
             app.config['AZURE_FUNCTION_ENDPOINT'] + f'/empires',
             headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
             data=json.dumps(empires_payload)
         )
+        uag._memo_invalidate('/empires')
     finally:
         uam.release_locks_by_id(request_id)
     return flask.jsonify({"message": "Denounced!", "status": "success"}), 200
@@ -742,13 +744,14 @@ def declare_war(target_empire):
         )
 
         empires_payload = {
-            "empires": empires_info["empires"],
+            "empires": uag._empires_payload(empires_info["empires"]),
         }
         update_response = REQUESTS_SESSION.patch(
             app.config['AZURE_FUNCTION_ENDPOINT'] + f'/empires',
             headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
             data=json.dumps(empires_payload)
         )
+        uag._memo_invalidate('/empires')
     finally:
         uam.release_locks_by_id(request_id)
     return flask.jsonify({"message": "Declared war!", "status": "success"}), 200
@@ -1208,8 +1211,8 @@ def _surrender(
     )
 
 
-    empires_info["empires"][winning_empire]["aggression"][losing_empire] = 0
-    empires_info["empires"][losing_empire]["aggression"][winning_empire] = 0
+    uam._update_aggression(winning_empire, set_values={losing_empire: 0})
+    uam._update_aggression(losing_empire, set_values={winning_empire: 0})
 
     empires_info["empires"][winning_empire]["war"] = [
         empire_id for empire_id in empires_info["empires"][winning_empire]["war"]
@@ -1227,13 +1230,14 @@ def _surrender(
     empires_info["empires"][winning_empire]["peace"][losing_empire] = time_peace_expires.isoformat()
     empires_info["empires"][losing_empire]["peace"][winning_empire] = time_peace_expires.isoformat()
     empires_payload = {
-        "empires": empires_info["empires"]
+        "empires": uag._empires_payload(empires_info["empires"])
     }
     empires_response = REQUESTS_SESSION.patch(
         app.config['AZURE_FUNCTION_ENDPOINT'] + f'/empires',
         headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-        data=json.dumps(empires_info)
+        data=json.dumps(empires_payload)
     )
+    uag._memo_invalidate('/empires')
 
 @bp.route('/api/empire/<target_empire>/acceptsurrenderoffer', methods=['POST'])
 @flask_praetorian.auth_required
@@ -1465,28 +1469,22 @@ def universe_policies():
         valid_votes, message = _validate_cast_votes(kd_info, votes)
         if not valid_votes:
             return flask.jsonify({"message": message}), 400
-        
-        universe_politics = uag._get_universe_politics()
+        if option.removeprefix("option_") not in uas.UNIVERSE_POLICIES.get(policy, {}).get("options", {}):
+            return flask.jsonify({"message": "That is not a valid policy option"}), 400
 
         kd_patch_payload = {
             "votes": kd_info["votes"] - votes,
         }
 
-        try:
-            universe_politics["votes"][policy][option][kd_id] += votes
-        except KeyError:
-            universe_politics["votes"][policy][option][kd_id] = votes
-
         kd_patch_response = REQUESTS_SESSION.patch(
             app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}',
             headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
             data=json.dumps(kd_patch_payload)
         )
 
-        universe_politics_response = REQUESTS_SESSION.patch(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/universepolitics',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-            data=json.dumps(universe_politics)
+        uag._patch_item(
+            "universe_votes",
+            [{"op": "incr", "path": f"/votes/{policy}/{option}/{kd_id}", "value": votes}],
         )
     finally:
         uam.release_locks_by_id(request_id)
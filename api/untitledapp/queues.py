@@ -0,0 +1,88 @@
+import bisect
+import datetime
+import itertools
+import math
+
+
+def entry_time(entry):
+    return datetime.datetime.fromisoformat(entry["time"]).timestamp()
+
+def bucket_time(time, bucket_seconds):
+    """Round a datetime up to the next multiple of bucket_seconds, leaving it as is when bucket_seconds is 0"""
+    if not bucket_seconds:
+        return time
+    return datetime.datetime.fromtimestamp(
+        math.ceil(time.timestamp() / bucket_seconds) * bucket_seconds,
+        datetime.timezone.utc,
+    )
+
+
+class BuildQueue:
+    """Queue entries sorted by completion time, with their epoch seconds in a parallel list
+
+    Entries keep their isoformat "time" for display. Totals due before a time
+    are read from per-key prefix sums, so each horizon is one bisect.
+    """
+
+    def __init__(self, entries=(), times=None):
+        entries = list(entries)
+        if times is None or len(times) != len(entries):
+            # Written before queues were kept sorted, parse and sort once
+            pairs = sorted(
+                ((entry_time(entry), entry) for entry in entries),
+                key=lambda pair: pair[0],
+            )
+            entries = [entry for _, entry in pairs]
+            times = [time for time, _ in pairs]
+        self.entries = entries
+        self.times = list(times)
+        self._prefix = {}
+
+    @classmethod
+    def from_document(cls, document, key):
+        return cls(document.get(key, []), document.get("times"))
+
+    def to_document(self, key):
+        return {key: self.entries, "times": self.times}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def top(self, n):
+        return self.entries[:n]
+
+    def next_time(self):
+        return self.times[0] if self.times else None
+
+    def count_before(self, time):
+        return bisect.bisect_left(self.times, time)
+
+    def _prefix_sums(self, key):
+        if key not in self._prefix:
+            self._prefix[key] = [0] + list(itertools.accumulate(entry.get(key, 0) for entry in self.entries))
+        return self._prefix[key]
+
+    def totals_before(self, time, keys):
+        """Sum of each key over the entries completing strictly before time"""
+        i_end = self.count_before(time)
+        return {
+            key: self._prefix_sums(key)[i_end]
+            for key in keys
+        }
+
+    def pop_due(self, time):
+        """Split off the entries completing strictly before time. Returns (due entries, remaining queue)"""
+        i_end = self.count_before(time)
+        return self.entries[:i_end], BuildQueue(self.entries[i_end:], self.times[i_end:])
+
+
+def as_queue(entries, key=None):
+    """A BuildQueue from a queue, a queue document with key, or a list of entries"""
+    if isinstance(entries, BuildQueue):
+        return entries
+    if key is not None and isinstance(entries, dict):
+        return BuildQueue.from_document(entries, key)
+    return BuildQueue(entries)
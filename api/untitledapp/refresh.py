@@ -1,11 +1,15 @@
 
 import collections
+import concurrent.futures
+import copy
 import datetime
+import heapq
 import json
 import math
 import os
 import time
 import random
+import threading
 import uuid
 
 import flask
@@ -14,13 +18,40 @@ from flask_sock import Sock, ConnectionClosed
 
 import untitledapp.misc as uam
 import untitledapp.build as uab
+import untitledapp.events as uae
 import untitledapp.conquer as uac
 import untitledapp.getters as uag
+import untitledapp.income as uai
+import untitledapp.notify as uan
+import untitledapp.queues as uaq
 import untitledapp.shared as uas
-from untitledapp import db, User, REQUESTS_SESSION, SOCK_HANDLERS
+from untitledapp import db, User, REQUESTS_SESSION
 
 bp = flask.Blueprint("refresh", __name__)
 
+# A tick holds this lock while it runs, calls that arrive meanwhile are folded into it
+TICK_LOCK_NAME = '/refreshdata'
+TICK_LOCK_SECONDS = 600
+TICK_STATS_WINDOW = 256
+_TICK_STATS_LOCK = threading.Lock()
+_TICK_STATS = {
+    "ticks": 0,
+    "coalesced": 0,
+    "behind": 0,
+    "lag": collections.deque(maxlen=TICK_STATS_WINDOW),
+    "seconds": collections.deque(maxlen=TICK_STATS_WINDOW),
+}
+
+QUEUE_CATEGORIES = [
+    "settles",
+    "mobis",
+    "structures",
+    "missiles",
+    "engineers",
+    "revealed",
+    "shared",
+]
+
 def _calc_pop_change_per_epoch(
     kd_info_parse,
     fuelless: bool,
@@ -196,6 +227,22 @@ def _calc_networth(
         networth += (value_unit * uas.GAME_CONFIG["NETWORTH_VALUES"][key_unit])
     return networth
 
+def _complete_projects(new_kd_info):
+    for key_project in uas.ONE_TIME_PROJECTS:
+        if key_project not in new_kd_info["completed_projects"]:
+            if new_kd_info["projects_points"][key_project] >= new_kd_info["projects_max_points"][key_project]:
+                new_kd_info["completed_projects"].append(key_project)
+                new_kd_info["projects_assigned"][key_project] = 0
+                new_kd_info["projects_target"][key_project] = 0
+                uan.publish(new_kd_info["kdId"], {
+                    "message": f"Completed project {key_project}!",
+                    "status": "info",
+                    "category": "Projects",
+                    "delay": 15000,
+                    "update": [],
+                })
+    return new_kd_info
+
 def _kingdom_with_income(
     kd_info_parse,
     current_bonuses,
@@ -204,7 +251,13 @@ def _kingdom_with_income(
 ):
     time_last_income = datetime.datetime.fromisoformat(kd_info_parse["last_income"]).astimezone(datetime.timezone.utc)
     seconds_elapsed = (time_now - time_last_income).total_seconds()
+    if seconds_elapsed <= 0:
+        # Continuous income already settled this kingdom past the tick's time
+        return kd_info_parse
     epoch_elapsed = seconds_elapsed / uas.GAME_CONFIG["BASE_EPOCH_SECONDS"]
+    # Settling outside the tick moves last_income but leaves siphons for the tick
+    time_last_siphons = datetime.datetime.fromisoformat(kd_info_parse.get("last_siphons", kd_info_parse["last_income"])).astimezone(datetime.timezone.utc)
+    siphons_epoch_elapsed = max((time_now - time_last_siphons).total_seconds(), seconds_elapsed) / uas.GAME_CONFIG["BASE_EPOCH_SECONDS"]
 
     is_isolationist = "Isolationist" in state["state"]["active_policies"]
     is_free_trade = "Free Trade" in state["state"]["active_policies"]
@@ -224,10 +277,13 @@ def _kingdom_with_income(
         income["money"]["gross"],
         kd_info_parse["kdId"],
         time_now,
-        epoch_elapsed,
+        siphons_epoch_elapsed,
     )
     income["money"]["net"] = (income["money"]["gross"] + income["money"]["siphons_in"] - income["money"]["siphons_out"])
-    new_income = income["money"]["net"] * epoch_elapsed
+    new_income = (
+        income["money"]["gross"] * epoch_elapsed
+        + (income["money"]["siphons_in"] - income["money"]["siphons_out"]) * siphons_epoch_elapsed
+    )
 
     total_units = {
         k: v
@@ -285,23 +341,7 @@ def _kingdom_with_income(
     new_kd_info = kd_info_parse.copy()
     for key_project, new_points in new_project_points.items():
         new_kd_info["projects_points"][key_project] += new_points
-    for key_project in uas.ONE_TIME_PROJECTS:
-        if key_project not in kd_info_parse["completed_projects"]:
-            if new_kd_info["projects_points"][key_project] >= new_kd_info["projects_max_points"][key_project]:
-                new_kd_info["completed_projects"].append(key_project)
-                new_kd_info["projects_assigned"][key_project] = 0
-                new_kd_info["projects_target"][key_project] = 0
-                try:
-                    ws = SOCK_HANDLERS[kd_info_parse["kdId"]]
-                    ws.send(json.dumps({
-                        "message": f"Completed project {key_project}!",
-                        "status": "info",
-                        "category": "Projects",
-                        "delay": 15000,
-                        "update": [],
-                    }))
-                except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-                    pass
+    _complete_projects(new_kd_info)
 
     if new_kd_info["auto_spending_enabled"]:
         pct_allocated = sum(new_kd_info["auto_spending"].values())
@@ -314,6 +354,7 @@ def _kingdom_with_income(
     new_kd_info["drones"] += new_drones
     new_kd_info["population"] = new_kd_info["population"] + pop_change
     new_kd_info["last_income"] = time_now.isoformat()
+    new_kd_info["last_siphons"] = time_now.isoformat()
     new_kd_info["income"] = income
     new_kd_info["networth"] = math.floor(_calc_networth(
         new_kd_info,
@@ -337,346 +378,173 @@ def _kingdom_with_income(
 
     return new_kd_info
     
-def _resolve_settles(kd_id, time_update):
-    app = flask.current_app
-    while not uam.acquire_lock(f'/kingdom/{kd_id}/settles', timeout=999):
-        time.sleep(0.01)
-    try:
-        settle_info = REQUESTS_SESSION.get(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/settles',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-        )
-        settle_info_parse = json.loads(settle_info.text)
-
-        ready_settles = 0
-        keep_settles = []
-        next_resolve = datetime.datetime(year=2099, month=1, day=1).astimezone(datetime.timezone.utc)
-        for settle in settle_info_parse["settles"]:
-            time = datetime.datetime.fromisoformat(settle["time"]).astimezone(datetime.timezone.utc)
-            if time < time_update:
-                ready_settles += settle['amount']
-            else:
-                if time < next_resolve:
-                    next_resolve = time
-                keep_settles.append(settle)
-        
-        settles_payload = {
-            "settles": keep_settles
-        }
-        settles_patch = REQUESTS_SESSION.patch(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/settles',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-            data=json.dumps(settles_payload),
-        )
-        if ready_settles:
-            try:
-                ws = SOCK_HANDLERS[kd_id]
-                ws.send(json.dumps({
-                    "message": f"Finished settling {ready_settles} stars",
-                    "status": "info",
-                    "category": "Settles",
-                    "delay": 5000,
-                    "update": [],
-                }))
-            except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-                pass
-    finally:
-        uam.release_lock(f'/kingdom/{kd_id}/settles')
+def _queue_next_resolve(queue):
+    next_time = queue.next_time()
+    if next_time is None:
+        return datetime.datetime(year=2099, month=1, day=1).astimezone(datetime.timezone.utc)
+    return datetime.datetime.fromtimestamp(next_time, datetime.timezone.utc)
+
+def _resolve_settles(kd_id, settle_info_parse, time_update):
+    settles_queue = uaq.BuildQueue.from_document(settle_info_parse, "settles")
+    due_settles, keep_settles = settles_queue.pop_due(time_update.timestamp())
+    ready_settles = sum(settle['amount'] for settle in due_settles)
+    next_resolve = _queue_next_resolve(keep_settles)
     
-    return ready_settles, next_resolve
+    settles_payload = keep_settles.to_document("settles")
+    if ready_settles:
+        uan.publish(kd_id, {
+            "message": f"Finished settling {ready_settles} stars",
+            "status": "info",
+            "category": "Settles",
+            "delay": 5000,
+            "update": [],
+        })
     
-def _resolve_mobis(kd_id, time_update):
-    app = flask.current_app
-    while not uam.acquire_lock(f'/kingdom/{kd_id}/mobis', timeout=999):
-        time.sleep(0.01)
-    try:
-        mobis_info = REQUESTS_SESSION.get(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/mobis',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-        )
-        mobis_info_parse = json.loads(mobis_info.text)
-
-        ready_mobis = collections.defaultdict(int)
-        keep_mobis = []
-        next_resolve = datetime.datetime(year=2099, month=1, day=1).astimezone(datetime.timezone.utc)
-        for mobi in mobis_info_parse["mobis"]:
-            time = datetime.datetime.fromisoformat(mobi["time"]).astimezone(datetime.timezone.utc)
-            if time < time_update:
-                mobi.pop("time")
-                for key_unit, amt_unit in mobi.items():
-                    ready_mobis[key_unit] += amt_unit
-            else:
-                next_resolve = min(time, next_resolve)
-                keep_mobis.append(mobi)
-        
-        
-        
-        mobis_payload = {
-            "mobis": keep_mobis
-        }
-        mobis_patch = REQUESTS_SESSION.patch(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/mobis',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-            data=json.dumps(mobis_payload),
-        )
-        try:
-            ws = SOCK_HANDLERS[kd_id]
-            count_mobis = sum(ready_mobis.values())
-            if count_mobis:
-                ws.send(json.dumps({
-                    "message": f"Finished mobilizing {count_mobis} units",
-                    "status": "info",
-                    "category": "Mobis",
-                    "delay": 5000,
-                    "update": [],
-                }))
-        except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-            pass
-    finally:
-        uam.release_lock(f'/kingdom/{kd_id}/mobis')
+    return ready_settles, next_resolve, settles_payload
     
-    return ready_mobis, next_resolve
+def _resolve_mobis(kd_id, mobis_info_parse, time_update):
+    mobis_queue = uaq.BuildQueue.from_document(mobis_info_parse, "mobis")
+    due_mobis, keep_mobis = mobis_queue.pop_due(time_update.timestamp())
+    ready_mobis = collections.defaultdict(int)
+    for mobi in due_mobis:
+        for key_unit, amt_unit in mobi.items():
+            if key_unit != "time":
+                ready_mobis[key_unit] += amt_unit
+    next_resolve = _queue_next_resolve(keep_mobis)
     
-def _resolve_structures(kd_id, time_update):
-    app = flask.current_app
-    while not uam.acquire_lock(f'/kingdom/{kd_id}/structures', timeout=999):
-        time.sleep(0.01)
-    try:
-        structures_info = REQUESTS_SESSION.get(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/structures',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-        )
-        structures_info_parse = json.loads(structures_info.text)
-
-        ready_structures = collections.defaultdict(int)
-        keep_structures = []
-        next_resolve = datetime.datetime(year=2099, month=1, day=1).astimezone(datetime.timezone.utc)
-        for structure in structures_info_parse["structures"]:
-            time = datetime.datetime.fromisoformat(structure["time"]).astimezone(datetime.timezone.utc)
-            if time < time_update:
-                structure.pop("time")
-                for key_structure, amt_structure in structure.items():
-                    ready_structures[key_structure] += amt_structure
-            else:
-                next_resolve = min(time, next_resolve)
-                keep_structures.append(structure)
-        
-        
-        
-        structures_payload = {
-            "structures": keep_structures
-        }
-        structures_patch = REQUESTS_SESSION.patch(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/structures',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-            data=json.dumps(structures_payload),
-        )
-        try:
-            ws = SOCK_HANDLERS[kd_id]
-            count_structures = sum(ready_structures.values())
-            if count_structures:
-                ws.send(json.dumps({
-                    "message": f"Finished building {count_structures} structures",
-                    "status": "info",
-                    "category": "Structures",
-                    "delay": 5000,
-                    "update": [],
-                }))
-        except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-            pass
-    finally:
-        uam.release_lock(f'/kingdom/{kd_id}/structures')
+    mobis_payload = keep_mobis.to_document("mobis")
+    count_mobis = sum(ready_mobis.values())
+    if count_mobis:
+        uan.publish(kd_id, {
+            "message": f"Finished mobilizing {count_mobis} units",
+            "status": "info",
+            "category": "Mobis",
+            "delay": 5000,
+            "update": [],
+        })
     
-    return ready_structures, next_resolve
+    return ready_mobis, next_resolve, mobis_payload
     
-def _resolve_missiles(kd_id, time_update):
-    app = flask.current_app
-    while not uam.acquire_lock(f'/kingdom/{kd_id}/missiles', timeout=999):
-        time.sleep(0.01)
-    try:
-        missiles_info = REQUESTS_SESSION.get(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/missiles',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-        )
-        missiles_info_parse = json.loads(missiles_info.text)
-
-        ready_missiles = collections.defaultdict(int)
-        keep_missiles = []
-        next_resolve = datetime.datetime(year=2099, month=1, day=1).astimezone(datetime.timezone.utc)
-        for missile in missiles_info_parse["missiles"]:
-            time = datetime.datetime.fromisoformat(missile["time"]).astimezone(datetime.timezone.utc)
-            if time < time_update:
-                missile.pop("time")
-                for key_missile, amt_missile in missile.items():
-                    ready_missiles[key_missile] += amt_missile
-            else:
-                next_resolve = min(time, next_resolve)
-                keep_missiles.append(missile)
-        
-        missiles_payload = {
-            "missiles": keep_missiles
-        }
-        missiles_patch = REQUESTS_SESSION.patch(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/missiles',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-            data=json.dumps(missiles_payload),
-        )
-        try:
-            ws = SOCK_HANDLERS[kd_id]
-            count_missiles = sum(ready_missiles.values())
-            if count_missiles:
-                ws.send(json.dumps({
-                    "message": f"Finished building {count_missiles} missiles",
-                    "status": "info",
-                    "category": "Missiles",
-                    "delay": 5000,
-                    "update": [],
-                }))
-        except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-            pass
-    finally:
-        uam.release_lock(f'/kingdom/{kd_id}/missiles')
+def _resolve_structures(kd_id, structures_info_parse, time_update):
+    structures_queue = uaq.BuildQueue.from_document(structures_info_parse, "structures")
+    due_structures, keep_structures = structures_queue.pop_due(time_update.timestamp())
+    ready_structures = collections.defaultdict(int)
+    for structure in due_structures:
+        for key_structure, amt_structure in structure.items():
+            if key_structure != "time":
+                ready_structures[key_structure] += amt_structure
+    next_resolve = _queue_next_resolve(keep_structures)
     
-    return ready_missiles, next_resolve
+    structures_payload = keep_structures.to_document("structures")
+    count_structures = sum(ready_structures.values())
+    if count_structures:
+        uan.publish(kd_id, {
+            "message": f"Finished building {count_structures} structures",
+            "status": "info",
+            "category": "Structures",
+            "delay": 5000,
+            "update": [],
+        })
     
-def _resolve_engineers(kd_id, time_update):
-    app = flask.current_app
-    while not uam.acquire_lock(f'/kingdom/{kd_id}/engineers', timeout=999):
-        time.sleep(0.01)
-    try:
-        engineer_info = REQUESTS_SESSION.get(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/engineers',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-        )
-        engineer_info_parse = json.loads(engineer_info.text)
-
-        ready_engineers = 0
-        keep_engineers = []
-        next_resolve = datetime.datetime(year=2099, month=1, day=1).astimezone(datetime.timezone.utc)
-        for engineer in engineer_info_parse["engineers"]:
-            time = datetime.datetime.fromisoformat(engineer["time"]).astimezone(datetime.timezone.utc)
-            if time < time_update:
-                ready_engineers += engineer['amount']
-            else:
-                if time < next_resolve:
-                    next_resolve = time
-                keep_engineers.append(engineer)
-        
-        engineers_payload = {
-            "engineers": keep_engineers
-        }
-        engineers_patch = REQUESTS_SESSION.patch(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/engineers',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-            data=json.dumps(engineers_payload),
-        )
-        if ready_engineers:
-            try:
-                ws = SOCK_HANDLERS[kd_id]
-                ws.send(json.dumps({
-                    "message": f"Finished training {ready_engineers} engineers",
-                    "status": "info",
-                    "category": "Engineers",
-                    "delay": 5000,
-                    "update": [],
-                }))
-            except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-                pass
-    finally:
-        uam.release_lock(f'/kingdom/{kd_id}/engineers')
+    return ready_structures, next_resolve, structures_payload
     
-    return ready_engineers, next_resolve
+def _resolve_missiles(kd_id, missiles_info_parse, time_update):
+    missiles_queue = uaq.BuildQueue.from_document(missiles_info_parse, "missiles")
+    due_missiles, keep_missiles = missiles_queue.pop_due(time_update.timestamp())
+    ready_missiles = collections.defaultdict(int)
+    for missile in due_missiles:
+        for key_missile, amt_missile in missile.items():
+            if key_missile != "time":
+                ready_missiles[key_missile] += amt_missile
+    next_resolve = _queue_next_resolve(keep_missiles)
     
-def _resolve_revealed(kd_id, time_update):
-    app = flask.current_app
-    while not uam.acquire_lock(f'/kingdom/{kd_id}/revealed', timeout=999):
-        time.sleep(0.01)
-    try:
-        revealed_info = REQUESTS_SESSION.get(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/revealed',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-        )
-        revealed_info_parse = json.loads(revealed_info.text)
-
-        keep_revealed = collections.defaultdict(dict)
-        keep_galaxies = {}
-        next_resolve = datetime.datetime(year=2099, month=1, day=1).astimezone(datetime.timezone.utc)
-
-        for revealed_kd_id, revealed_dict in revealed_info_parse["revealed"].items():
-            for revealed_stat, time_str in revealed_dict.items():
-                time = datetime.datetime.fromisoformat(time_str).astimezone(datetime.timezone.utc)
-                if time > time_update:
-                    next_resolve = min(time, next_resolve)
-                    keep_revealed[revealed_kd_id][revealed_stat] = time_str
+    missiles_payload = keep_missiles.to_document("missiles")
+    count_missiles = sum(ready_missiles.values())
+    if count_missiles:
+        uan.publish(kd_id, {
+            "message": f"Finished building {count_missiles} missiles",
+            "status": "info",
+            "category": "Missiles",
+            "delay": 5000,
+            "update": [],
+        })
+    
+    return ready_missiles, next_resolve, missiles_payload
+    
+def _resolve_engineers(kd_id, engineer_info_parse, time_update):
+    engineers_queue = uaq.BuildQueue.from_document(engineer_info_parse, "engineers")
+    due_engineers, keep_engineers = engineers_queue.pop_due(time_update.timestamp())
+    ready_engineers = sum(engineer['amount'] for engineer in due_engineers)
+    next_resolve = _queue_next_resolve(keep_engineers)
+    
+    engineers_payload = keep_engineers.to_document("engineers")
+    if ready_engineers:
+        uan.publish(kd_id, {
+            "message": f"Finished training {ready_engineers} engineers",
+            "status": "info",
+            "category": "Engineers",
+            "delay": 5000,
+            "update": [],
+        })
+    
+    return ready_engineers, next_resolve, engineers_payload
+    
+def _resolve_revealed(kd_id, revealed_info_parse, time_update):
+    keep_revealed = collections.defaultdict(dict)
+    keep_galaxies = {}
+    next_resolve = datetime.datetime(year=2099, month=1, day=1).astimezone(datetime.timezone.utc)
 
-        for galaxy_id, time_str in revealed_info_parse["galaxies"].items():
+    for revealed_kd_id, revealed_dict in revealed_info_parse["revealed"].items():
+        for revealed_stat, time_str in revealed_dict.items():
             time = datetime.datetime.fromisoformat(time_str).astimezone(datetime.timezone.utc)
             if time > time_update:
-                keep_galaxies[galaxy_id] = time_str
                 next_resolve = min(time, next_resolve)
+                keep_revealed[revealed_kd_id][revealed_stat] = time_str
 
-        revealed_payload = {
-            "revealed": keep_revealed,
-            "galaxies": keep_galaxies,
-        }
-        revealed_patch = REQUESTS_SESSION.patch(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/revealed',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-            data=json.dumps(revealed_payload),
-        )
-    finally:
-        uam.release_lock(f'/kingdom/{kd_id}/revealed')
+    for galaxy_id, time_str in revealed_info_parse["galaxies"].items():
+        time = datetime.datetime.fromisoformat(time_str).astimezone(datetime.timezone.utc)
+        if time > time_update:
+            keep_galaxies[galaxy_id] = time_str
+            next_resolve = min(time, next_resolve)
+
+    revealed_payload = {
+        "revealed": keep_revealed,
+        "galaxies": keep_galaxies,
+    }
     
-    return next_resolve
+    return next_resolve, revealed_payload
     
-def _resolve_shared(kd_id, time_update):
-    app = flask.current_app
-    while not uam.acquire_lock(f'/kingdom/{kd_id}/shared', timeout=999):
-        time.sleep(0.01)
-    try:
-        shared_info = REQUESTS_SESSION.get(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/shared',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']}
-        )
-        shared_info_parse = json.loads(shared_info.text)
-
-        keep_shared = collections.defaultdict(dict)
-        keep_shared_requests = collections.defaultdict(dict)
-        keep_shared_offers = collections.defaultdict(dict)
-        next_resolve = datetime.datetime(year=2099, month=1, day=1).astimezone(datetime.timezone.utc)
+def _resolve_shared(kd_id, shared_info_parse, time_update):
+    keep_shared = collections.defaultdict(dict)
+    keep_shared_requests = collections.defaultdict(dict)
+    keep_shared_offers = collections.defaultdict(dict)
+    next_resolve = datetime.datetime(year=2099, month=1, day=1).astimezone(datetime.timezone.utc)
 
-        for shared_kd_id, shared_dict in shared_info_parse["shared"].items():
-            time = datetime.datetime.fromisoformat(shared_dict["time"]).astimezone(datetime.timezone.utc)
-            if time > time_update:
-                next_resolve = min(time, next_resolve)
-                keep_shared[shared_kd_id] = shared_dict
+    for shared_kd_id, shared_dict in shared_info_parse["shared"].items():
+        time = datetime.datetime.fromisoformat(shared_dict["time"]).astimezone(datetime.timezone.utc)
+        if time > time_update:
+            next_resolve = min(time, next_resolve)
+            keep_shared[shared_kd_id] = shared_dict
 
-        for shared_kd_id, shared_dict in shared_info_parse["shared_requests"].items():
-            time = datetime.datetime.fromisoformat(shared_dict["time"]).astimezone(datetime.timezone.utc)
-            if time > time_update:
-                next_resolve = min(time, next_resolve)
-                keep_shared_requests[shared_kd_id] = shared_dict
+    for shared_kd_id, shared_dict in shared_info_parse["shared_requests"].items():
+        time = datetime.datetime.fromisoformat(shared_dict["time"]).astimezone(datetime.timezone.utc)
+        if time > time_update:
+            next_resolve = min(time, next_resolve)
+            keep_shared_requests[shared_kd_id] = shared_dict
 
-        for shared_kd_id, shared_dict in shared_info_parse["shared_offers"].items():
-            time = datetime.datetime.fromisoformat(shared_dict["time"]).astimezone(datetime.timezone.utc)
-            if time > time_update:
-                next_resolve = min(time, next_resolve)
-                keep_shared_offers[shared_kd_id] = shared_dict
+    for shared_kd_id, shared_dict in shared_info_parse["shared_offers"].items():
+        time = datetime.datetime.fromisoformat(shared_dict["time"]).astimezone(datetime.timezone.utc)
+        if time > time_update:
+            next_resolve = min(time, next_resolve)
+            keep_shared_offers[shared_kd_id] = shared_dict
 
-        shared_payload = {
-            "shared": keep_shared,
-            "shared_requests": keep_shared_requests,
-            "shared_offers": keep_shared_offers,
-        }
-        shared_post = REQUESTS_SESSION.post(
-            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}/shared',
-            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-            data=json.dumps(shared_payload),
-        )
-    finally:
-        uam.release_lock(f'/kingdom/{kd_id}/shared')
+    shared_payload = {
+        "shared": keep_shared,
+        "shared_requests": keep_shared_requests,
+        "shared_offers": keep_shared_offers,
+    }
     
-    return next_resolve
+    return next_resolve, shared_payload
 
 def _resolve_generals(kd_info_parse, time_update):
     generals_keep = []
@@ -701,19 +569,15 @@ def _resolve_generals(kd_info_parse, time_update):
 
     kd_info_parse["generals_out"] = generals_keep
     
-    try:
-        ws = SOCK_HANDLERS[kd_info_parse["kdId"]]
-        count_returning_units = sum(returning_units.values())
-        if count_returning_units:
-            ws.send(json.dumps({
-                "message": f"{returning_generals} generals returned with {count_returning_units} units",
-                "status": "info",
-                "category": "Generals",
-                "delay": 15000,
-                "update": [],
-            }))
-    except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-        pass
+    count_returning_units = sum(returning_units.values())
+    if count_returning_units:
+        uan.publish(kd_info_parse["kdId"], {
+            "message": f"{returning_generals} generals returned with {count_returning_units} units",
+            "status": "info",
+            "category": "Generals",
+            "delay": 15000,
+            "update": [],
+        })
     return kd_info_parse, next_resolve
 
 
@@ -730,17 +594,13 @@ def _resolve_spy(kd_info_parse, time_update, current_bonuses):
     )
     if kd_info_parse["spy_attempts"] < uas.GAME_CONFIG["BASE_SPY_ATTEMPTS_MAX"]:
         kd_info_parse["spy_attempts"] += 1
-        try:
-            ws = SOCK_HANDLERS[kd_info_parse["kdId"]]
-            ws.send(json.dumps({
-                "message": f"A new spy attempt is available",
-                "status": "info",
-                "category": "Spy",
-                "delay": 15000,
-                "update": [],
-            }))
-        except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-            pass
+        uan.publish(kd_info_parse["kdId"], {
+            "message": f"A new spy attempt is available",
+            "status": "info",
+            "category": "Spy",
+            "delay": 15000,
+            "update": [],
+        })
     return kd_info_parse, next_resolve_time
 
 
@@ -1024,17 +884,13 @@ def _resolve_auto_attack(kd_info_parse):
                     value_unit,
                 )
     kd_info_parse, payload, _ = uac._attack_primitives(req, kd_info_parse["kdId"])
-    try:
-        ws = SOCK_HANDLERS[kd_info_parse["kdId"]]
-        ws.send(json.dumps({
-            "message": payload["message"],
-            "status": payload.get("status", "info"),
-            "category": "Auto Primitives",
-            "delay": 15000,
-            "update": ["mobis", "attackhistory"],
-        }))
-    except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-        pass
+    uan.publish(kd_info_parse["kdId"], {
+        "message": payload["message"],
+        "status": payload.get("status", "info"),
+        "category": "Auto Primitives",
+        "delay": 15000,
+        "update": ["mobis", "attackhistory"],
+    })
     return None
 
 def _resolve_auto_rob(kd_info_parse):
@@ -1048,17 +904,13 @@ def _resolve_auto_rob(kd_info_parse):
             "shielded": shielded,
         }
         kd_info_parse, payload, _ = uac._rob_primitives(req, kd_info_parse["kdId"])
-        try:
-            ws = SOCK_HANDLERS[kd_info_parse["kdId"]]
-            ws.send(json.dumps({
-                "message": payload["message"],
-                "status": payload.get("status", "info"),
-                "category": "Auto Primitives",
-                "delay": 15000,
-                "update": ["spyhistory"],
-            }))
-        except (KeyError, ConnectionError, StopIteration, ConnectionClosed):
-            pass
+        uan.publish(kd_info_parse["kdId"], {
+            "message": payload["message"],
+            "status": payload.get("status", "info"),
+            "category": "Auto Primitives",
+            "delay": 15000,
+            "update": ["spyhistory"],
+        })
     return None
 
 def _resolve_auto_projects(kd_info_parse):
@@ -1290,7 +1142,7 @@ def _resolve_schedule_missiles(new_kd_info, schedule):
 def _resolve_schedules(kd_id, time_update):
 
     app = flask.current_app
-    while not uam.acquire_lock(f'/kingdom/{kd_id}', timeout=999):
+    while not uam.acquire_lock(f'/kingdom/{kd_id}', timeout=999, wait=10):
         time.sleep(0.01)
     
     try:
@@ -1367,13 +1219,14 @@ def _begin_election(state):
             headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
             data=json.dumps(state_payload)
         )
+        uag._memo_invalidate('/state')
     finally:
         uam.release_locks_by_id(request_id)
     return state
 
 def _resolve_election(state):
     app = flask.current_app
-    while not uam.acquire_lock(f'/updatestate', timeout=999):
+    while not uam.acquire_lock(f'/updatestate', timeout=999, wait=10):
         time.sleep(0.01)
     try:
         election_end = datetime.datetime.fromisoformat(state["state"]["election_end"]).astimezone(datetime.timezone.utc)
@@ -1410,14 +1263,26 @@ def _resolve_election(state):
             headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
             data=json.dumps(state_payload)
         )
+        uag._memo_invalidate('/state')
     finally:
         uam.release_lock(f'/updatestate')
     return state
 
+def _networth_winners(networth, count):
+    """The count highest networth kingdoms, ties broken by id like the leaderboard
+
+    Picked from this tick's scores rather than the shared LEADERBOARD, which
+    /api/scores may re-sync to an older scores document between calls.
+    """
+    return [
+        kd_id
+        for kd_id, _ in heapq.nsmallest(count, networth.items(), key=lambda item: (-item[1], item[0]))
+    ]
+
 def _resolve_scores(kd_scores, time_update):
 
     app = flask.current_app
-    while not uam.acquire_lock(f'/scores', timeout=999):
+    while not uam.acquire_lock(f'/scores', timeout=999, wait=10):
         time.sleep(0.01)
     try:
         scores = uag._get_scores()
@@ -1432,10 +1297,7 @@ def _resolve_scores(kd_scores, time_update):
         
         new_scores["last_update"] = time_update.isoformat()
 
-        top_kds = sorted(
-            new_scores["networth"],
-            key=lambda x: -new_scores["networth"][x]
-        )[:len(uas.GAME_CONFIG["NETWORTH_POINTS"])]
+        top_kds = _networth_winners(new_scores["networth"], len(uas.GAME_CONFIG["NETWORTH_POINTS"]))
         for i_points, kd_scoring in enumerate(top_kds):
             points_value = uas.GAME_CONFIG["NETWORTH_POINTS"][i_points]
             epoch_points = epoch_elapsed * points_value
@@ -1463,21 +1325,15 @@ def _update_history(
     time_update,
 ):
     app = flask.current_app
-    while not uam.acquire_lock(f'/kingdom/{kd_info["kdId"]}/history', timeout=999):
+    while not uam.acquire_lock(f'/kingdom/{kd_info["kdId"]}/history', timeout=999, wait=10):
         time.sleep(0.01)
     try:
         history_payload = {}
 
         basic_kd_info_keys = ["networth", "stars", "drones", "population"]
         for key_info in basic_kd_info_keys:
-            history_payload[key_info] = {
-                "time": time_update.isoformat(),
-                "value": kd_info[key_info],
-            }
-        history_payload["engineers"] = {
-            "time": time_update.isoformat(),
-            "value": kd_info["units"]["engineers"],
-        }
+            history_payload[key_info] = kd_info[key_info]
+        history_payload["engineers"] = kd_info["units"]["engineers"]
         
         total_units = kd_info["units"].copy()
         total_general_units = {
@@ -1494,92 +1350,88 @@ def _update_history(
         offense = uag._calc_max_offense(total_units)
         defense = uag._calc_max_defense(total_units)
 
-        history_payload["max_offense"] = {
-            "time": time_update.isoformat(),
-            "value": offense,
-        }
-        history_payload["max_defense"] = {
-            "time": time_update.isoformat(),
-            "value": defense,
-        }
+        history_payload["max_offense"] = offense
+        history_payload["max_defense"] = defense
         update_response = REQUESTS_SESSION.patch(
             app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_info["kdId"]}/history',
             headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-            data=json.dumps({"history": history_payload})
+            data=json.dumps({"time": time_update.isoformat(), "values": history_payload})
         )
     finally:
         uam.release_lock(f'/kingdom/{kd_info["kdId"]}/history')
     return None
 
+def _resolve_empire(empire_info, empires_info, empire_id, num_kingdoms, aggression, time_update):
+    """Update one empire's entry in place, returning the empires it newly declared war on"""
+    empire_info["num_kingdoms"] = num_kingdoms
+    empire_info["aggression_max"] = num_kingdoms * uas.GAME_CONFIG["AGGRO_METER_PER_KD"]
+
+    if empire_info["denounced"]:
+        denounce_expiration = datetime.datetime.fromisoformat(empire_info["denounced_expires"]).astimezone(datetime.timezone.utc)
+        if denounce_expiration < time_update:
+            empire_info["denounced"] = ""
+            empire_info["denounced_expires"] = ""
+
+    if empire_info["surprise_war_penalty"]:
+        denounce_expiration = datetime.datetime.fromisoformat(empire_info["surprise_war_penalty_expires"]).astimezone(datetime.timezone.utc)
+        if denounce_expiration < time_update:
+            empire_info["surprise_war_penalty"] = False
+            empire_info["surprise_war_penalty_expires"] = ""
+
+    empire_info["peace"] = {
+        other_empire_id: peace_expiration
+        for other_empire_id, peace_expiration in empire_info["peace"].items()
+        if datetime.datetime.fromisoformat(peace_expiration).astimezone(datetime.timezone.utc) > time_update
+    }
+
+    new_wars = []
+    for other_empire_id, aggression_meter in aggression.items():
+        if aggression_meter > empire_info["aggression_max"]:
+            if other_empire_id not in empire_info["war"]:
+                empire_info["war"].append(other_empire_id)
+                empires_info["empires"][other_empire_id]["war"].append(empire_id)
+                new_wars.append(other_empire_id)
+    return new_wars
+
 def _resolve_empires(
     kd_scores,
     time_update,
 ):
+    """Update empire status under the /empires lock, then decay each empire's aggression
+
+    Aggression is kept per empire and decayed with an atomic backend operation, so
+    attacks and spy ops adding aggression do not wait on the /empires lock. It is
+    read before taking the lock, which then only covers the empires document.
+    """
     app = flask.current_app
-    while not uam.acquire_lock(f'/empires', timeout=999):
+    empire_aggression = uag._get_empire_aggression(uag._memo_get('/empires')["empires"].keys())
+    while not uam.acquire_lock(f'/empires', timeout=999, wait=10):
         time.sleep(0.01)
     try:
-        empires_inverted, empires_info, _, _ = uag._get_empires_inverted()
+        empires_info = uag._memo_get('/empires')
+        galaxy_info = uag._get_galaxy_info()
         time_last_update = datetime.datetime.fromisoformat(empires_info["last_update"]).astimezone(datetime.timezone.utc)
         seconds_elapsed = (time_update - time_last_update).total_seconds()
         epoch_elapsed = seconds_elapsed / uas.GAME_CONFIG["BASE_EPOCH_SECONDS"]
 
-        kd_counts = collections.defaultdict(int)
-        for kd_id in kd_scores["networth"].keys():
-            kd_empire = empires_inverted.get(kd_id)
-            if kd_empire:
-                kd_counts[kd_empire] += 1
-        
-        for empire_id in empires_info["empires"].keys():
-            empires_info["empires"][empire_id]["num_kingdoms"] = kd_counts.get(empire_id, 0)
-            empires_info["empires"][empire_id]["aggression_max"] = empires_info["empires"][empire_id]["num_kingdoms"] * uas.GAME_CONFIG["AGGRO_METER_PER_KD"]
-
-            decay_per_epoch = empires_info["empires"][empire_id]["num_kingdoms"] * uas.GAME_CONFIG["AGGRO_METER_DECAY_PER_KD_PER_EPOCH"]
-            decay = decay_per_epoch * epoch_elapsed
-
-            if empires_info["empires"][empire_id]["denounced"]:
-                denounce_expiration = datetime.datetime.fromisoformat(empires_info["empires"][empire_id]["denounced_expires"]).astimezone(datetime.timezone.utc)
-                if denounce_expiration < time_update:
-                    empires_info["empires"][empire_id]["denounced"] = ""
-                    empires_info["empires"][empire_id]["denounced_expires"] = ""
-
-            if empires_info["empires"][empire_id]["surprise_war_penalty"]:
-                denounce_expiration = datetime.datetime.fromisoformat(empires_info["empires"][empire_id]["surprise_war_penalty_expires"]).astimezone(datetime.timezone.utc)
-                if denounce_expiration < time_update:
-                    empires_info["empires"][empire_id]["surprise_war_penalty"] = False
-                    empires_info["empires"][empire_id]["surprise_war_penalty_expires"] = ""
-
-            new_peace = {
-                empire_id: peace_expiration
-                for empire_id, peace_expiration in empires_info["empires"][empire_id]["peace"].items()
-                if datetime.datetime.fromisoformat(peace_expiration).astimezone(datetime.timezone.utc) > time_update
-            }
-            empires_info["empires"][empire_id]["peace"] = new_peace
-
-            for other_empire_id, aggression_meter in empires_info["empires"][empire_id]["aggression"].items():
-                if aggression_meter > empires_info["empires"][empire_id]["aggression_max"]:
-                    if other_empire_id not in empires_info["empires"][empire_id]["war"]:
-                        empires_info["empires"][empire_id]["war"].append(other_empire_id)
-                        empires_info["empires"][other_empire_id]["war"].append(empire_id)
-
-                        news_payload = {
-                            "news": {
-                                "time": time_update.isoformat(),
-                                "news": f"{empires_info['empires'][empire_id]['name']} declared war by aggression on {empires_info['empires'][other_empire_id]['name']}",
-                            }
-                        }
-                        universe_news_update_response = REQUESTS_SESSION.patch(
-                            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/universenews',
-                            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
-                            data=json.dumps(news_payload)
-                        )
-            for other_empire_id in empires_info["empires"][empire_id]["aggression"]:
-                empires_info["empires"][empire_id]["aggression"][other_empire_id] = max(
-                    empires_info["empires"][empire_id]["aggression"][other_empire_id] - decay,
-                    0,
-                )
+        empire_wars = {}
+        for empire_id, empire_info in empires_info["empires"].items():
+            num_kingdoms = sum(
+                kd_id in kd_scores["networth"]
+                for galaxy in empire_info["galaxies"]
+                for kd_id in galaxy_info[galaxy]
+            )
+            empire_wars[empire_id] = _resolve_empire(
+                empire_info,
+                empires_info,
+                empire_id,
+                num_kingdoms,
+                empire_aggression.get(empire_id, {}),
+                time_update,
+            )
+
         empires_payload = {
-            "empires": empires_info["empires"],
+            "empires": uag._empires_payload(empires_info["empires"]),
             "last_update": time_update.isoformat(),
         }
 
@@ -1588,9 +1440,31 @@ def _resolve_empires(
             headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
             data=json.dumps(empires_payload)
         )
+        uag._memo_invalidate('/empires')
     finally:
         uam.release_lock(f'/empires')
 
+    for empire_id, new_wars in empire_wars.items():
+        for other_empire_id in new_wars:
+            news_payload = {
+                "news": {
+                    "time": time_update.isoformat(),
+                    "news": f"{empires_info['empires'][empire_id]['name']} declared war by aggression on {empires_info['empires'][other_empire_id]['name']}",
+                }
+            }
+            universe_news_update_response = REQUESTS_SESSION.patch(
+                app.config['AZURE_FUNCTION_ENDPOINT'] + f'/universenews',
+                headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
+                data=json.dumps(news_payload)
+            )
+
+        decay_per_epoch = empires_info["empires"][empire_id]["num_kingdoms"] * uas.GAME_CONFIG["AGGRO_METER_DECAY_PER_KD_PER_EPOCH"]
+        uam._update_aggression(
+            empire_id,
+            decay=decay_per_epoch * epoch_elapsed,
+            last_update=time_update.isoformat(),
+        )
+
 def _refresh_kd(kd_id, state, time_update, update_history):
     app = flask.current_app
     try:
@@ -1602,9 +1476,10 @@ def _refresh_kd(kd_id, state, time_update, update_history):
         print(f"Could not query kd_id {kd_id}")
         pass
 
-    while not uam.acquire_lock(f'/kingdom/{kd_id}', timeout=999):
+    while not uam.acquire_lock(f'/kingdom/{kd_id}', timeout=999, wait=10, settle=False):
         time.sleep(0.01)
 
+    queue_request_id = str(uuid.uuid4())
     try:
         next_resolves = {}
         kd_info = REQUESTS_SESSION.get(
@@ -1614,6 +1489,7 @@ def _refresh_kd(kd_id, state, time_update, update_history):
         kd_info_parse = json.loads(kd_info.text)
         if kd_info_parse["status"].lower() == "dead":
             return (0, 0)
+        old_kd_info = copy.deepcopy(kd_info_parse)
         current_bonuses = {
             project: project_dict.get("max_bonus", 0) * min(kd_info_parse["projects_points"][project] / kd_info_parse["projects_max_points"][project], 1.0)
             for project, project_dict in uas.PROJECTS.items()
@@ -1621,9 +1497,18 @@ def _refresh_kd(kd_id, state, time_update, update_history):
         }
 
         categories_to_resolve = [cat for cat, time in kd_info_parse["next_resolve"].items() if datetime.datetime.fromisoformat(time).astimezone(datetime.timezone.utc) < time_update]
+        queues_to_resolve = sorted(set(categories_to_resolve) & set(QUEUE_CATEGORIES))
+        queue_locks = [f'/kingdom/{kd_id}/{category}' for category in queues_to_resolve]
+        if queue_locks:
+            while not uam.acquire_locks(queue_locks, timeout=10, lock_timeout=999, request_id=queue_request_id):
+                time.sleep(0.01)
+        queue_infos = uag._batch_read([f"{category}_{kd_id}" for category in queues_to_resolve])
+        batch_patches = {}
+
         if "settles" in categories_to_resolve:
-            new_stars, next_resolves["settles"] = _resolve_settles(
+            new_stars, next_resolves["settles"], batch_patches[f"settles_{kd_id}"] = _resolve_settles(
                 kd_id,
+                queue_infos[f"settles_{kd_id}"],
                 time_update,
             )
             kd_info_parse["stars"] += new_stars
@@ -1632,39 +1517,60 @@ def _refresh_kd(kd_id, state, time_update, update_history):
                 kd_info_parse["projects_max_points"][key_project] = project_max_func(kd_info_parse["stars"])
         
         if "mobis" in categories_to_resolve:
-            new_units, next_resolves["mobis"] = _resolve_mobis(kd_id, time_update)
+            new_units, next_resolves["mobis"], batch_patches[f"mobis_{kd_id}"] = _resolve_mobis(
+                kd_id,
+                queue_infos[f"mobis_{kd_id}"],
+                time_update,
+            )
             for key_unit, amt_unit in new_units.items():
                 kd_info_parse["units"][key_unit] += amt_unit
         
         if "structures" in categories_to_resolve:
-            new_structures, next_resolves["structures"] = _resolve_structures(kd_id, time_update)
+            new_structures, next_resolves["structures"], batch_patches[f"structures_{kd_id}"] = _resolve_structures(
+                kd_id,
+                queue_infos[f"structures_{kd_id}"],
+                time_update,
+            )
             for key_structure, amt_structure in new_structures.items():
                 kd_info_parse["structures"][key_structure] += amt_structure
         
         if "missiles" in categories_to_resolve:
-            new_missiles, next_resolves["missiles"] = _resolve_missiles(kd_id, time_update)
+            new_missiles, next_resolves["missiles"], batch_patches[f"missiles_{kd_id}"] = _resolve_missiles(
+                kd_id,
+                queue_infos[f"missiles_{kd_id}"],
+                time_update,
+            )
             for key_missiles, amt_missiles in new_missiles.items():
                 kd_info_parse["missiles"][key_missiles] += amt_missiles
 
         if "engineers" in categories_to_resolve:
-            new_engineers, next_resolves["engineers"] = _resolve_engineers(
+            new_engineers, next_resolves["engineers"], batch_patches[f"engineers_{kd_id}"] = _resolve_engineers(
                 kd_id,
+                queue_infos[f"engineers_{kd_id}"],
                 time_update,
             )
             kd_info_parse["units"]["engineers"] += new_engineers
         
         if "revealed" in categories_to_resolve:
-            next_resolves["revealed"] = _resolve_revealed(
+            next_resolves["revealed"], batch_patches[f"revealed_{kd_id}"] = _resolve_revealed(
                 kd_id,
+                queue_infos[f"revealed_{kd_id}"],
                 time_update,
             )
         
         if "shared" in categories_to_resolve:
-            next_resolves["shared"] = _resolve_shared(
+            next_resolves["shared"], batch_patches[f"shared_{kd_id}"] = _resolve_shared(
                 kd_id,
+                queue_infos[f"shared_{kd_id}"],
                 time_update,
             )
 
+        # Auto spending takes the queue locks itself, so write the queues back first
+        failed = uag._batch_patch(batch_patches, retries=uag.BATCH_PATCH_RETRIES)
+        if failed:
+            app.logger.error('Could not write resolved queues %s for kingdom %s', failed, kd_id)
+        uam.release_locks_by_id(queue_request_id)
+
         if "generals" in categories_to_resolve:
             kd_info_parse, next_resolves["generals"] = _resolve_generals(
                 kd_info_parse,
@@ -1706,6 +1612,7 @@ def _refresh_kd(kd_id, state, time_update, update_history):
             data=json.dumps(new_kd_info, default=str),
         )
     finally:
+        uam.release_locks_by_id(queue_request_id)
         uam.release_lock(f'/kingdom/{kd_id}')
 
     _resolve_schedules(kd_id, time_update)
@@ -1717,6 +1624,11 @@ def _refresh_kd(kd_id, state, time_update, update_history):
         _resolve_auto_rob(new_kd_info)
 
     new_kd_info = uag._get_kd_info(kd_id)
+    uae.publish_kingdom_event(
+        kd_id,
+        kingdom=uae.kingdom_changes(old_kd_info, new_kd_info),
+        resolved=categories_to_resolve,
+    )
     score_stars = new_kd_info["stars"]
     score_networth = new_kd_info["networth"]
 
@@ -1728,6 +1640,246 @@ def _refresh_kd(kd_id, state, time_update, update_history):
     return score_stars, score_networth
 
 
+def _refresh_kd_income(kd_id, state, time_update, update_history):
+    """Accrue income for a kingdom with nothing due, skipping queue and schedule resolution"""
+    app = flask.current_app
+    try:
+        query = db.session.query(User).filter_by(kd_id=kd_id).all()
+        user = query[0]
+        if not user.kd_created:
+            return (0, 0)
+    except:
+        print(f"Could not query kd_id {kd_id}")
+        pass
+
+    while not uam.acquire_lock(f'/kingdom/{kd_id}', timeout=999, wait=10, settle=False):
+        time.sleep(0.01)
+    try:
+        kd_info_parse = uag._get_kd_info(kd_id, project=False)
+        if kd_info_parse["status"].lower() == "dead":
+            return (0, 0)
+        current_bonuses = {
+            project: project_dict.get("max_bonus", 0) * min(kd_info_parse["projects_points"][project] / kd_info_parse["projects_max_points"][project], 1.0)
+            for project, project_dict in uas.PROJECTS.items()
+            if "max_bonus" in project_dict
+        }
+        old_kd_info = copy.deepcopy(kd_info_parse)
+        new_kd_info = _kingdom_with_income(kd_info_parse, current_bonuses, state, time_update)
+        kd_patch_response = REQUESTS_SESSION.patch(
+            app.config['AZURE_FUNCTION_ENDPOINT'] + f'/kingdom/{kd_id}',
+            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
+            data=json.dumps(new_kd_info, default=str),
+        )
+    finally:
+        uam.release_lock(f'/kingdom/{kd_id}')
+    uae.publish_kingdom_event(kd_id, kingdom=uae.kingdom_changes(old_kd_info, new_kd_info))
+    return new_kd_info["stars"], new_kd_info["networth"]
+
+def _refresh_income_batch(kd_ids, state, time_update):
+    """Accrue income for kingdoms with nothing due in one vectorized pass
+
+    Kingdoms whose lock is busy, that have siphons to settle or whose write
+    failed are left for _refresh_kd_income. Returns the scores of the kingdoms
+    handled and the ids left over.
+    """
+    db_kds = db.session.query(User).filter(User.kd_id.in_(kd_ids)).all()
+    created_kds = {str(user.kd_id) for user in db_kds if user.kd_created}
+    kd_scores = {
+        kd_id: (0, 0)
+        for kd_id in kd_ids
+        if kd_id not in created_kds
+    }
+    locked_kds = [
+        kd_id
+        for kd_id in kd_ids
+        if kd_id in created_kds and uam.acquire_lock(f'/kingdom/{kd_id}', timeout=999, settle=False)
+    ]
+    leftover_kds = [
+        kd_id
+        for kd_id in kd_ids
+        if kd_id in created_kds and kd_id not in locked_kds
+    ]
+    try:
+        batch_items = uag._batch_read([
+            f'{item_prefix}_{kd_id}'
+            for kd_id in locked_kds
+            for item_prefix in ["kingdom", "mobis", "siphons_out", "siphons_in"]
+        ])
+        batch_kds = []
+        for kd_id in locked_kds:
+            kd_info_parse = batch_items[f'kingdom_{kd_id}']
+            if kd_info_parse["status"].lower() == "dead":
+                kd_scores[kd_id] = (0, 0)
+            elif datetime.datetime.fromisoformat(kd_info_parse["last_income"]).astimezone(datetime.timezone.utc) >= time_update:
+                # Continuous income already settled this kingdom past the tick's time
+                kd_scores[kd_id] = (kd_info_parse["stars"], kd_info_parse["networth"])
+            elif batch_items[f'siphons_out_{kd_id}']["siphons_out"] or batch_items[f'siphons_in_{kd_id}']["siphons_in"]:
+                leftover_kds.append(kd_id)
+            else:
+                batch_kds.append(kd_id)
+
+        kd_infos = [batch_items[f'kingdom_{kd_id}'] for kd_id in batch_kds]
+        current_bonuses = [
+            {
+                project: project_dict.get("max_bonus", 0) * min(kd_info_parse["projects_points"][project] / kd_info_parse["projects_max_points"][project], 1.0)
+                for project, project_dict in uas.PROJECTS.items()
+                if "max_bonus" in project_dict
+            }
+            for kd_info_parse in kd_infos
+        ]
+        start_time = datetime.datetime.now(datetime.timezone.utc)
+        units_training = [
+            uag._calc_units(start_time, {}, [], uaq.BuildQueue.from_document(batch_items[f'mobis_{kd_id}'], "mobis"))["hour_24"]
+            for kd_id in batch_kds
+        ]
+        new_kd_infos = uai.kingdoms_with_income(
+            kd_infos,
+            current_bonuses,
+            state,
+            time_update,
+            units_training=units_training,
+        )
+        kd_patches = {}
+        for kd_id, new_kd_info in zip(batch_kds, new_kd_infos):
+            _complete_projects(new_kd_info)
+            kd_patches[f'kingdom_{kd_id}'] = new_kd_info
+        failed = set(uag._batch_patch(kd_patches))
+        written_kds = []
+        for kd_id in batch_kds:
+            new_kd_info = kd_patches[f'kingdom_{kd_id}']
+            if f'kingdom_{kd_id}' in failed:
+                # _refresh_kd_income accrues from whatever was stored, so a write that did land is not counted twice
+                leftover_kds.append(kd_id)
+                continue
+            if new_kd_info["status"] == "Dead":
+                uam._mark_kingdom_death(kd_id)
+            kd_scores[kd_id] = (new_kd_info["stars"], new_kd_info["networth"])
+            written_kds.append(kd_id)
+    finally:
+        uam.release_locks_by_name([f'/kingdom/{kd_id}' for kd_id in locked_kds])
+    if failed:
+        flask.current_app.logger.warning('Batch income write failed for %s, left for single refreshes', sorted(failed))
+    old_kd_infos = dict(zip(batch_kds, kd_infos))
+    for kd_id in written_kds:
+        uae.publish_kingdom_event(kd_id, kingdom=uae.kingdom_changes(old_kd_infos[kd_id], kd_patches[f'kingdom_{kd_id}']))
+    return kd_scores, leftover_kds
+
+def _refresh_kd_worker(app, refresh_func, kd_id, state, time_update, update_history):
+    """Refresh a kingdom on a worker thread with its own app context and db session"""
+    with app.app_context():
+        kd_start = time.perf_counter()
+        try:
+            scores = refresh_func(kd_id, state, time_update, update_history)
+        finally:
+            db.session.remove()
+        return scores, time.perf_counter() - kd_start
+
+def _refresh_kingdoms(kingdoms, state, time_update, update_history, kds_due=None):
+    """Refresh kingdoms across a bounded worker pool
+
+    Kingdoms in kds_due get a full refresh and the rest only accrue income. With
+    kds_due of None every kingdom gets a full refresh.
+
+    Returns the (stars, networth) of each kingdom and the seconds spent on each
+    """
+    app = flask.current_app._get_current_object()
+    max_workers = max(int(app.config.get("REFRESH_WORKERS", 1) or 1), 1)
+    kd_scores = {}
+    kd_latencies = {}
+    kd_refresh_funcs = {
+        kd_id: _refresh_kd
+        for kd_id in kingdoms
+        if kds_due is None or kd_id in kds_due
+    }
+    if kds_due is not None:
+        batch_start = time.perf_counter()
+        kd_scores, leftover_kds = _refresh_income_batch(
+            [kd_id for kd_id in kingdoms if kd_id not in kds_due],
+            state,
+            time_update,
+        )
+        app.logger.info(
+            'Accrued income for %s kingdoms in one batch in %.3fs',
+            len(kd_scores),
+            time.perf_counter() - batch_start,
+        )
+        for kd_id in leftover_kds:
+            kd_refresh_funcs[kd_id] = _refresh_kd_income
+    if max_workers == 1:
+        for kd_id, refresh_func in kd_refresh_funcs.items():
+            kd_start = time.perf_counter()
+            kd_scores[kd_id] = refresh_func(
+                kd_id,
+                state,
+                time_update,
+                update_history,
+            )
+            kd_latencies[kd_id] = time.perf_counter() - kd_start
+        return kd_scores, kd_latencies
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                _refresh_kd_worker,
+                app,
+                refresh_func,
+                kd_id,
+                state,
+                time_update,
+                update_history,
+            ): kd_id
+            for kd_id, refresh_func in kd_refresh_funcs.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            kd_id = futures[future]
+            kd_scores[kd_id], kd_latencies[kd_id] = future.result()
+    return kd_scores, kd_latencies
+
+def _tick_lag(state, time_update):
+    """Seconds this tick started later than the cadence asks for, and whether it has fallen behind
+
+    The last tick's start and duration are kept in state, so every worker that
+    takes a turn at ticking sees the same ones. Only a tick that overran the
+    cadence puts the next one behind, so a trigger slower than the cadence makes
+    ticks late without making them drop work.
+    """
+    tick_seconds = uas.GAME_CONFIG["BASE_TICK_SECONDS"]
+    last_start = state["state"].get("last_tick_start")
+    if not last_start:
+        return 0.0, False
+    since_last = (time_update - datetime.datetime.fromisoformat(last_start)).total_seconds()
+    lag = max(since_last - tick_seconds, 0.0)
+    return lag, state["state"].get("last_tick_seconds", 0.0) > tick_seconds
+
+def _deferred_work_due(history_datetime, time_update, behind):
+    """Whether this tick records history and resolves scores
+
+    A tick that is behind defers both, until history is a full epoch overdue.
+    """
+    overdue = time_update - history_datetime >= datetime.timedelta(seconds=uas.GAME_CONFIG["BASE_EPOCH_SECONDS"])
+    run_deferred = not behind or overdue
+    return history_datetime < time_update and run_deferred, run_deferred
+
+def _record_tick(tick_seconds, lag, behind):
+    with _TICK_STATS_LOCK:
+        _TICK_STATS["ticks"] += 1
+        _TICK_STATS["behind"] += int(behind)
+        _TICK_STATS["lag"].append(lag)
+        _TICK_STATS["seconds"].append(tick_seconds)
+
+def _get_tick_stats():
+    """Tick counts, and lag and duration percentiles over the recent ticks of this worker"""
+    with _TICK_STATS_LOCK:
+        return {
+            "target_seconds": uas.GAME_CONFIG["BASE_TICK_SECONDS"],
+            "speed": uas.GAME_CONFIG["GAME_SPEED"],
+            "ticks": _TICK_STATS["ticks"],
+            "coalesced": _TICK_STATS["coalesced"],
+            "behind": _TICK_STATS["behind"],
+            "lag": uam._percentiles(_TICK_STATS["lag"]),
+            "seconds": uam._percentiles(_TICK_STATS["seconds"]),
+        }
+
 @bp.route('/api/refreshdata')
 def refresh_data():
     """Perform periodic refresh tasks"""
@@ -1740,6 +1892,18 @@ def refresh_data():
     time_now = datetime.datetime.now(datetime.timezone.utc).isoformat()
     if time_now < state["state"]["game_start"]:
         return ("Not started", 200)
+
+    if not uam.acquire_lock(TICK_LOCK_NAME, timeout=TICK_LOCK_SECONDS, settle=False):
+        with _TICK_STATS_LOCK:
+            _TICK_STATS["coalesced"] += 1
+        return ("Tick already running", 200)
+    try:
+        return _refresh_tick(state, time_now)
+    finally:
+        uam.release_lock(TICK_LOCK_NAME)
+
+def _refresh_tick(state, time_now):
+    app = flask.current_app
     if time_now > state["state"]["election_end"] and state["state"]["election_end"] != "":
         state = _resolve_election(state)
     elif time_now > state["state"]["election_start"] and state["state"]["election_end"] == "":
@@ -1748,9 +1912,19 @@ def refresh_data():
     kingdoms = uag._get_kingdoms()
     time_update = datetime.datetime.now(datetime.timezone.utc)
 
+    tick_start = time.perf_counter()
+    lag, behind = _tick_lag(state, time_update)
     history_datetime = datetime.datetime.fromisoformat(state["state"]["next_history"]).astimezone(datetime.timezone.utc)
-    if history_datetime < time_update:
-        update_history = True
+    update_history, update_scores = _deferred_work_due(history_datetime, time_update, behind)
+    if behind:
+        app.logger.warning(
+            'The last tick overran its %.3fs cadence, %s history and scores',
+            uas.GAME_CONFIG["BASE_TICK_SECONDS"],
+            'deferring' if not update_scores else 'still running overdue',
+        )
+
+    # History stays due and is recorded by the next tick that keeps up, or once it is an epoch overdue
+    if update_history:
         next_history = history_datetime + datetime.timedelta(seconds=uas.GAME_CONFIG["BASE_EPOCH_SECONDS"])
         state_payload = {
             "next_history": next_history.isoformat(),
@@ -1761,17 +1935,20 @@ def refresh_data():
             headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
             data=json.dumps(state_payload)
         )
-    else:
-        update_history = False
+        uag._memo_invalidate('/state')
 
-    kd_scores = {}
-    for kd_id in kingdoms:
-        kd_scores[kd_id] = _refresh_kd(
-            kd_id,
-            state,
-            time_update,
-            update_history,
-        )
+    # Kingdom history is recorded by the full refresh, so every kingdom gets one each epoch
+    kds_due = None if update_history else uag._get_due_kingdoms(time_update)
+
+    kd_scores, kd_latencies = _refresh_kingdoms(
+        kingdoms,
+        state,
+        time_update,
+        update_history,
+        kds_due,
+    )
+    # Kingdom refreshes may have written shared documents from other contexts
+    uag._memo_invalidate()
     
     kd_scores_split = {
         "stars": {
@@ -1783,7 +1960,33 @@ def refresh_data():
             for kd_id, items in kd_scores.items() 
         },
     }
-    _resolve_scores(kd_scores_split, time_update)
+    # Points accrue over the time since the last scores update, so skipping one loses nothing
+    if update_scores:
+        _resolve_scores(kd_scores_split, time_update)
     _resolve_empires(kd_scores_split, time_update)
-        
-    return "Refreshed", 200
\ No newline at end of file
+
+    tick_seconds = time.perf_counter() - tick_start
+    _record_tick(tick_seconds, lag, behind)
+    # Shared through state so the next tick is judged the same whichever worker runs it
+    tick_response = REQUESTS_SESSION.patch(
+        app.config['AZURE_FUNCTION_ENDPOINT'] + f'/updatestate',
+        headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
+        data=json.dumps({
+            "last_tick_start": time_update.isoformat(),
+            "last_tick_seconds": tick_seconds,
+        })
+    )
+    uag._memo_invalidate('/state')
+    if kd_latencies:
+        latencies_sorted = sorted(kd_latencies.values())
+        slowest_kd = max(kd_latencies, key=kd_latencies.get)
+        app.logger.info(
+            'Refreshed %s kingdoms (%s individually) in %.3fs (median %.3fs, max %.3fs for %s)',
+            len(kd_scores),
+            len(kd_latencies),
+            tick_seconds,
+            latencies_sorted[len(latencies_sorted) // 2],
+            latencies_sorted[-1],
+            slowest_kd,
+        )
+    return "Refreshed", 200
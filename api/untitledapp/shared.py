@@ -93,8 +93,24 @@ RACES = [
     "Fuzi",
 ]
 
+# Durations of a standard round. A round's speed divides them, and everything else is a multiple of an epoch
+STANDARD_EPOCH_SECONDS = 30 * 60
+STANDARD_QUEUE_BUCKET_SECONDS = 5 * 60
+STANDARD_TICK_SECONDS = 60
+# Round speeds by name. A standard round runs about a month, rapid a week and hyper a day
+GAME_SPEEDS = {
+    "standard": 1,
+    "rapid": 4,
+    "hyper": 30,
+}
+# Past this the queue buckets shrink below a second
+MAX_GAME_SPEED = 300
+
 GAME_CONFIG = {
-    "BASE_EPOCH_SECONDS": 30 * 60, 
+    "GAME_SPEED": 1,
+    "BASE_EPOCH_SECONDS": STANDARD_EPOCH_SECONDS, 
+    "BASE_QUEUE_BUCKET_SECONDS": STANDARD_QUEUE_BUCKET_SECONDS,
+    "BASE_TICK_SECONDS": STANDARD_TICK_SECONDS,
 
     "BASE_SETTLE_STARS_POWER": 0.5,
     "BASE_SETTLE_COST_CONSTANT": 50,
@@ -287,6 +303,29 @@ GAME_CONFIG = {
     "SURPRISE_WAR_PENALTY_MULTIPLIER": 48,
 }
 
+def parse_game_speed(speed):
+    """A round speed from a multiplier or a GAME_SPEEDS name, standard when unset"""
+    if speed is None or speed == "":
+        return 1.0
+    if speed in GAME_SPEEDS:
+        return float(GAME_SPEEDS[speed])
+    speed = float(speed)
+    if not math.isfinite(speed) or not 0 < speed <= MAX_GAME_SPEED:
+        raise ValueError(f"Game speed must be above 0 and at most {MAX_GAME_SPEED}, got {speed}")
+    return speed
+
+def apply_game_speed(speed):
+    """Scale the epoch, queue buckets and tick cadence for a round running speed times faster than standard"""
+    speed = parse_game_speed(speed)
+    if speed != GAME_CONFIG["GAME_SPEED"]:
+        GAME_CONFIG.update({
+            "GAME_SPEED": speed,
+            "BASE_EPOCH_SECONDS": STANDARD_EPOCH_SECONDS / speed,
+            "BASE_QUEUE_BUCKET_SECONDS": STANDARD_QUEUE_BUCKET_SECONDS / speed,
+            "BASE_TICK_SECONDS": STANDARD_TICK_SECONDS / speed,
+        })
+    return speed
+
 GAME_FUNCS = {
     "BASE_SETTLE_COST": lambda stars: math.floor((stars ** GAME_CONFIG["BASE_SETTLE_STARS_POWER"]) * GAME_CONFIG["BASE_SETTLE_COST_CONSTANT"]), 
     "BASE_MAX_SETTLE": lambda stars: math.floor(stars * GAME_CONFIG["BASE_MAX_SETTLE_CAP"]), 
@@ -405,6 +444,16 @@ AGGRO_OPERATIONS = [
 DATE_SENTINEL = "2099-01-01T00:00:00+00:00"
 
 INITIAL_KINGDOM_STARS = 300
+HISTORY_METRICS = [
+    "networth",
+    "stars",
+    "population",
+    "drones",
+    "engineers",
+    "max_offense",
+    "max_defense",
+]
+
 INITIAL_KINGDOM_STATE = {
     "kingdom": {
         "kdId": "",
@@ -562,11 +611,11 @@ INITIAL_KINGDOM_STATE = {
     "siphons_in": {"siphons_in": []},
     "siphons_out": {"siphons_out": []},
     "news": {"news": []},
-    "settles": {"settles": []},
-    "mobis": {"mobis": []},
-    "structures": {"structures": []},
-    "missiles": {"missiles": []},
-    "engineers": {"engineers": []},
+    "settles": {"settles": [], "times": []},
+    "mobis": {"mobis": [], "times": []},
+    "structures": {"structures": [], "times": []},
+    "missiles": {"missiles": [], "times": []},
+    "engineers": {"engineers": [], "times": []},
     "revealed": {
         "revealed": {},
         "galaxies": {},
@@ -590,14 +639,9 @@ INITIAL_KINGDOM_STATE = {
         "shared": 0,
     },
     "history": {
-        "history": {
-            "networth": [],
-            "stars": [],
-            "population": [],
-            "drones": [],
-            "engineers": [],
-            "max_offense": [],
-            "max_defense": [],
+        "series": {
+            metric: {"time": [], "value": []}
+            for metric in HISTORY_METRICS
         }
     },
 }
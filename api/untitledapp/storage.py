@@ -0,0 +1,804 @@
+import bisect
+import collections
+import copy
+import datetime
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+import requests
+import requests.adapters
+
+# Endpoint the embedded backend is mounted on when AZURE_FUNCTION_ENDPOINT is unset
+EMBEDDED_ENDPOINT = "http://embedded/api"
+KINGDOM_ITEMS = [
+    "kingdom",
+    "siphons_in",
+    "siphons_out",
+    "news",
+    "settles",
+    "mobis",
+    "structures",
+    "missiles",
+    "engineers",
+    "revealed",
+    "shared",
+    "pinned",
+    "spy_history",
+    "attack_history",
+    "missile_history",
+    "messages",
+    "notifs",
+    "history",
+]
+RESET_KEEP_IDS = [
+    "accounts",
+    "state",
+    "kingdoms",
+    "galaxies",
+    "empires",
+    "universe_news",
+    "universe_votes",
+    "scores",
+]
+RESOLVE_SCHEDULE_KEYS = {"next_resolve", "schedule", "auto_attack_enabled", "auto_rob_enabled", "status", "resolve_due"}
+# Kingdom logs by route, as (item prefix, key)
+KINGDOM_LOGS = {
+    "news": ("news", "news"),
+    "messages": ("messages", "messages"),
+    "spyhistory": ("spy_history", "spy_history"),
+    "attackhistory": ("attack_history", "attack_history"),
+    "missilehistory": ("missile_history", "missile_history"),
+}
+KINGDOM_QUEUES = ["settles", "mobis", "structures", "missiles", "engineers"]
+PATCH_OPERATIONS = {"add", "set", "replace", "remove", "incr"}
+
+
+class ItemNotFound(KeyError):
+    pass
+
+
+class MemoryStore:
+    """Items held in a dict by id
+
+    Writes are visible as soon as they are made, so a request that fails
+    part-way keeps what it wrote before failing.
+    """
+
+    def __init__(self, items=None):
+        self.items = items or {}
+
+    def read(self, item_id):
+        try:
+            return self.items[item_id]
+        except KeyError:
+            raise ItemNotFound(item_id)
+
+    def get(self, item_id):
+        return self.items.get(item_id)
+
+    def write(self, item):
+        self.items[item["id"]] = item
+
+    def delete(self, item_id):
+        self.items.pop(item_id, None)
+
+    def ids(self):
+        return list(self.items)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class SqliteStore(MemoryStore):
+    """Items cached in memory and written through to a SQLite file when a request commits
+
+    The cache is loaded once, so the file must only be used by a single process.
+    A request that fails is rolled back by reloading the items it read or wrote.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS items (id TEXT PRIMARY KEY, body TEXT NOT NULL)")
+        self._conn.commit()
+        super().__init__({
+            item_id: json.loads(body)
+            for item_id, body in self._conn.execute("SELECT id, body FROM items")
+        })
+        self._touched = set()
+        self._written = set()
+
+    def read(self, item_id):
+        self._touched.add(item_id)
+        return super().read(item_id)
+
+    def get(self, item_id):
+        self._touched.add(item_id)
+        return super().get(item_id)
+
+    def write(self, item):
+        super().write(item)
+        self._touched.add(item["id"])
+        self._written.add(item["id"])
+
+    def delete(self, item_id):
+        super().delete(item_id)
+        self._touched.add(item_id)
+        self._written.add(item_id)
+
+    def commit(self):
+        written = [
+            (item_id, self.items.get(item_id))
+            for item_id in self._written
+        ]
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO items (id, body) VALUES (?, ?)",
+                [(item_id, json.dumps(item)) for item_id, item in written if item is not None],
+            )
+            self._conn.executemany(
+                "DELETE FROM items WHERE id = ?",
+                [(item_id,) for item_id, item in written if item is None],
+            )
+        self._touched = set()
+        self._written = set()
+
+    def rollback(self):
+        for item_id in self._touched:
+            row = self._conn.execute("SELECT body FROM items WHERE id = ?", (item_id,)).fetchone()
+            if row is None:
+                self.items.pop(item_id, None)
+            else:
+                self.items[item_id] = json.loads(row[0])
+        self._touched = set()
+        self._written = set()
+
+
+def _queue_time(entry):
+    return datetime.datetime.fromisoformat(entry["time"]).timestamp()
+
+def _queue_sorted(queue, key):
+    entries = queue.get(key, [])
+    times = queue.get("times")
+    if times is None or len(times) != len(entries):
+        pairs = sorted(
+            ((_queue_time(entry), entry) for entry in entries),
+            key=lambda pair: pair[0],
+        )
+        queue[key] = [entry for _, entry in pairs]
+        queue["times"] = [time for time, _ in pairs]
+    return queue
+
+def _queue_insert(queue, key, new_entries):
+    for entry in new_entries:
+        time = _queue_time(entry)
+        i_insert = bisect.bisect_right(queue["times"], time)
+        if i_insert and queue["times"][i_insert - 1] == time:
+            existing_entry = queue[key][i_insert - 1]
+            for key_amount, amount in entry.items():
+                if key_amount != "time":
+                    existing_entry[key_amount] = existing_entry.get(key_amount, 0) + amount
+            continue
+        queue["times"].insert(i_insert, time)
+        queue[key].insert(i_insert, entry)
+    return queue
+
+def _history_time(value):
+    return int(datetime.datetime.fromisoformat(value).timestamp())
+
+def _history_window(series, since=None, before=None):
+    windowed = {}
+    for key_history, columns in series.items():
+        times = columns["time"]
+        i_start = bisect.bisect_left(times, since) if since is not None else 0
+        i_end = bisect.bisect_left(times, before) if before is not None else len(times)
+        windowed[key_history] = {
+            "time": times[i_start:i_end],
+            "value": columns["value"][i_start:i_end],
+        }
+    return windowed
+
+def _kingdom_due_time(kd):
+    if kd.get("status", "").lower() == "dead":
+        return None
+    if kd.get("auto_attack_enabled") or kd.get("auto_rob_enabled"):
+        return 0.0
+    due_times = [
+        *kd.get("next_resolve", {}).values(),
+        *(schedule["time"] for schedule in kd.get("schedule", [])),
+    ]
+    if not due_times:
+        return None
+    return min(
+        datetime.datetime.fromisoformat(due_time).timestamp()
+        for due_time in due_times
+    )
+
+def _revealed_apply(revealed_info, req_body):
+    for kd_id, revealed_dict in (req_body.get("new_revealed") or {}).items():
+        revealed_info["revealed"][kd_id] = {
+            **revealed_info["revealed"].get(kd_id, {}),
+            **revealed_dict,
+        }
+    if req_body.get("new_galaxies"):
+        revealed_info["galaxies"] = {
+            **revealed_info["galaxies"],
+            **req_body["new_galaxies"],
+        }
+    if req_body.get("new_revealed_galaxymates"):
+        revealed_info["revealed_galaxymates"] += req_body["new_revealed_galaxymates"]
+    if req_body.get("new_revealed_to_galaxymates"):
+        revealed_info["revealed_to_galaxymates"] += req_body["new_revealed_to_galaxymates"]
+    for key in ["revealed", "galaxies", "revealed_galaxymates", "revealed_to_galaxymates"]:
+        if req_body.get(key) is not None:
+            revealed_info[key] = req_body[key]
+    return revealed_info
+
+def _notifs_apply(notifs, add_categories, clear_categories):
+    for add_cat in add_categories:
+        notifs[add_cat] += 1
+    for clear_cat in clear_categories:
+        notifs[clear_cat] = 0
+    return notifs
+
+def _apply_operations(item, operations):
+    """Apply the function app's partial-document operations to an item in place
+
+    Paths are JSON pointers. add inserts into arrays, with "-" appending, while
+    set overwrites, and both create missing object keys, as does incr.
+    """
+    for operation in operations:
+        if operation.get("op") not in PATCH_OPERATIONS or not operation.get("path", "").startswith("/"):
+            raise ValueError(f"Invalid patch operation {operation}")
+    for operation in operations:
+        *parent_keys, key = [
+            key.replace("~1", "/").replace("~0", "~")
+            for key in operation["path"][1:].split("/")
+        ]
+        parent = item
+        for parent_key in parent_keys:
+            parent = parent[int(parent_key)] if isinstance(parent, list) else parent[parent_key]
+        op, value = operation["op"], operation.get("value")
+        if isinstance(parent, list):
+            if op == "add":
+                parent.insert(len(parent) if key == "-" else int(key), value)
+            elif op == "remove":
+                del parent[int(key)]
+            elif op == "incr":
+                parent[int(key)] += value
+            else:
+                parent[int(key)] = value
+        elif op == "remove":
+            del parent[key]
+        elif op == "replace" and key not in parent:
+            raise KeyError(operation["path"])
+        elif op == "incr":
+            parent[key] = parent.get(key, 0) + value
+        else:
+            parent[key] = value
+    return item
+
+
+class EmbeddedBackend(requests.adapters.BaseAdapter):
+    """The function app's routes served in-process from a store
+
+    Mounted on REQUESTS_SESSION at AZURE_FUNCTION_ENDPOINT, so getters and actions
+    reach it through the same calls as the function app. Requests are applied one
+    at a time and each is committed to the store as a unit. Logs are never paged
+    since nothing limits the size of an item here. Request counts and seconds are
+    kept per route in stats.
+    """
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+        self.stats = collections.defaultdict(lambda: {"requests": 0, "seconds": 0.0})
+        self._lock = threading.RLock()
+        self._routes = []
+        self._add_routes()
+        if self.store.get("state") is None:
+            self.init_state({})
+            self.store.commit()
+
+    def _route(self, method, template, handler):
+        pattern = re.sub(r"\{(\w+)\}", r"(?P<\1>[^/]+)", template)
+        self._routes.append((method, re.compile(f"^{pattern}$"), f"{method} {template}", handler))
+
+    def _add_routes(self):
+        self._route("POST", "deleteall", self.delete_all)
+        self._route("POST", "init", self.init_state)
+        self._route("GET", "state", lambda req: self._get("state"))
+        self._route("PATCH", "updatestate", self.update_state)
+        self._route("POST", "resetstate", self.reset_state)
+        self._route("GET", "accounts", lambda req: self._get("accounts"))
+        self._route("PATCH", "accounts", lambda req: self._merge("accounts", {"accounts": req["body"]["accounts"]}))
+        self._route("GET", "scores", lambda req: self._get("scores"))
+        self._route("PATCH", "scores", lambda req: self._merge("scores", req["body"]))
+        self._route("POST", "galaxy/{galaxyId}", self.create_galaxy)
+        self._route("POST", "kingdom", self.create_kingdom)
+        self._route("GET", "item", lambda req: self._get(req["body"]["item"]))
+        self._route("POST", "createitem", self.create_item)
+        self._route("PATCH", "item/{itemId}", self.patch_item)
+        self._route("GET", "kingdoms", lambda req: self._get("kingdoms"))
+        self._route("PATCH", "kingdoms", lambda req: self._merge("kingdoms", req["body"]))
+        self._route("GET", "galaxies", lambda req: self._get("galaxies"))
+        self._route("GET", "galaxy/{galaxy_id}/politics", lambda req, galaxy_id: self._get(f"galaxy_votes_{galaxy_id}"))
+        self._route("PATCH", "galaxy/{galaxy_id}/politics", lambda req, galaxy_id: self._merge(f"galaxy_votes_{galaxy_id}", req["body"]))
+        self._route("GET", "empire/{empire_id}/politics", lambda req, empire_id: self._get(f"empire_politics_{empire_id}"))
+        self._route("PATCH", "empire/{empire_id}/politics", lambda req, empire_id: self._merge(f"empire_politics_{empire_id}", req["body"]))
+        self._route("GET", "universevotes", lambda req: self._get("universe_votes"))
+        self._route("PATCH", "universepolitics", lambda req: self._merge("universe_votes", req["body"]))
+        self._route("GET", "empires", lambda req: self._get("empires"))
+        self._route("POST", "empire", self.create_empire)
+        self._route("PATCH", "empires", lambda req: self._merge("empires", req["body"]))
+        self._route("GET", "empire/{empireId}/aggression", lambda req, empireId: (200, self._read_empire_aggression(empireId)))
+        self._route("PATCH", "empire/{empireId}/aggression", self.update_empire_aggression)
+        self._route("GET", "resolveschedule", self.get_due_kingdoms)
+        self._route("GET", "kingdom/{kdId}", lambda req, kdId: self._get(f"kingdom_{kdId}"))
+        self._route("PATCH", "kingdom/{kdId}", self.update_kingdom)
+        for direction in ["in", "out"]:
+            self._route("GET", f"kingdom/{{kdId}}/siphons{direction}", lambda req, kdId, direction=direction: self._get(f"siphons_{direction}_{kdId}"))
+            self._route("PATCH", f"kingdom/{{kdId}}/siphons{direction}", lambda req, kdId, direction=direction: self.update_siphons(f"siphons_{direction}", kdId, req["body"]))
+        for route, (item_prefix, key) in KINGDOM_LOGS.items():
+            self._route("GET", f"kingdom/{{kdId}}/{route}", lambda req, kdId, item_prefix=item_prefix, key=key: self._log_read(f"{item_prefix}_{kdId}", key, req["params"]))
+            self._route("PATCH", f"kingdom/{{kdId}}/{route}", lambda req, kdId, item_prefix=item_prefix, key=key: self._log_prepend(f"{item_prefix}_{kdId}", key, req["body"]))
+        self._route("GET", "galaxy/{galaxyId}/news", lambda req, galaxyId: self._log_read(f"galaxy_news_{galaxyId}", "news", req["params"]))
+        self._route("PATCH", "galaxy/{galaxyId}/news", lambda req, galaxyId: self._log_prepend(f"galaxy_news_{galaxyId}", "news", req["body"]))
+        self._route("GET", "empire/{empireId}/news", lambda req, empireId: self._log_read(f"empire_news_{empireId}", "news", req["params"]))
+        self._route("PATCH", "empire/{empireId}/news", lambda req, empireId: self._log_prepend(f"empire_news_{empireId}", "news", req["body"]["news"]))
+        self._route("GET", "universenews", lambda req: self._log_read("universe_news", "news", req["params"]))
+        self._route("PATCH", "universenews", lambda req: self._log_prepend("universe_news", "news", req["body"]["news"]))
+        self._route("GET", "kingdom/{kdId}/notifs", lambda req, kdId: self._get(f"notifs_{kdId}"))
+        self._route("PATCH", "kingdom/{kdId}/notifs", lambda req, kdId: self._apply(f"notifs_{kdId}", _notifs_apply, req["body"].get("add_categories", []), req["body"].get("clear_categories", [])))
+        for key in KINGDOM_QUEUES:
+            self._route("GET", f"kingdom/{{kdId}}/{key}", lambda req, kdId, key=key: (200, _queue_sorted(dict(self.store.read(f"{key}_{kdId}")), key)))
+            self._route("PATCH", f"kingdom/{{kdId}}/{key}", lambda req, kdId, key=key: self.update_queue(key, kdId, req["body"]))
+        self._route("GET", "kingdom/{kdId}/revealed", lambda req, kdId: self._get(f"revealed_{kdId}"))
+        self._route("PATCH", "kingdom/{kdId}/revealed", lambda req, kdId: self._apply(f"revealed_{kdId}", _revealed_apply, req["body"]))
+        self._route("GET", "kingdom/{kdId}/shared", lambda req, kdId: self._get(f"shared_{kdId}"))
+        self._route("POST", "kingdom/{kdId}/shared", lambda req, kdId: self._merge(f"shared_{kdId}", req["body"]))
+        self._route("PATCH", "kingdom/{kdId}/shared", lambda req, kdId: self._extend(f"shared_{kdId}", "shared", req["body"]["shared"]))
+        self._route("PATCH", "kingdom/{kdId}/sharedrequests", lambda req, kdId: self._extend(f"shared_requests_{kdId}", "shared_requests", req["body"]["shared_requests"]))
+        self._route("GET", "kingdom/{kdId}/pinned", lambda req, kdId: self._get(f"pinned_{kdId}"))
+        self._route("PATCH", "kingdom/{kdId}/pinned", self.update_pinned)
+        self._route("GET", "kingdom/{kdId}/history", self.get_history)
+        self._route("POST", "histories", self.get_histories)
+        self._route("PATCH", "kingdom/{kdId}/history", self.update_history)
+        self._route("POST", "batch/read", self.batch_read)
+        self._route("POST", "batch/patch", self.batch_patch)
+        self._route("POST", "batch/commit", self.batch_commit)
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        url = urllib.parse.urlsplit(request.url)
+        path = url.path.split("/api/", 1)[-1].strip("/")
+        body = request.body
+        if isinstance(body, bytes):
+            body = body.decode()
+        req = {
+            "body": json.loads(body) if body else {},
+            "params": {
+                key: values[0]
+                for key, values in urllib.parse.parse_qs(url.query).items()
+            },
+        }
+        status_code, payload = 404, f"No route for {request.method} {path}"
+        route_start = time.perf_counter()
+        for method, pattern, route_name, handler in self._routes:
+            match = pattern.match(path)
+            if method != request.method or match is None:
+                continue
+            with self._lock:
+                try:
+                    status_code, payload = handler(req, **match.groupdict())
+                    if isinstance(payload, dict):
+                        payload = json.dumps(payload)
+                    self.store.commit()
+                except Exception:
+                    logging.exception("%s failed", route_name)
+                    self.store.rollback()
+                    status_code, payload = 500, f"{route_name} encountered an error"
+            route_stats = self.stats[route_name]
+            route_stats["requests"] += 1
+            route_stats["seconds"] += time.perf_counter() - route_start
+            break
+
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = payload.encode()
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+    def _get(self, item_id):
+        return 200, self.store.read(item_id)
+
+    def _merge(self, item_id, fields):
+        self.store.write({**self.store.read(item_id), **fields, "id": item_id})
+        return 200, "Updated"
+
+    def _apply(self, item_id, apply, *args):
+        item = apply(self.store.read(item_id), *args)
+        self.store.write(item)
+        return 200, item
+
+    def _extend(self, item_id, key, new_entries):
+        item = self.store.read(item_id)
+        item[key] = item[key] + new_entries
+        self.store.write(item)
+        return 200, "Updated"
+
+    def _schedule_kingdom(self, kd_id, patch):
+        if RESOLVE_SCHEDULE_KEYS.isdisjoint(patch.keys()):
+            return
+        kd = self.store.read(f"kingdom_{kd_id}")
+        due_time = _kingdom_due_time(kd)
+        if kd.get("resolve_due") != due_time:
+            self.store.write({**kd, "resolve_due": due_time})
+
+    def _log_prepend(self, item_id, key, new_entries):
+        if isinstance(new_entries, dict):
+            new_entries = [new_entries]
+        log = self.store.read(item_id)
+        if "next_seq" not in log:
+            entries = log.get(key, [])
+            for i_entry, entry in enumerate(entries):
+                entry["seq"] = len(entries) - i_entry
+            log[key] = entries
+            log["next_seq"] = len(entries) + 1
+            log["pages"] = []
+        entries = [dict(entry) for entry in new_entries]
+        for entry in reversed(entries):
+            entry["seq"] = log["next_seq"]
+            log["next_seq"] += 1
+        log[key] = entries + log[key]
+        self.store.write(log)
+        return 200, "Updated"
+
+    def _log_read(self, item_id, key, params):
+        log = self.store.read(item_id)
+        limit = int(params["limit"]) if "limit" in params else None
+        before = int(params["before"]) if "before" in params else None
+        entries = [
+            entry
+            for entry in log.get(key, [])
+            if before is None or entry.get("seq", 0) < before
+        ]
+        return 200, {**log, key: entries[:limit], "pages": log.get("pages", [])}
+
+    def delete_all(self, req):
+        for item_id in self.store.ids():
+            self.store.write({"id": item_id})
+        return 201, "Deleted"
+
+    def init_state(self, req):
+        for item in [
+            {"id": "state", "state": {}},
+            {"id": "kingdoms", "kingdoms": {}},
+            {"id": "galaxies", "galaxies": {}},
+            {"id": "empires", "empires": {}, "last_update": ""},
+            {"id": "universe_news", "news": []},
+            {"id": "universe_votes", "votes": {}},
+            {"id": "accounts", "accounts": []},
+            {
+                "id": "scores",
+                "points": {},
+                "stars": {},
+                "networth": {},
+                "galaxy_networth": {},
+                "last_update": "",
+            },
+        ]:
+            self.store.write(item)
+        return 201, "Initial state created."
+
+    def update_state(self, req):
+        state = self.store.read("state")
+        state["state"] = {**state["state"], **req["body"]}
+        self.store.write(state)
+        return 200, "Updated state"
+
+    def reset_state(self, req):
+        for item_id in self.store.ids():
+            if item_id not in RESET_KEEP_IDS:
+                self.store.delete(item_id)
+        accounts = self.store.read("accounts")
+        for account in accounts["accounts"]:
+            account["kd_id"] = None
+            account["kd_death_date"] = None
+            account["kd_created"] = False
+        self.store.write(accounts)
+        self._merge("kingdoms", {"kingdoms": {}})
+        self._merge("galaxies", {"galaxies": {}})
+        self._merge("empires", {"empires": {}, "last_update": ""})
+        self._merge("universe_news", {"news": [], "pages": []})
+        self._merge("universe_votes", {"votes": {
+            "policy_1": {
+                "option_1": {},
+                "option_2": {},
+            },
+            "policy_2": {
+                "option_1": {},
+                "option_2": {},
+            }
+        }})
+        self._merge("scores", {
+            "last_update": "",
+            "points": {},
+            "stars": {},
+            "networth": {},
+            "galaxy_networth": {},
+        })
+        return 200, "Reset state"
+
+    def create_galaxy(self, req, galaxyId):
+        galaxies = self.store.read("galaxies")
+        if galaxyId not in galaxies["galaxies"]:
+            galaxies["galaxies"][galaxyId] = []
+            self.store.write(galaxies)
+            self.store.write({"id": f"galaxy_news_{galaxyId}", "news": []})
+            self.store.write({
+                "id": f"galaxy_votes_{galaxyId}",
+                "votes": {
+                    "policy_1": {},
+                    "policy_2": {},
+                    "leader": {},
+                },
+                "active_policies": [],
+                "leader": "",
+                "policy_1_winner": "",
+                "policy_2_winner": "",
+                "empire_invitations": [],
+                "empire_join_requests": [],
+            })
+        return 201, "Created galaxy"
+
+    def create_kingdom(self, req):
+        kd_name = req["body"].get("kingdom_name")
+        kingdoms = self.store.read("kingdoms")
+        if kd_name in kingdoms["kingdoms"]:
+            return 400, "This kingdom already exists"
+        kd_id = str(len(kingdoms["kingdoms"]))
+        kingdoms["kingdoms"][kd_id] = kd_name
+        self.store.write(kingdoms)
+        galaxies = self.store.read("galaxies")
+        galaxies["galaxies"][req["body"].get("galaxy")].append(kd_id)
+        self.store.write(galaxies)
+        for resource_name in KINGDOM_ITEMS:
+            self.store.write({
+                "id": f"{resource_name}_{kd_id}",
+                "kdId": kd_id,
+                "type": resource_name,
+            })
+        return 201, kd_id
+
+    def create_item(self, req):
+        item_id = req["body"]["item"]
+        state = req["body"]["state"]
+        item_contents = self.store.get(item_id)
+        if item_contents is None:
+            self.store.write({"id": item_id, **state})
+        else:
+            for index_key in ["pages", "buckets"]:
+                if index_key in item_contents:
+                    item_contents[index_key] = []
+            self.store.write({**item_contents, **state})
+        return 201, f"Successfully created {item_id} state"
+
+    def patch_item(self, req, itemId):
+        operations = req["body"].get("operations", [])
+        try:
+            item = _apply_operations(copy.deepcopy(self.store.read(itemId)), operations)
+        except ValueError as e:
+            return 400, str(e)
+        self.store.write(item)
+        if itemId.startswith("kingdom_"):
+            self._schedule_kingdom(
+                itemId.removeprefix("kingdom_"),
+                {operation["path"].split("/")[1]: None for operation in operations},
+            )
+        return 200, item
+
+    def create_empire(self, req):
+        empires = self.store.read("empires")
+        empire_id = str(len(empires["empires"]))
+        empires["empires"][empire_id] = {
+            "name": req["body"].get("empire_name"),
+            "galaxies": [req["body"].get("galaxy_id")],
+            "num_kingdoms": 0,
+            "aggression_max": 999,
+            "war": [],
+            "peace": {},
+            "denounced": "",
+            "denounced_expires": "",
+            "surprise_war_penalty": False,
+            "surprise_war_penalty_expires": "",
+        }
+        self.store.write(empires)
+        self.store.write({
+            "id": f"empire_politics_{empire_id}",
+            "empire_invitations": [],
+            "empire_join_requests": [],
+            "surrender_offers_sent": [],
+            "surrender_offers_received": [],
+            "surrender_requests_sent": [],
+            "surrender_requests_received": [],
+            "leader": req["body"].get("leader"),
+        })
+        self.store.write({"id": f"empire_news_{empire_id}", "news": []})
+        self.store.write({"id": f"empire_aggression_{empire_id}", "aggression": {}})
+        return 201, empire_id
+
+    def _read_empire_aggression(self, empire_id):
+        empire_aggression = self.store.get(f"empire_aggression_{empire_id}")
+        if empire_aggression is None:
+            # Empires created before aggression was split out keep it on the empires item
+            empire = self.store.read("empires")["empires"].get(empire_id, {})
+            empire_aggression = {"id": f"empire_aggression_{empire_id}", "aggression": empire.get("aggression", {})}
+            self.store.write(empire_aggression)
+        return empire_aggression
+
+    def update_empire_aggression(self, req, empireId):
+        empire_aggression = self._read_empire_aggression(empireId)
+        aggression = empire_aggression["aggression"]
+        for target_empire, value in req["body"].get("set", {}).items():
+            aggression[target_empire] = value
+        for target_empire, delta in req["body"].get("deltas", {}).items():
+            aggression[target_empire] = aggression.get(target_empire, 0) + delta
+        decay = req["body"].get("decay", 0)
+        if decay:
+            for target_empire, value in aggression.items():
+                aggression[target_empire] = max(value - decay, 0)
+        if "last_update" in req["body"]:
+            empire_aggression["last_update"] = req["body"]["last_update"]
+        self.store.write(empire_aggression)
+        return 200, empire_aggression
+
+    def get_due_kingdoms(self, req):
+        before = datetime.datetime.fromisoformat(req["params"]["before"]).timestamp()
+        due = {}
+        for item_id in self.store.ids():
+            kd = self.store.get(item_id)
+            if kd.get("type") == "kingdom" and kd.get("resolve_due") is not None:
+                due[kd["kdId"]] = kd["resolve_due"]
+        return 200, {
+            "kingdoms": sorted(kd_id for kd_id, due_time in due.items() if due_time <= before),
+            "scheduled": len(due),
+        }
+
+    def update_kingdom(self, req, kdId):
+        self._merge(f"kingdom_{kdId}", req["body"])
+        self._schedule_kingdom(kdId, req["body"])
+        return 200, "Kingdom updated."
+
+    def update_siphons(self, key, kd_id, req_body):
+        siphons_info = self.store.read(f"{key}_{kd_id}")
+        if req_body.get("new_siphons"):
+            siphons_info[key] = siphons_info[key] + [req_body["new_siphons"]]
+        if req_body.get("siphons") is not None:
+            siphons_info[key] = req_body["siphons"]
+        self.store.write(siphons_info)
+        return 200, "Kingdom siphons updated."
+
+    def update_queue(self, key, kd_id, req_body):
+        queue = _queue_sorted(self.store.read(f"{key}_{kd_id}"), key)
+        if req_body.get(f"new_{key}"):
+            _queue_insert(queue, key, req_body[f"new_{key}"])
+        if req_body.get(key) is not None:
+            queue[key] = req_body[key]
+            queue["times"] = req_body.get("times")
+            _queue_sorted(queue, key)
+        self.store.write(queue)
+        return 200, f"Kingdom {key} updated."
+
+    def update_pinned(self, req, kdId):
+        pinned = self.store.read(f"pinned_{kdId}")
+        new_unpinned = req["body"].get("unpinned", [])
+        pinned["pinned"] = [
+            kd
+            for kd in pinned["pinned"] + req["body"].get("pinned", [])
+            if kd not in new_unpinned
+        ]
+        self.store.write(pinned)
+        return 200, "Kingdom pinned updated."
+
+    def _read_history(self, kd_id, since=None, before=None):
+        history = self.store.read(f"history_{kd_id}")
+        return {
+            "id": history["id"],
+            "kdId": history.get("kdId"),
+            "series": _history_window(history.get("series", {}), since, before),
+        }
+
+    def get_history(self, req, kdId):
+        since = _history_time(req["params"]["since"]) if "since" in req["params"] else None
+        before = _history_time(req["params"]["before"]) if "before" in req["params"] else None
+        return 200, self._read_history(kdId, since, before)
+
+    def get_histories(self, req):
+        since = _history_time(req["body"]["since"]) if req["body"].get("since") else None
+        before = _history_time(req["body"]["before"]) if req["body"].get("before") else None
+        return 200, {
+            "histories": {
+                kd_id: self._read_history(kd_id, since, before)["series"] if self.store.get(f"history_{kd_id}") is not None else None
+                for kd_id in req["body"].get("kingdoms", [])
+            }
+        }
+
+    def update_history(self, req, kdId):
+        history = self.store.read(f"history_{kdId}")
+        time_history = _history_time(req["body"]["time"])
+        series = history.setdefault("series", {})
+        for key_history, value in req["body"].get("values", {}).items():
+            columns = series.setdefault(key_history, {"time": [], "value": []})
+            columns["time"].append(time_history)
+            columns["value"].append(value)
+        self.store.write(history)
+        return 200, "Kingdom history updated."
+
+    def batch_read(self, req):
+        return 200, {
+            "items": {
+                item_id: self.store.get(item_id)
+                for item_id in req["body"].get("items", [])
+            }
+        }
+
+    def batch_patch(self, req):
+        failed = []
+        for patch in req["body"].get("items", []):
+            item_id = patch["id"]
+            if self.store.get(item_id) is None:
+                failed.append(item_id)
+                continue
+            self._merge(item_id, patch.get("merge", {}))
+            if item_id.startswith("kingdom_"):
+                self._schedule_kingdom(item_id.removeprefix("kingdom_"), patch.get("merge", {}))
+        return (500 if failed else 200), {"failed": failed}
+
+    def batch_commit(self, req):
+        patches = req["body"].get("items", [])
+        missing = [patch["id"] for patch in patches if self.store.get(patch["id"]) is None]
+        if missing:
+            return 409, {"committed": False, "failed": missing}
+        self.batch_patch({"body": {"items": patches}})
+        for log in req["body"].get("logs", []):
+            self._log_prepend(log["id"], log["key"], log["entries"])
+        for revealed in req["body"].get("revealed", []):
+            self._apply(revealed["id"], _revealed_apply, revealed)
+        for notifs in req["body"].get("notifs", []):
+            self._apply(
+                notifs["id"],
+                _notifs_apply,
+                notifs.get("add_categories", []),
+                notifs.get("clear_categories", []),
+            )
+        return 200, {"committed": True, "failed": []}
+
+
+STORAGE_BACKENDS = {
+    "memory": lambda sqlite_path: EmbeddedBackend(MemoryStore()),
+    "sqlite": lambda sqlite_path: EmbeddedBackend(SqliteStore(sqlite_path)),
+}
+
+def create_storage(backend, sqlite_path=None):
+    """The embedded backend to mount on AZURE_FUNCTION_ENDPOINT, or None to use the function app"""
+    if backend == "functions":
+        return None
+    try:
+        create_backend = STORAGE_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown storage backend {backend}")
+    return create_backend(sqlite_path)
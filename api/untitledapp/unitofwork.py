@@ -0,0 +1,118 @@
+import copy
+import json
+
+import flask
+
+import untitledapp.events as uae
+import untitledapp.getters as uag
+from untitledapp import REQUESTS_SESSION
+
+
+class CommitError(Exception):
+    pass
+
+
+class PartialCommitError(CommitError):
+    """Some items were written and could not be put back after the commit failed"""
+
+    def __init__(self, message, not_restored):
+        super().__init__(message)
+        self.not_restored = not_restored
+
+
+class UnitOfWork:
+    """Reads for a game action in one batch, and its writes staged until commit
+
+    Kingdom items are merged by the backend all-or-nothing. Log entries,
+    revealed and notifs changes are applied after them in a fixed order, and
+    anything registered with after_commit runs only once the writes landed,
+    so an action that fails part-way publishes nothing.
+    """
+
+    def __init__(self):
+        self.items = {}
+        self.merges = {}
+        self.logs = []
+        self.revealed = []
+        self.notifs = {}
+        self._after_commit = []
+
+    def read(self, item_ids):
+        """Batch read the items not already read. Returns copies keyed by item id"""
+        missing = [item_id for item_id in item_ids if item_id not in self.items]
+        self.items.update(uag._batch_read(missing))
+        return {
+            item_id: copy.deepcopy(self.items[item_id])
+            for item_id in item_ids
+        }
+
+    def merge(self, item_id, fields):
+        self.merges.setdefault(item_id, {}).update(fields)
+
+    def append_log(self, item_id, key, entry):
+        for log in self.logs:
+            if log["id"] == item_id and log["key"] == key:
+                log["entries"].insert(0, entry)
+                return
+        self.logs.append({"id": item_id, "key": key, "entries": [entry]})
+
+    def reveal(self, kd_id, payload):
+        self.revealed.append({"id": f"revealed_{kd_id}", **payload})
+
+    def add_notifs(self, kd_id, categories):
+        self.notifs.setdefault(kd_id, []).extend(categories)
+        self.after_commit(uae.publish_kingdom_event, kd_id, update=["notifs"])
+
+    def after_commit(self, func, *args, **kwargs):
+        self._after_commit.append((func, args, kwargs))
+
+    def payload(self):
+        return {
+            "items": [
+                {"id": item_id, "merge": merge}
+                for item_id, merge in self.merges.items()
+            ],
+            "logs": self.logs,
+            "revealed": self.revealed,
+            "notifs": [
+                {"id": f"notifs_{kd_id}", "add_categories": categories}
+                for kd_id, categories in self.notifs.items()
+            ],
+        }
+
+    def commit(self):
+        """Send every staged write in one request. Raises CommitError if the items were not applied
+
+        PartialCommitError is raised instead when some of them were applied and
+        could not be put back. Returns the ids of any logs, revealed or notifs items that failed after
+        the items committed.
+        """
+        app = flask.current_app
+        commit_response = REQUESTS_SESSION.post(
+            app.config['AZURE_FUNCTION_ENDPOINT'] + '/batch/commit',
+            headers={'x-functions-key': app.config['AZURE_FUNCTION_KEY']},
+            data=json.dumps(self.payload(), default=str),
+        )
+        try:
+            commit_response_json = json.loads(commit_response.text)
+        except ValueError:
+            commit_response_json = None
+        if not isinstance(commit_response_json, dict):
+            # Errors outside the commit itself come back as plain text or an empty body
+            self._after_commit = []
+            raise CommitError(f"Unexpected batch/commit response {commit_response.status_code}: {commit_response.text!r}")
+        if commit_response_json.get("not_restored"):
+            self._after_commit = []
+            raise PartialCommitError(
+                f"Items were committed in part, not restored: {commit_response_json['not_restored']}",
+                commit_response_json["not_restored"],
+            )
+        if not commit_response_json.get("committed"):
+            self._after_commit = []
+            raise CommitError(f"Items were not committed: {commit_response_json.get('failed', [])}")
+        return commit_response_json.get("failed", [])
+
+    def run_after_commit(self):
+        after_commit, self._after_commit = self._after_commit, []
+        for func, args, kwargs in after_commit:
+            func(*args, **kwargs)
@@ -0,0 +1,213 @@
+"""Microbenchmarks for the game math that runs for every kingdom on every tick
+
+Runs offline against synthetic kingdoms built from uas.INITIAL_KINGDOM_STATE, so no
+function app or database is needed. Backend reads made by the income functions are
+replaced with synthetic queues of the benchmarked length.
+
+    python benchmarks/bench_game_math.py
+    python benchmarks/bench_game_math.py --save benchmarks/baseline.json
+    python benchmarks/bench_game_math.py --compare benchmarks/baseline.json --threshold 0.2
+
+--compare exits with status 1 when any benchmark is slower than its baseline by more
+than the threshold.
+"""
+import argparse
+import contextlib
+import copy
+import datetime
+import json
+import platform
+import sys
+import timeit
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "api"))
+
+import untitledapp.build as uab
+import untitledapp.conquer as uac
+import untitledapp.getters as uag
+import untitledapp.income as uai
+import untitledapp.queues as uaq
+import untitledapp.refresh as uar
+import untitledapp.shared as uas
+
+KINGDOM_SIZES = {
+    "small": 300,
+    "medium": 3000,
+    "large": 30000,
+}
+QUEUE_LENGTHS = [0, 10, 100, 1000]
+BATCH_SIZES = [10, 100, 1000]
+TIME_NOW = datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc)
+# Synthetic mobis queue per benchmark kingdom id, served by the patched _get_mobis_queue
+MOBIS_QUEUES = {}
+
+
+def make_kingdom(stars, kd_id="1"):
+    kd_info = copy.deepcopy(uas.INITIAL_KINGDOM_STATE["kingdom"])
+    kd_info["kdId"] = kd_id
+    kd_info["race"] = "Xo"
+    kd_info["stars"] = stars
+    kd_info["population"] = stars * 80
+    kd_info["fuel"] = stars * 100
+    kd_info["money"] = stars * 1000
+    kd_info["drones"] = stars * 50
+    kd_info["last_income"] = (TIME_NOW - datetime.timedelta(seconds=uas.GAME_CONFIG["BASE_EPOCH_SECONDS"])).isoformat()
+    for key_structure in kd_info["structures"]:
+        kd_info["structures"][key_structure] = stars / len(kd_info["structures"])
+    for key_unit in kd_info["units"]:
+        kd_info["units"][key_unit] = stars * 10
+    kd_info["generals_out"] = [
+        {
+            "attack": stars * 5,
+            "flex": stars * 2,
+            "return_time": (TIME_NOW + datetime.timedelta(hours=i_general + 1)).isoformat(),
+        }
+        for i_general in range(2)
+    ]
+    return kd_info
+
+def make_mobis_queue(length):
+    return uaq.BuildQueue([
+        {
+            "time": (TIME_NOW + datetime.timedelta(minutes=15 * i_mobi)).isoformat(),
+            "attack": 10,
+            "defense": 10,
+            "flex": 5,
+        }
+        for i_mobi in range(length)
+    ])
+
+def current_bonuses(kd_info):
+    return {
+        project: project_dict.get("max_bonus", 0) * min(kd_info["projects_points"][project] / kd_info["projects_max_points"][project], 1.0)
+        for project, project_dict in uas.PROJECTS.items()
+        if "max_bonus" in project_dict
+    }
+
+@contextlib.contextmanager
+def backend_patched():
+    """Replace the backend reads made by the income functions for the whole run
+
+    Entered once around the timing loop, so the patching itself is not timed.
+    """
+    with (
+        mock.patch.object(uag, "_get_mobis_queue", new=MOBIS_QUEUES.__getitem__),
+        mock.patch.object(uar, "_resolve_siphons", new=lambda *args, **kwargs: (0, 0.0, [])),
+    ):
+        yield
+
+def benchmark_cases():
+    """Yield (name, callable) for every benchmark, reading from backend_patched()"""
+    state = {"state": {"active_policies": []}}
+    for size_name, stars in KINGDOM_SIZES.items():
+        kd_info = make_kingdom(stars)
+        bonuses = current_bonuses(kd_info)
+        total_units = {
+            key_unit: stars * 10
+            for key_unit in uas.UNITS
+        }
+        yield f"_calc_max_offense[{size_name}]", lambda: uag._calc_max_offense(total_units)
+        yield f"_calc_max_defense[{size_name}]", lambda: uag._calc_max_defense(total_units)
+        yield f"_calc_networth[{size_name}]", lambda kd_info=kd_info: uar._calc_networth(kd_info)
+        yield f"_calc_losses[{size_name}]", lambda: uac._calc_losses(total_units, 0.1)
+
+        for queue_length in QUEUE_LENGTHS:
+            mobis_queue = make_mobis_queue(queue_length)
+            case = f"{size_name},queue={queue_length}"
+            kd_info_case = {**kd_info, "kdId": case}
+            MOBIS_QUEUES[case] = mobis_queue
+            yield f"_calc_units[{case}]", lambda kd_info=kd_info, mobis_queue=mobis_queue: uag._calc_units(
+                TIME_NOW,
+                kd_info["units"],
+                kd_info["generals_out"],
+                mobis_queue,
+            )
+
+            yield f"_calc_pop_change_per_epoch[{case}]", lambda kd_info_case=kd_info_case: uar._calc_pop_change_per_epoch(
+                kd_info_case,
+                False,
+                1.0,
+            )
+            yield f"_kingdom_with_income[{case}]", lambda kd_info_case=kd_info_case, bonuses=bonuses: uar._kingdom_with_income(
+                copy.deepcopy(kd_info_case),
+                bonuses,
+                state,
+                TIME_NOW,
+            )
+
+    for num_splits in [2, 12, 48]:
+        yield f"_make_time_splits[splits={num_splits}]", lambda num_splits=num_splits: uab._make_time_splits(0.5, 1.5, num_splits)
+
+    for batch_size in BATCH_SIZES:
+        kd_infos = [make_kingdom(KINGDOM_SIZES["medium"], str(kd_id)) for kd_id in range(batch_size)]
+        bonuses = [current_bonuses(kd_info) for kd_info in kd_infos]
+        yield f"calc_income_batch[kingdoms={batch_size}]", lambda kd_infos=kd_infos, bonuses=bonuses: uai.calc_income_batch(
+            kd_infos,
+            bonuses,
+            state,
+            TIME_NOW,
+        )
+
+def run_benchmarks(name_filter=None, repeat=5):
+    """Return the best seconds per call for each benchmark"""
+    results = {}
+    with backend_patched():
+        for name, func in benchmark_cases():
+            if name_filter and name_filter not in name:
+                continue
+            timer = timeit.Timer(func)
+            number, _ = timer.autorange()
+            results[name] = min(timer.repeat(repeat=repeat, number=number)) / number
+    return results
+
+def compare_to_baseline(results, baseline, threshold):
+    """Return (name, baseline seconds, current seconds) for benchmarks slower than baseline by more than threshold"""
+    regressions = []
+    for name, seconds in results.items():
+        baseline_seconds = baseline["results"].get(name)
+        if baseline_seconds and seconds > baseline_seconds * (1 + threshold):
+            regressions.append((name, baseline_seconds, seconds))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--save", type=Path, help="write the results to this JSON baseline")
+    parser.add_argument("--compare", type=Path, help="compare the results against this JSON baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown against the baseline, 0.2 is 20%%")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.filter, args.repeat)
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    for name, seconds in results.items():
+        line = f"{name:<60} {seconds * 1e6:>12.2f} us"
+        if baseline and name in baseline["results"]:
+            line += f" {seconds / baseline['results'][name]:>7.2f}x"
+        print(line)
+
+    if args.save:
+        args.save.parent.mkdir(parents=True, exist_ok=True)
+        args.save.write_text(json.dumps(
+            {
+                "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": results,
+            },
+            indent=2,
+        ))
+
+    if baseline:
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+        for name, baseline_seconds, seconds in regressions:
+            print(f"REGRESSION {name}: {baseline_seconds * 1e6:.2f} us -> {seconds * 1e6:.2f} us")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,378 @@
+"""Headless round simulator that drives the real API with scripted bot kingdoms
+
+Creates a round of bot kingdoms through the API routes, then alternates a turn of
+bot actions with a tick of /api/refreshdata, reporting throughput and where the
+time went. Storage is the in-process "memory" backend from untitledapp.storage,
+so no Azure services are needed, and the round runs at --speed so timers
+resolve faster than real time.
+
+    python benchmarks/simulate_round.py --kingdoms 100 --turns 20
+    python benchmarks/simulate_round.py --kingdoms 1000 --turns 5 --strategies explorer=2,attacker=1,thief=1
+    python benchmarks/simulate_round.py --kingdoms 100 --turns 20 --save benchmarks/round.json
+
+Strategies:
+    explorer  enables auto spending, settles and builds structures
+    attacker  recruits, trains attackers and attacks kingdoms in other galaxies
+    thief     spies on kingdoms in other galaxies and auto robs primitives
+
+Every bot also buys votes and casts them during elections.
+"""
+import argparse
+import collections
+import datetime
+import functools
+import json
+import logging
+import math
+import os
+import platform
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "api"))
+
+import untitledapp
+import untitledapp.build as uab
+import untitledapp.conquer as uac
+import untitledapp.getters as uag
+import untitledapp.misc as uam
+import untitledapp.politics as uap
+import untitledapp.refresh as uar
+import untitledapp.shared as uas
+
+REFRESH_SECRET = "simulation"
+STRATEGIES = ["explorer", "attacker", "thief"]
+# Functions timed for the report, inclusive of anything they call
+PROFILED = {
+    uar: [
+        "_refresh_tick",
+        "_refresh_kd",
+        "_refresh_kd_income",
+        "_refresh_income_batch",
+        "_resolve_auto_spending",
+        "_resolve_auto_attack",
+        "_resolve_auto_rob",
+        "_resolve_schedules",
+        "_resolve_scores",
+        "_resolve_empires",
+        "_update_history",
+        "_begin_election",
+        "_resolve_election",
+    ],
+    uac: ["_attack", "_spy", "_rob_primitives"],
+    uag: ["_get_kd_info", "_get_state", "_batch_read", "_batch_patch"],
+    uam: ["acquire_locks", "release_locks_by_id"],
+}
+UNITS_CHOICES = {
+    "drones": 6000,
+    "recruits": 0,
+    "attack": 1000,
+    "defense": 1000,
+    "flex": 500,
+    "engineers": 0,
+}
+
+
+class Profiler:
+    """Count calls and inclusive seconds of module functions by replacing them with timed wrappers"""
+
+    def __init__(self):
+        self.stats = collections.defaultdict(lambda: {"calls": 0, "seconds": 0.0})
+
+    def wrap(self, module, name):
+        func = getattr(module, name)
+        stats = self.stats[f"{module.__name__.split('.')[-1]}.{name}"]
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats["calls"] += 1
+                stats["seconds"] += time.perf_counter() - start
+
+        setattr(module, name, timed)
+
+
+class Bot:
+    def __init__(self, client, name, strategy, token):
+        self.client = client
+        self.name = name
+        self.strategy = strategy
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.kd_id = None
+
+    def get(self, path):
+        return self.client.get(path, headers=self.headers)
+
+    def post(self, path, body):
+        return self.client.post(path, headers=self.headers, json=body)
+
+
+class Simulation:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.profiler = Profiler()
+        self.actions = collections.Counter()
+        self.statuses = collections.Counter()
+        self.errors = collections.Counter()
+        self.action_seconds = 0.0
+        self.tick_seconds = []
+
+        os.environ["REFRESH_SECRET"] = REFRESH_SECRET
+        self.app = untitledapp.create_app("config.SimulationConfig")
+        self.app.logger.setLevel(logging.ERROR)
+        self.backend = self.app.extensions["storage"]
+        self.client = self.app.test_client()
+        for module, names in PROFILED.items():
+            for name in names:
+                self.profiler.wrap(module, name)
+
+    def _call(self, action, func, *args):
+        """Run one API call, counting it by action and status. Returns the JSON body of a 200 or None"""
+        self.actions[action] += 1
+        try:
+            response = func(*args)
+        except Exception as e:
+            self.errors[f"{action}: {type(e).__name__}: {e}"] += 1
+            return None
+        self.statuses[f"{action} {response.status_code}"] += 1
+        if response.status_code >= 500:
+            self.errors[f"{action}: {response.status_code}"] += 1
+        if response.status_code != 200:
+            return None
+        return response.get_json(silent=True)
+
+    def setup(self):
+        args = self.args
+        strategies = [
+            strategy
+            for strategy, weight in args.strategies.items()
+            for _ in range(weight)
+        ]
+        with self.app.app_context():
+            untitledapp.db.drop_all()
+            untitledapp.db.create_all()
+            guard = untitledapp.guard
+            users = [untitledapp.User(username="admin", password="", roles="operator,admin", kd_created=True)]
+            users.extend(
+                untitledapp.User(username=f"bot{i_bot}", password="", roles="operator")
+                for i_bot in range(args.kingdoms)
+            )
+            untitledapp.db.session.add_all(users)
+            untitledapp.db.session.commit()
+            admin = Bot(self.client, "admin", None, guard.encode_jwt_token(users[0]))
+            self.bots = [
+                Bot(self.client, user.username, strategies[i_bot % len(strategies)], guard.encode_jwt_token(user))
+                for i_bot, user in enumerate(users[1:])
+            ]
+
+        time_now = datetime.datetime.now(datetime.timezone.utc)
+        self._call("admin resetstate", admin.post, "/api/resetstate", {})
+        self._call("admin createstate", admin.post, "/api/createstate", {
+            "num_galaxies": math.ceil(args.kingdoms / args.galaxy_size),
+            "max_galaxy_size": args.galaxy_size,
+            "avg_size_new_galaxy": args.galaxy_size,
+        })
+        self._call("admin updatestate", admin.post, "/api/updatestate", {
+            "game_start": time_now.isoformat(),
+            "game_end": (time_now + datetime.timedelta(days=365)).isoformat(),
+            "election_start": time_now.isoformat(),
+            "election_end": "",
+            "next_history": time_now.isoformat(),
+            "speed": args.speed,
+        })
+
+        stars = uas.INITIAL_KINGDOM_STATE["kingdom"]["stars"]
+        structures_choices = {
+            structure: stars // len(uas.STRUCTURES) + int(i_structure < stars % len(uas.STRUCTURES))
+            for i_structure, structure in enumerate(uas.STRUCTURES)
+        }
+        for bot in self.bots:
+            self._call("createkingdom", bot.post, "/api/createkingdom", {"kdName": bot.name})
+            self._call("createkingdomchoices", bot.post, "/api/createkingdomchoices", {
+                "unitsChoices": UNITS_CHOICES,
+                "structuresChoices": structures_choices,
+                "race": self.rng.choice(uas.RACES),
+            })
+        with self.app.app_context():
+            for bot in self.bots:
+                bot.kd_id = untitledapp.User.lookup(bot.name).kd_id
+            galaxies_inverted, _ = uag._get_galaxies_inverted()
+        self.galaxies = {bot.kd_id: galaxies_inverted.get(bot.kd_id) for bot in self.bots}
+
+        for bot in self.bots:
+            if bot.strategy == "explorer":
+                self._call("spending", bot.post, "/api/spending", {"enabled": True})
+                self._call("spending", bot.post, "/api/spending", {"settle": 40, "structures": 40, "military": 20})
+            elif bot.strategy == "thief":
+                self._call("robprimitives/auto", bot.post, "/api/robprimitives/auto", {"drones": 5, "keep": 5, "shielded": False})
+                self._call("robprimitives/auto", bot.post, "/api/robprimitives/auto", {"enabled": True})
+
+    def _target(self, bot):
+        targets = [
+            other.kd_id
+            for other in self.rng.sample(self.bots, min(len(self.bots), 8))
+            if other.kd_id is not None and self.galaxies[other.kd_id] != self.galaxies[bot.kd_id]
+        ]
+        return targets[0] if targets else None
+
+    def turn(self, bot, electing):
+        if bot.strategy == "explorer":
+            settle = self._call("GET settle", bot.get, "/api/settle")
+            if settle and settle["current_available_settle"] > 0:
+                self._call("settle", bot.post, "/api/settle", {
+                    "settleInput": self.rng.randint(1, settle["current_available_settle"]),
+                })
+            structures = self._call("GET structures", bot.get, "/api/structures")
+            if structures and structures["current_available_structures"] > 0:
+                self._call("structures", bot.post, "/api/structures", {
+                    self.rng.choice(uas.STRUCTURES): self.rng.randint(1, structures["current_available_structures"]),
+                })
+        elif bot.strategy == "attacker":
+            mobis = self._call("GET mobis", bot.get, "/api/mobis")
+            if mobis and mobis["current_available_recruits"] > 0:
+                self._call("recruits", bot.post, "/api/recruits", {
+                    "recruitsInput": self.rng.randint(1, mobis["current_available_recruits"]),
+                })
+            if mobis and mobis["units"]["current_total"]["recruits"] > 0:
+                self._call("mobis", bot.post, "/api/mobis", {
+                    "attack": self.rng.randint(1, int(mobis["units"]["current_total"]["recruits"])),
+                })
+            target = self._target(bot)
+            if mobis and target is not None:
+                available = mobis["units"]["current_total"]
+                self._call("attack", bot.post, f"/api/attack/{target}", {"attackerValues": {
+                    "attack": int(available.get("attack", 0) // 2),
+                    "flex": int(available.get("flex", 0) // 2),
+                    "generals": 1,
+                }})
+        elif bot.strategy == "thief":
+            target = self._target(bot)
+            if target is not None:
+                self._call("spy", bot.post, f"/api/spy/{target}", {
+                    "drones": 100,
+                    "shielded": False,
+                    "operation": self.rng.choice(uas.REVEAL_OPERATIONS + uas.AGGRO_OPERATIONS),
+                })
+
+        if electing:
+            self._call("votes", bot.post, "/api/votes", {"votes": 1})
+            self._call("universepolitics/policies", bot.post, "/api/universepolitics/policies", {
+                "votes": 1,
+                "policy": self.rng.choice(["policy_1", "policy_2"]),
+                "option": self.rng.choice(["option_1", "option_2"]),
+            })
+
+    def tick(self):
+        start = time.perf_counter()
+        self._call("refreshdata", lambda: self.client.get("/api/refreshdata", headers={"Refresh-Secret": REFRESH_SECRET}))
+        self.tick_seconds.append(time.perf_counter() - start)
+
+    def run(self):
+        setup_start = time.perf_counter()
+        self.setup()
+        setup_seconds = time.perf_counter() - setup_start
+        setup_actions = sum(self.actions.values())
+
+        round_start = time.perf_counter()
+        for _ in range(self.args.turns):
+            with self.app.app_context():
+                electing = uag._get_state()["state"].get("election_end", "") != ""
+            turn_start = time.perf_counter()
+            for bot in self.rng.sample(self.bots, len(self.bots)):
+                self.turn(bot, electing)
+            self.action_seconds += time.perf_counter() - turn_start
+            self.tick()
+        round_seconds = time.perf_counter() - round_start
+
+        with self.app.app_context():
+            tick_stats = uar._get_tick_stats()
+        num_actions = sum(self.actions.values()) - setup_actions - len(self.tick_seconds)
+        return {
+            "machine": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+            },
+            "kingdoms": self.args.kingdoms,
+            "turns": self.args.turns,
+            "speed": self.args.speed,
+            "strategies": self.args.strategies,
+            "setup_seconds": setup_seconds,
+            "round_seconds": round_seconds,
+            "game_seconds": round_seconds * self.args.speed,
+            "actions": num_actions,
+            "actions_per_second": num_actions / self.action_seconds if self.action_seconds else 0.0,
+            "ticks": len(self.tick_seconds),
+            "ticks_per_second": len(self.tick_seconds) / sum(self.tick_seconds) if self.tick_seconds else 0.0,
+            "tick_stats": tick_stats,
+            "statuses": dict(sorted(self.statuses.items())),
+            "errors": dict(self.errors.most_common()),
+            "functions": dict(sorted(self.profiler.stats.items(), key=lambda item: -item[1]["seconds"])),
+            "backend": dict(sorted(self.backend.stats.items(), key=lambda item: -item[1]["seconds"])),
+        }
+
+
+def print_report(results):
+    print(f"{results['kingdoms']} kingdoms, {results['turns']} turns at speed {results['speed']}")
+    print(f"setup          {results['setup_seconds']:10.2f}s")
+    print(f"round          {results['round_seconds']:10.2f}s ({results['game_seconds'] / 3600:.2f} game hours)")
+    print(f"actions        {results['actions']:10d} ({results['actions_per_second']:.1f}/s)")
+    print(f"ticks          {results['ticks']:10d} ({results['ticks_per_second']:.2f}/s, p90 {results['tick_stats']['seconds']['p90']:.3f}s, behind {results['tick_stats']['behind']})")
+    print()
+    print(f"{'function':40s} {'calls':>8s} {'total s':>10s} {'mean ms':>10s}")
+    for name, stats in results["functions"].items():
+        if stats["calls"]:
+            print(f"{name:40s} {stats['calls']:8d} {stats['seconds']:10.3f} {1000 * stats['seconds'] / stats['calls']:10.3f}")
+    print()
+    print(f"{'backend route':40s} {'requests':>8s} {'total s':>10s} {'mean ms':>10s}")
+    for name, stats in results["backend"].items():
+        print(f"{name:40s} {stats['requests']:8d} {stats['seconds']:10.3f} {1000 * stats['seconds'] / stats['requests']:10.3f}")
+    print()
+    print(f"{'action status':40s} {'count':>8s}")
+    for name, count in results["statuses"].items():
+        print(f"{name:40s} {count:8d}")
+    if results["errors"]:
+        print()
+        print("errors")
+        for name, count in results["errors"].items():
+            print(f"{count:8d} {name}")
+
+
+def parse_strategies(value):
+    strategies = {}
+    for part in value.split(","):
+        strategy, _, weight = part.partition("=")
+        if strategy not in STRATEGIES:
+            raise argparse.ArgumentTypeError(f"Unknown strategy {strategy}, expected one of {', '.join(STRATEGIES)}")
+        strategies[strategy] = int(weight or 1)
+    return strategies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--kingdoms", type=int, default=100)
+    parser.add_argument("--turns", type=int, default=10, help="Turns of bot actions, each followed by a tick")
+    parser.add_argument("--strategies", type=parse_strategies, default="explorer=1,attacker=1,thief=1")
+    parser.add_argument("--speed", type=float, default=uas.GAME_SPEEDS["hyper"], help="Round speed multiplier")
+    parser.add_argument("--galaxy-size", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="Write the results as JSON to this path")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    results = Simulation(args).run()
+    print_report(results)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved results to {args.save}")
+    return 1 if results["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,9 +3,11 @@ import logging
 import os
 import json
 import datetime
-from collections import defaultdict
+import bisect
+from collections import Counter, defaultdict
 
-from azure.cosmos import CosmosClient, PartitionKey
+from azure.core import MatchConditions
+from azure.cosmos import CosmosClient, PartitionKey, exceptions
 
 ENDPOINT = os.environ["COSMOS_ENDPOINT"]
 KEY = os.environ["COSMOS_KEY"]
@@ -30,6 +32,75 @@ RESET_KEEP_IDS = [
     "scores",
 ]
 
+PATCH_OPERATIONS = {"add", "set", "replace", "remove", "incr"}
+MAX_PATCH_OPERATIONS = 10
+
+def _path(*keys):
+    """JSON pointer to a nested key, escaping keys that contain ~ or /"""
+    return "".join(
+        "/" + str(key).replace("~", "~0").replace("/", "~1")
+        for key in keys
+    )
+
+def _merge_operations(fields, *keys):
+    """set operations that merge fields into the object at keys, leaving the item's system keys alone"""
+    return [
+        {"op": "set", "path": _path(*keys, key), "value": value}
+        for key, value in fields.items()
+        if keys or (key != "id" and not key.startswith("_"))
+    ]
+
+def _patch_item(item_id, operations, etag=None, filter_predicate=None):
+    """Apply partial-document operations to an item and return the patched item
+
+    Cosmos takes at most MAX_PATCH_OPERATIONS per patch, so longer lists are sent
+    as chunks in one transactional batch on the item's partition. etag and
+    filter_predicate guard the first chunk, which is enough inside a batch.
+    """
+    for operation in operations:
+        if operation.get("op") not in PATCH_OPERATIONS or not operation.get("path", "").startswith("/"):
+            raise ValueError(f"Invalid patch operation {operation}")
+    if not operations:
+        return CONTAINER.read_item(
+            item=item_id,
+            partition_key=item_id,
+        )
+    if len(operations) <= MAX_PATCH_OPERATIONS:
+        kwargs = {}
+        if etag is not None:
+            kwargs.update(etag=etag, match_condition=MatchConditions.IfNotModified)
+        if filter_predicate is not None:
+            kwargs["filter_predicate"] = filter_predicate
+        return CONTAINER.patch_item(
+            item=item_id,
+            partition_key=item_id,
+            patch_operations=operations,
+            **kwargs,
+        )
+    batch_operations = []
+    for i_chunk in range(0, len(operations), MAX_PATCH_OPERATIONS):
+        kwargs = {}
+        if i_chunk == 0 and etag is not None:
+            kwargs["if_match_etag"] = etag
+        if i_chunk == 0 and filter_predicate is not None:
+            kwargs["filter_predicate"] = filter_predicate
+        batch_operations.append((
+            "patch",
+            (item_id, operations[i_chunk:i_chunk + MAX_PATCH_OPERATIONS]),
+            kwargs,
+        ))
+    try:
+        results = CONTAINER.execute_item_batch(
+            batch_operations=batch_operations,
+            partition_key=item_id,
+        )
+    except exceptions.CosmosBatchOperationError as e:
+        # Surface a failed precondition the same way a single patch does
+        if e.operation_responses[e.error_index].get("statusCode") == 412:
+            raise exceptions.CosmosAccessConditionFailedError(message=f"{item_id} was modified concurrently")
+        raise
+    return results[-1]["resourceBody"]
+
 @APP.function_name(name="DeleteAll")
 @APP.route(route="deleteall", auth_level=func.AuthLevel.ADMIN, methods=["POST"])
 def delete_all(req: func.HttpRequest) -> func.HttpResponse:
@@ -142,18 +213,7 @@ def get_state(req: func.HttpRequest) -> func.HttpResponse:
 def update_state(req: func.HttpRequest) -> func.HttpResponse:
     req_body = req.get_json()
     try:
-        state = CONTAINER.read_item(
-            item="state",
-            partition_key="state",
-        )
-        state["state"] = {
-            **state["state"],
-            **req_body,
-        }
-        CONTAINER.replace_item(
-            "state",
-            state,
-        )
+        _patch_item("state", _merge_operations(req_body, "state"))
         return func.HttpResponse(
             "Updated state",
             status_code=200,
@@ -228,6 +288,7 @@ def reset_state(req: func.HttpRequest) -> func.HttpResponse:
             partition_key="universe_news"
         )
         universe_news["news"] = []
+        universe_news["pages"] = []
         CONTAINER.replace_item(
             "universe_news",
             universe_news,
@@ -300,15 +361,7 @@ def get_accounts(req: func.HttpRequest) -> func.HttpResponse:
 def update_accounts(req: func.HttpRequest) -> func.HttpResponse:
     req_body = req.get_json()
     try:
-        accounts = CONTAINER.read_item(
-            item="accounts",
-            partition_key="accounts",
-        )
-        accounts["accounts"] = req_body["accounts"]
-        CONTAINER.replace_item(
-            "accounts",
-            accounts,
-        )
+        _patch_item("accounts", [{"op": "set", "path": "/accounts", "value": req_body["accounts"]}])
         return func.HttpResponse(
             "Updated accounts",
             status_code=200,
@@ -342,18 +395,7 @@ def get_scores(req: func.HttpRequest) -> func.HttpResponse:
 def update_scores(req: func.HttpRequest) -> func.HttpResponse:
     req_body = req.get_json()
     try:
-        scores = CONTAINER.read_item(
-            item="scores",
-            partition_key="scores",
-        )
-        new_scores = {
-            **scores,
-            **req_body,
-        }
-        CONTAINER.replace_item(
-            "scores",
-            new_scores,
-        )
+        _patch_item("scores", _merge_operations(req_body))
         return func.HttpResponse(
             "Updated scores",
             status_code=200,
@@ -377,11 +419,7 @@ def create_galaxy(req: func.HttpRequest) -> func.HttpResponse:
 
         galaxy_id = str(req.route_params.get('galaxyId'))
         if galaxy_id not in galaxies["galaxies"].keys():
-            galaxies["galaxies"][galaxy_id] = []
-            CONTAINER.replace_item(
-                galaxies_id,
-                galaxies,
-            )
+            _patch_item(galaxies_id, [{"op": "set", "path": _path("galaxies", galaxy_id), "value": []}])
             CONTAINER.create_item(
                 {
                     "id": f"galaxy_news_{galaxy_id}",
@@ -433,21 +471,12 @@ def create_kingdom(req: func.HttpRequest) -> func.HttpResponse:
         )
     try:
         kd_id = str(len(existing_kds["kingdoms"]))
-        existing_kds["kingdoms"][kd_id] = kd_name
-        CONTAINER.replace_item(
+        _patch_item(
             "kingdoms",
-            existing_kds,
-        )
-
-        galaxies = CONTAINER.read_item(
-            item="galaxies",
-            partition_key="galaxies",
-        )
-        galaxies["galaxies"][galaxy].append(kd_id)
-        CONTAINER.replace_item(
-            "galaxies",
-            galaxies,
+            [{"op": "set", "path": _path("kingdoms", kd_id), "value": kd_name}],
+            etag=existing_kds["_etag"],
         )
+        _patch_item("galaxies", [{"op": "add", "path": _path("galaxies", galaxy, "-"), "value": kd_id}])
 
         for resource_name in [
             "kingdom",
@@ -532,6 +561,10 @@ def create_item(req: func.HttpRequest) -> func.HttpResponse:
             f"Successfully created {item} state",
             status_code=201,
         )
+    # Pages and buckets sealed from the old contents do not belong to the new state
+    for index_key in ["pages", "buckets"]:
+        if index_key in item_contents:
+            item_contents[index_key] = []
     try:
         CONTAINER.replace_item(
             item,
@@ -550,6 +583,44 @@ def create_item(req: func.HttpRequest) -> func.HttpResponse:
             status_code=500,
         )
 
+@APP.function_name(name="PatchItem")
+@APP.route(route="item/{itemId}", auth_level=func.AuthLevel.ADMIN, methods=["PATCH"])
+def patch_item(req: func.HttpRequest) -> func.HttpResponse:
+    """Apply the "operations" list of add, set, replace, remove and incr operations to an item
+
+    Each operation is {"op", "path", "value"} with a JSON pointer path, so callers
+    send only what changed instead of the whole document.
+    """
+    logging.info('Python HTTP trigger function processed a patch item request.')
+    req_body = req.get_json()
+    item_id = str(req.route_params.get('itemId'))
+    operations = req_body.get("operations", [])
+    try:
+        item = _patch_item(item_id, operations)
+    except ValueError as e:
+        return func.HttpResponse(
+            str(e),
+            status_code=400,
+        )
+    except:
+        return func.HttpResponse(
+            f"{item_id} was not patched",
+            status_code=500,
+        )
+    if item_id.startswith("kingdom_") and not _reschedule_kingdom(
+        item_id.removeprefix("kingdom_"),
+        item,
+        {operation["path"].split("/")[1]: None for operation in operations},
+    ):
+        return func.HttpResponse(
+            f"{item_id} was patched but could not be rescheduled",
+            status_code=500,
+        )
+    return func.HttpResponse(
+        json.dumps(item),
+        status_code=200,
+    )
+
 @APP.function_name(name="GetKingdoms")
 @APP.route(route="kingdoms", auth_level=func.AuthLevel.ADMIN, methods=["GET"])
 def get_kingdoms(req: func.HttpRequest) -> func.HttpResponse:
@@ -577,16 +648,8 @@ def update_kingdoms(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed an update kingdoms request.')    
     req_body = req.get_json()
     item_id = f"kingdoms"
-    kingdoms = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        update_kd = {**kingdoms, **req_body}
-        CONTAINER.replace_item(
-            item_id,
-            update_kd,
-        )
+        _patch_item(item_id, _merge_operations(req_body))
         return func.HttpResponse(
             "Kingdoms updated.",
             status_code=200,
@@ -648,16 +711,8 @@ def update_galaxy_politics(req: func.HttpRequest) -> func.HttpResponse:
     req_body = req.get_json()
     galaxy_id = str(req.route_params.get('galaxy_id'))
     item_id = f"galaxy_votes_{galaxy_id}"
-    galaxy_votes = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        update_galaxy_votes = {**galaxy_votes, **req_body}
-        CONTAINER.replace_item(
-            item_id,
-            update_galaxy_votes,
-        )
+        _patch_item(item_id, _merge_operations(req_body))
         return func.HttpResponse(
             "Galaxy politics updated.",
             status_code=200,
@@ -698,16 +753,8 @@ def update_empire_politics(req: func.HttpRequest) -> func.HttpResponse:
     req_body = req.get_json()
     empire_id = str(req.route_params.get('empire_id'))
     item_id = f"empire_politics_{empire_id}"
-    empire_politics = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        update_empire_politics = {**empire_politics, **req_body}
-        CONTAINER.replace_item(
-            item_id,
-            update_empire_politics,
-        )
+        _patch_item(item_id, _merge_operations(req_body))
         return func.HttpResponse(
             "Empire politics updated.",
             status_code=200,
@@ -746,16 +793,8 @@ def update_universe_politics(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a universe politics update request.')    
     req_body = req.get_json()
     item_id = f"universe_votes"
-    universe_votes = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        update_universe_votes = {**universe_votes, **req_body}
-        CONTAINER.replace_item(
-            item_id,
-            update_universe_votes,
-        )
+        _patch_item(item_id, _merge_operations(req_body))
         return func.HttpResponse(
             "Universe politics updated.",
             status_code=200,
@@ -801,10 +840,9 @@ def create_empire(req: func.HttpRequest) -> func.HttpResponse:
     )
     try:
         empire_id = str(len(empires["empires"]))
-        empires["empires"][empire_id] = {
+        new_empire = {
             "name": empire_name,
             "galaxies": [galaxy_id],
-            "aggression": {},
             "num_kingdoms": 0,
             "aggression_max": 999,
             "war": [],
@@ -814,9 +852,10 @@ def create_empire(req: func.HttpRequest) -> func.HttpResponse:
             "surprise_war_penalty": False,
             "surprise_war_penalty_expires": "",
         }
-        CONTAINER.replace_item(
+        _patch_item(
             "empires",
-            empires,
+            [{"op": "set", "path": _path("empires", empire_id), "value": new_empire}],
+            etag=empires["_etag"],
         )
         CONTAINER.create_item(
             {
@@ -836,6 +875,12 @@ def create_empire(req: func.HttpRequest) -> func.HttpResponse:
                 "news": [],
             }
         )
+        CONTAINER.create_item(
+            {
+                "id": f"empire_aggression_{empire_id}",
+                "aggression": {},
+            }
+        )
         return func.HttpResponse(
             empire_id,
             status_code=201,
@@ -853,23 +898,231 @@ def update_empires(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed an update empires request.')    
     req_body = req.get_json()
     item_id = f"empires"
+    try:
+        _patch_item(item_id, _merge_operations(req_body))
+        return func.HttpResponse(
+            "Empires updated.",
+            status_code=200,
+        )
+    except:
+        return func.HttpResponse(
+            "The empires were not updated",
+            status_code=500,
+        )
+
+AGGRESSION_PATCH_RETRIES = 10
+
+def _read_empire_aggression(empire_id):
+    item_id = f"empire_aggression_{empire_id}"
+    try:
+        return CONTAINER.read_item(
+            item=item_id,
+            partition_key=item_id,
+        )
+    except exceptions.CosmosResourceNotFoundError:
+        pass
+
+    # Empires created before aggression was split out keep it on the empires item
     empires = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
+        item="empires",
+        partition_key="empires",
     )
+    aggression = empires["empires"].get(empire_id, {}).get("aggression", {})
     try:
-        update_kd = {**empires, **req_body}
-        CONTAINER.replace_item(
-            item_id,
-            update_kd,
+        return CONTAINER.create_item(
+            {
+                "id": item_id,
+                "aggression": aggression,
+            }
+        )
+    except exceptions.CosmosResourceExistsError:
+        return CONTAINER.read_item(
+            item=item_id,
+            partition_key=item_id,
+        )
+
+def _apply_aggression_ops(aggression, req_body):
+    for target_empire, value in req_body.get("set", {}).items():
+        aggression[target_empire] = value
+    for target_empire, delta in req_body.get("deltas", {}).items():
+        aggression[target_empire] = aggression.get(target_empire, 0) + delta
+    decay = req_body.get("decay", 0)
+    if decay:
+        for target_empire, value in aggression.items():
+            aggression[target_empire] = max(value - decay, 0)
+    return aggression
+
+@APP.function_name(name="GetEmpireAggression")
+@APP.route(route="empire/{empireId}/aggression", auth_level=func.AuthLevel.ADMIN, methods=["GET"])
+def get_empire_aggression(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('Python HTTP trigger function processed a get empire aggression request.')    
+    empire_id = str(req.route_params.get('empireId'))
+    try:
+        empire_aggression = _read_empire_aggression(empire_id)
+        return func.HttpResponse(
+            json.dumps(empire_aggression),
+            status_code=201,
         )
+    except:
         return func.HttpResponse(
-            "Empires updated.",
+            "Could not retrieve empire aggression",
+            status_code=500,
+        )
+
+@APP.function_name(name="UpdateEmpireAggression")
+@APP.route(route="empire/{empireId}/aggression", auth_level=func.AuthLevel.ADMIN, methods=["PATCH"])
+def update_empire_aggression(req: func.HttpRequest) -> func.HttpResponse:
+    """Apply set, deltas and decay to an empire's aggression atomically
+
+    set and deltas are sent as set and incr operations. decay depends on every
+    value, so the item is replaced only if it has not changed since it was read,
+    and the operations are reapplied to a fresh read when another writer got
+    there first.
+    """
+    logging.info('Python HTTP trigger function processed an update empire aggression request.')    
+    req_body = req.get_json()
+    empire_id = str(req.route_params.get('empireId'))
+    item_id = f"empire_aggression_{empire_id}"
+    try:
+        if not req_body.get("decay", 0):
+            operations = [
+                *_merge_operations(req_body.get("set", {}), "aggression"),
+                *(
+                    {"op": "incr", "path": _path("aggression", target_empire), "value": delta}
+                    for target_empire, delta in req_body.get("deltas", {}).items()
+                ),
+            ]
+            if "last_update" in req_body:
+                operations.append({"op": "set", "path": "/last_update", "value": req_body["last_update"]})
+            try:
+                empire_aggression = _patch_item(item_id, operations)
+            except exceptions.CosmosResourceNotFoundError:
+                _read_empire_aggression(empire_id)
+                empire_aggression = _patch_item(item_id, operations)
+            return func.HttpResponse(
+                json.dumps(empire_aggression),
+                status_code=200,
+            )
+        for _ in range(AGGRESSION_PATCH_RETRIES):
+            empire_aggression = _read_empire_aggression(empire_id)
+            empire_aggression["aggression"] = _apply_aggression_ops(
+                empire_aggression.get("aggression", {}),
+                req_body,
+            )
+            if "last_update" in req_body:
+                empire_aggression["last_update"] = req_body["last_update"]
+            try:
+                CONTAINER.replace_item(
+                    item_id,
+                    empire_aggression,
+                    etag=empire_aggression["_etag"],
+                    match_condition=MatchConditions.IfNotModified,
+                )
+            except exceptions.CosmosAccessConditionFailedError:
+                continue
+            return func.HttpResponse(
+                json.dumps(empire_aggression),
+                status_code=200,
+            )
+        return func.HttpResponse(
+            "The empire aggression was modified concurrently",
+            status_code=409,
+        )
+    except:
+        return func.HttpResponse(
+            "The empire aggression was not updated",
+            status_code=500,
+        )
+
+RESOLVE_SCHEDULE_KEYS = {"next_resolve", "schedule", "auto_attack_enabled", "auto_rob_enabled", "status", "resolve_due"}
+RESOLVE_SCHEDULE_RETRIES = 10
+DUE_KINGDOMS_QUERY = (
+    "SELECT VALUE c.kdId FROM c WHERE c.type = 'kingdom'"
+    " AND IS_NUMBER(c.resolve_due) AND c.resolve_due <= @before"
+)
+SCHEDULED_KINGDOMS_QUERY = "SELECT VALUE COUNT(1) FROM c WHERE c.type = 'kingdom' AND IS_NUMBER(c.resolve_due)"
+
+def _kingdom_due_time(kd):
+    """Earliest epoch second the refresh has work for a kingdom, or None if it never will"""
+    if kd.get("status", "").lower() == "dead":
+        return None
+    if kd.get("auto_attack_enabled") or kd.get("auto_rob_enabled"):
+        return 0.0
+    due_times = [
+        *kd.get("next_resolve", {}).values(),
+        *(schedule["time"] for schedule in kd.get("schedule", [])),
+    ]
+    if not due_times:
+        return None
+    return min(
+        datetime.datetime.fromisoformat(due_time).timestamp()
+        for due_time in due_times
+    )
+
+def _schedule_kingdom(kd_id, kd):
+    """Keep a kingdom's resolve_due in step with the rest of its item
+
+    The due time lives on the kingdom item, so rescheduling writes only that
+    kingdom's partition and the schedule is a query over kingdoms. The due time
+    is set only on the version of the item it was computed from, and recomputed
+    from a fresh read when another writer got there first.
+    """
+    item_id = f"kingdom_{kd_id}"
+    for _ in range(RESOLVE_SCHEDULE_RETRIES):
+        due_time = _kingdom_due_time(kd)
+        if kd.get("resolve_due") == due_time:
+            return kd
+        try:
+            return _patch_item(
+                item_id,
+                [{"op": "set", "path": "/resolve_due", "value": due_time}],
+                etag=kd["_etag"],
+            )
+        except exceptions.CosmosAccessConditionFailedError:
+            kd = CONTAINER.read_item(
+                item=item_id,
+                partition_key=item_id,
+            )
+    raise exceptions.CosmosAccessConditionFailedError(message=f"Could not reschedule kingdom {kd_id}")
+
+def _reschedule_kingdom(kd_id, kd, patch):
+    """Reschedule a kingdom after a write that touched its due time, returning False if that failed"""
+    if RESOLVE_SCHEDULE_KEYS.isdisjoint(patch.keys()):
+        return True
+    try:
+        _schedule_kingdom(kd_id, kd)
+    except:
+        logging.exception(f"Could not reschedule kingdom {kd_id}")
+        return False
+    return True
+
+@APP.function_name(name="GetDueKingdoms")
+@APP.route(route="resolveschedule", auth_level=func.AuthLevel.ADMIN, methods=["GET"])
+def get_due_kingdoms(req: func.HttpRequest) -> func.HttpResponse:
+    """Kingdoms with work due at or before the "before" param
+
+    A kingdom stays due until it is rescheduled, so a refresh that fails
+    partway picks the kingdom up again on the next tick
+    """
+    logging.info('Python HTTP trigger function processed a get due kingdoms request.')    
+    try:
+        before = datetime.datetime.fromisoformat(req.params.get("before")).timestamp()
+        due_kds = CONTAINER.query_items(
+            query=DUE_KINGDOMS_QUERY,
+            parameters=[{"name": "@before", "value": before}],
+            enable_cross_partition_query=True,
+        )
+        scheduled = CONTAINER.query_items(
+            query=SCHEDULED_KINGDOMS_QUERY,
+            enable_cross_partition_query=True,
+        )
+        return func.HttpResponse(
+            json.dumps({"kingdoms": sorted(set(due_kds)), "scheduled": sum(scheduled)}),
             status_code=200,
         )
     except:
         return func.HttpResponse(
-            "The empires were not updated",
+            "Could not retrieve the resolve schedule",
             status_code=500,
         )
 
@@ -902,25 +1155,22 @@ def update_kingdom(req: func.HttpRequest) -> func.HttpResponse:
     req_body = req.get_json()
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"kingdom_{kd_id}"
-    kd = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        update_kd = {**kd, **req_body}
-        CONTAINER.replace_item(
-            item_id,
-            update_kd,
-        )
-        return func.HttpResponse(
-            "Kingdom updated.",
-            status_code=200,
-        )
+        update_kd = _patch_item(item_id, _merge_operations(req_body))
     except:
         return func.HttpResponse(
             "The kingdom was not updated",
             status_code=500,
         )
+    if not _reschedule_kingdom(kd_id, update_kd, req_body):
+        return func.HttpResponse(
+            "The kingdom was updated but could not be rescheduled",
+            status_code=500,
+        )
+    return func.HttpResponse(
+        "Kingdom updated.",
+        status_code=200,
+    )
 
 @APP.function_name(name="GetSiphonsIn")
 @APP.route(route="kingdom/{kdId:int}/siphonsin", auth_level=func.AuthLevel.ADMIN, methods=["GET"])
@@ -973,19 +1223,13 @@ def update_siphonsout(req: func.HttpRequest) -> func.HttpResponse:
     siphons = req_body.get("siphons", None)
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"siphons_out_{kd_id}"
-    siphons_out_info = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
+    operations = []
+    if new_siphons:
+        operations.append({"op": "add", "path": "/siphons_out/-", "value": new_siphons})
+    if siphons != None:
+        operations.append({"op": "set", "path": "/siphons_out", "value": siphons})
     try:
-        if new_siphons:
-            siphons_out_info["siphons_out"] = siphons_out_info["siphons_out"] + [new_siphons]
-        if siphons != None:
-            siphons_out_info["siphons_out"] = siphons
-        CONTAINER.replace_item(
-            item_id,
-            siphons_out_info,
-        )
+        _patch_item(item_id, operations)
         return func.HttpResponse(
             "Kingdom siphons out updated.",
             status_code=200,
@@ -1005,19 +1249,13 @@ def update_siphonsin(req: func.HttpRequest) -> func.HttpResponse:
     siphons = req_body.get("siphons", None)
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"siphons_in_{kd_id}"
-    siphons_in_info = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
+    operations = []
+    if new_siphons:
+        operations.append({"op": "add", "path": "/siphons_in/-", "value": new_siphons})
+    if siphons != None:
+        operations.append({"op": "set", "path": "/siphons_in", "value": siphons})
     try:
-        if new_siphons:
-            siphons_in_info["siphons_in"] = siphons_in_info["siphons_in"] + [new_siphons]
-        if siphons != None:
-            siphons_in_info["siphons_in"] = siphons
-        CONTAINER.replace_item(
-            item_id,
-            siphons_in_info,
-        )
+        _patch_item(item_id, operations)
         return func.HttpResponse(
             "Kingdom siphons in updated.",
             status_code=200,
@@ -1028,6 +1266,145 @@ def update_siphonsin(req: func.HttpRequest) -> func.HttpResponse:
             status_code=500,
         )
 
+LOG_PAGE_SIZE = 100
+LOG_PATCH_RETRIES = 10
+COMMIT_RETRIES = 10
+
+def _log_migrate(log, key):
+    """Number the entries of a log written before it was paged, newest first
+
+    Entries added by patch carry no seq. The head is contiguous from next_seq
+    down, so theirs follows from their position.
+    """
+    if "next_seq" in log:
+        for i_entry, entry in enumerate(log[key]):
+            entry.setdefault("seq", log["next_seq"] - 1 - i_entry)
+        return log
+    entries = log.get(key, [])
+    for i_entry, entry in enumerate(entries):
+        entry["seq"] = len(entries) - i_entry
+    log[key] = entries
+    log["next_seq"] = len(entries) + 1
+    log["pages"] = []
+    return log
+
+def _log_prepend(item_id, key, new_entries):
+    """Add entries to the front of a paged log
+
+    Entries are numbered with an increasing seq. The head item holds the newest
+    entries, and once it reaches twice LOG_PAGE_SIZE the oldest LOG_PAGE_SIZE
+    are sealed into a page item that is never rewritten. The head always keeps
+    at least a page of entries, so the first page of a read is a single item.
+    pages indexes the sealed pages, newest first.
+
+    Entries are inserted with a patch that sends only the new entries, and the
+    head is rewritten only to seal a page or to number a log from before paging.
+    """
+    if isinstance(new_entries, dict):
+        new_entries = [new_entries]
+    operations = [{"op": "incr", "path": "/next_seq", "value": len(new_entries)}]
+    operations.extend(
+        {"op": "add", "path": _path(key, 0), "value": entry}
+        for entry in reversed(new_entries)
+    )
+    try:
+        log = _patch_item(
+            item_id,
+            operations,
+            filter_predicate="FROM c WHERE IS_DEFINED(c.next_seq)",
+        )
+    except exceptions.CosmosAccessConditionFailedError:
+        return _log_rewrite(item_id, key, new_entries)
+    if len(log[key]) >= 2 * LOG_PAGE_SIZE:
+        return _log_rewrite(item_id, key, [])
+    return _log_migrate(log, key)
+
+def _log_rewrite(item_id, key, new_entries):
+    """Prepend entries by replacing the head, sealing pages it has outgrown"""
+    for _ in range(LOG_PATCH_RETRIES):
+        log = _log_migrate(
+            CONTAINER.read_item(
+                item=item_id,
+                partition_key=item_id,
+            ),
+            key,
+        )
+        entries = [dict(entry) for entry in new_entries]
+        for entry in reversed(entries):
+            entry["seq"] = log["next_seq"]
+            log["next_seq"] += 1
+        log[key] = entries + log[key]
+        while len(log[key]) >= 2 * LOG_PAGE_SIZE:
+            sealed = log[key][-LOG_PAGE_SIZE:]
+            log[key] = log[key][:-LOG_PAGE_SIZE]
+            # Named by its first seq so a retry rewrites the same page
+            page_id = f"{item_id}_page_{sealed[-1]['seq']}"
+            CONTAINER.upsert_item(
+                {
+                    "id": page_id,
+                    key: sealed,
+                }
+            )
+            log["pages"].insert(0, {
+                "id": page_id,
+                "count": len(sealed),
+                "min_seq": sealed[-1]["seq"],
+                "max_seq": sealed[0]["seq"],
+            })
+        try:
+            CONTAINER.replace_item(
+                item_id,
+                log,
+                etag=log["_etag"],
+                match_condition=MatchConditions.IfNotModified,
+            )
+        except exceptions.CosmosAccessConditionFailedError:
+            continue
+        return log
+    raise exceptions.CosmosAccessConditionFailedError(message=f"{item_id} was modified concurrently")
+
+def _log_read(item_id, key, limit=None, before=None):
+    """Return the head item with key holding up to limit entries older than the before seq
+
+    Sealed pages are only read when the head does not hold enough entries.
+    """
+    log = _log_migrate(
+        CONTAINER.read_item(
+            item=item_id,
+            partition_key=item_id,
+        ),
+        key,
+    )
+    entries = [
+        entry
+        for entry in log[key]
+        if before is None or entry["seq"] < before
+    ]
+    for page in log["pages"]:
+        if limit is not None and len(entries) >= limit:
+            break
+        if before is not None and page["min_seq"] >= before:
+            continue
+        page_item = CONTAINER.read_item(
+            item=page["id"],
+            partition_key=page["id"],
+        )
+        entries.extend(
+            entry
+            for entry in page_item[key]
+            if before is None or entry["seq"] < before
+        )
+    log[key] = entries[:limit]
+    return log
+
+def _log_params(req):
+    limit = req.params.get("limit")
+    before = req.params.get("before")
+    return {
+        "limit": int(limit) if limit is not None else None,
+        "before": int(before) if before is not None else None,
+    }
+
 @APP.function_name(name="GetNews")
 @APP.route(route="kingdom/{kdId:int}/news", auth_level=func.AuthLevel.ADMIN, methods=["GET"])
 def get_news(req: func.HttpRequest) -> func.HttpResponse:
@@ -1035,10 +1412,7 @@ def get_news(req: func.HttpRequest) -> func.HttpResponse:
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"news_{kd_id}"
     try:
-        news = CONTAINER.read_item(
-            item=item_id,
-            partition_key=item_id,
-        )
+        news = _log_read(item_id, "news", **_log_params(req))
         return func.HttpResponse(
             json.dumps(news),
             status_code=201,
@@ -1056,10 +1430,7 @@ def get_galaxy_news(req: func.HttpRequest) -> func.HttpResponse:
     galaxy_id = str(req.route_params.get('galaxyId'))
     item_id = f"galaxy_news_{galaxy_id}"
     try:
-        news = CONTAINER.read_item(
-            item=item_id,
-            partition_key=item_id,
-        )
+        news = _log_read(item_id, "news", **_log_params(req))
         return func.HttpResponse(
             json.dumps(news),
             status_code=201,
@@ -1078,19 +1449,8 @@ def update_galaxy_news(req: func.HttpRequest) -> func.HttpResponse:
     new_news = req_body
     galaxy_id = str(req.route_params.get('galaxyId'))
     item_id = f"galaxy_news_{galaxy_id}"
-    news = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        if isinstance(new_news, dict):
-            news["news"] = [new_news] + news["news"]
-        else:
-            news["news"] = new_news + news["news"]
-        CONTAINER.replace_item(
-            item_id,
-            news,
-        )
+        _log_prepend(item_id, "news", new_news)
         return func.HttpResponse(
             "Kingdom news updated.",
             status_code=200,
@@ -1108,10 +1468,7 @@ def get_empire_news(req: func.HttpRequest) -> func.HttpResponse:
     empire_id = str(req.route_params.get('empireId'))
     item_id = f"empire_news_{empire_id}"
     try:
-        news = CONTAINER.read_item(
-            item=item_id,
-            partition_key=item_id,
-        )
+        news = _log_read(item_id, "news", **_log_params(req))
         return func.HttpResponse(
             json.dumps(news),
             status_code=201,
@@ -1128,10 +1485,7 @@ def get_universe_news(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a get universe news request.')    
     item_id = f"universe_news"
     try:
-        news = CONTAINER.read_item(
-            item=item_id,
-            partition_key=item_id,
-        )
+        news = _log_read(item_id, "news", **_log_params(req))
         return func.HttpResponse(
             json.dumps(news),
             status_code=201,
@@ -1150,19 +1504,8 @@ def update_news(req: func.HttpRequest) -> func.HttpResponse:
     new_news = req_body
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"news_{kd_id}"
-    news = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        if isinstance(new_news, dict):
-            news["news"] = [new_news] + news["news"]
-        else:
-            news["news"] = new_news + news["news"]
-        CONTAINER.replace_item(
-            item_id,
-            news,
-        )
+        _log_prepend(item_id, "news", new_news)
         return func.HttpResponse(
             "Kingdom news updated.",
             status_code=200,
@@ -1181,19 +1524,8 @@ def update_empire_news(req: func.HttpRequest) -> func.HttpResponse:
         req_body = req.get_json()
         new_news = req_body["news"]
         empire_id = str(req.route_params.get('empireId'))
-        item_id = f"empire_{empire_id}"
-        news = CONTAINER.read_item(
-            item=item_id,
-            partition_key=item_id,
-        )
-        if isinstance(new_news, dict):
-            news["news"] = [new_news] + news["news"]
-        else:
-            news["news"] = new_news + news["news"]
-        CONTAINER.replace_item(
-            item_id,
-            news,
-        )
+        item_id = f"empire_news_{empire_id}"
+        _log_prepend(item_id, "news", new_news)
         return func.HttpResponse(
             "Empire news updated.",
             status_code=200,
@@ -1212,18 +1544,7 @@ def update_universe_news(req: func.HttpRequest) -> func.HttpResponse:
         req_body = req.get_json()
         new_news = req_body["news"]
         item_id = f"universe_news"
-        news = CONTAINER.read_item(
-            item=item_id,
-            partition_key=item_id,
-        )
-        if isinstance(new_news, dict):
-            news["news"] = [new_news] + news["news"]
-        else:
-            news["news"] = new_news + news["news"]
-        CONTAINER.replace_item(
-            item_id,
-            news,
-        )
+        _log_prepend(item_id, "news", new_news)
         return func.HttpResponse(
             "Universe news updated.",
             status_code=200,
@@ -1241,10 +1562,7 @@ def get_messages(req: func.HttpRequest) -> func.HttpResponse:
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"messages_{kd_id}"
     try:
-        messages = CONTAINER.read_item(
-            item=item_id,
-            partition_key=item_id,
-        )
+        messages = _log_read(item_id, "messages", **_log_params(req))
         return func.HttpResponse(
             json.dumps(messages),
             status_code=201,
@@ -1263,19 +1581,8 @@ def update_messages(req: func.HttpRequest) -> func.HttpResponse:
     new_messages = req_body
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"messages_{kd_id}"
-    messages = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        if isinstance(new_messages, dict):
-            messages["messages"] = [new_messages] + messages["messages"][0:99]
-        else:
-            messages["messages"] = new_messages + messages["messages"][0:99]
-        CONTAINER.replace_item(
-            item_id,
-            messages,
-        )
+        _log_prepend(item_id, "messages", new_messages)
         return func.HttpResponse(
             "Kingdom messages updated.",
             status_code=200,
@@ -1307,6 +1614,18 @@ def get_notifs(req: func.HttpRequest) -> func.HttpResponse:
             status_code=500,
         )
 
+def _notifs_operations(add_categories, clear_categories):
+    return [
+        *(
+            {"op": "incr", "path": _path(add_cat), "value": count}
+            for add_cat, count in Counter(add_categories).items()
+        ),
+        *(
+            {"op": "set", "path": _path(clear_cat), "value": 0}
+            for clear_cat in clear_categories
+        ),
+    ]
+
 @APP.function_name(name="UpdateNotifs")
 @APP.route(route="kingdom/{kdId:int}/notifs", auth_level=func.AuthLevel.ADMIN, methods=["PATCH"])
 def update_notifs(req: func.HttpRequest) -> func.HttpResponse:
@@ -1317,19 +1636,8 @@ def update_notifs(req: func.HttpRequest) -> func.HttpResponse:
 
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"notifs_{kd_id}"
-    notifs = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        for add_cat in add_categories:
-            notifs[add_cat] += 1
-        for clear_cat in clear_categories:
-            notifs[clear_cat] = 0
-        CONTAINER.replace_item(
-            item_id,
-            notifs,
-        )
+        _patch_item(item_id, _notifs_operations(add_categories, clear_categories))
         return func.HttpResponse(
             "Kingdom notifs updated.",
             status_code=200,
@@ -1340,15 +1648,102 @@ def update_notifs(req: func.HttpRequest) -> func.HttpResponse:
             status_code=500,
         )
 
+def _queue_time(entry):
+    return datetime.datetime.fromisoformat(entry["time"]).timestamp()
+
+def _queue_sorted(queue, key):
+    """Keep a build queue sorted by completion time, with epoch seconds in times
+
+    Queues written before they were sorted are sorted and given times on read.
+    """
+    entries = queue.get(key, [])
+    times = queue.get("times")
+    if times is None or len(times) != len(entries):
+        pairs = sorted(
+            ((_queue_time(entry), entry) for entry in entries),
+            key=lambda pair: pair[0],
+        )
+        queue[key] = [entry for _, entry in pairs]
+        queue["times"] = [time for time, _ in pairs]
+    return queue
+
+def _queue_insert(queue, key, new_entries):
+    """Insert entries in time order, adding into any entry completing at the same time
+
+    Orders are rounded to a bucket before they are queued, so merging keeps the
+    queue length bounded by the horizon rather than by the number of orders.
+    Returns the patch operations that make the same change to the stored item.
+    """
+    operations = []
+    for entry in new_entries:
+        time = _queue_time(entry)
+        i_insert = bisect.bisect_right(queue["times"], time)
+        if i_insert and queue["times"][i_insert - 1] == time:
+            existing_entry = queue[key][i_insert - 1]
+            for key_amount, amount in entry.items():
+                if key_amount == "time":
+                    continue
+                operations.append({
+                    "op": "incr" if key_amount in existing_entry else "set",
+                    "path": _path(key, i_insert - 1, key_amount),
+                    "value": amount,
+                })
+                existing_entry[key_amount] = existing_entry.get(key_amount, 0) + amount
+            continue
+        queue["times"].insert(i_insert, time)
+        queue[key].insert(i_insert, dict(entry))
+        operations.extend([
+            {"op": "add", "path": _path("times", i_insert), "value": time},
+            {"op": "add", "path": _path(key, i_insert), "value": entry},
+        ])
+    return operations
+
+def _queue_update(item_id, key, new_entries, replace_entries, replace_times):
+    """Replace a build queue, or insert new_entries into it, patching only what changed
+
+    Insert positions come from a read, so the patch applies only if the queue is
+    unchanged since, and is recomputed on conflict. Queues stored before they
+    had times are sorted and written whole.
+    """
+    if replace_entries != None:
+        queue = _queue_sorted({key: replace_entries, "times": replace_times}, key)
+        return _patch_item(item_id, [
+            {"op": "set", "path": _path(key), "value": queue[key]},
+            {"op": "set", "path": "/times", "value": queue["times"]},
+        ])
+    if not new_entries:
+        return None
+    for _ in range(LOG_PATCH_RETRIES):
+        queue = CONTAINER.read_item(
+            item=item_id,
+            partition_key=item_id,
+        )
+        unsorted = queue.get("times") is None or len(queue["times"]) != len(queue.get(key, []))
+        _queue_sorted(queue, key)
+        operations = _queue_insert(queue, key, new_entries)
+        if unsorted:
+            operations = [
+                {"op": "set", "path": _path(key), "value": queue[key]},
+                {"op": "set", "path": "/times", "value": queue["times"]},
+            ]
+        try:
+            return _patch_item(item_id, operations, etag=queue["_etag"])
+        except exceptions.CosmosAccessConditionFailedError:
+            continue
+    raise exceptions.CosmosAccessConditionFailedError(message=f"{item_id} was modified concurrently")
+
 @APP.function_name(name="GetSettles")
 @APP.route(route="kingdom/{kdId:int}/settles", auth_level=func.AuthLevel.ADMIN, methods=["GET"])
 def get_settles(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a get settles request.')    
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"settles_{kd_id}"
-    settles = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
+    settles = _queue_sorted(
+        CONTAINER.read_item(
+            item=item_id,
+            partition_key=item_id,
+        ),
+        "settles",
     )
     try:
         return func.HttpResponse(
@@ -1370,19 +1765,8 @@ def update_settles(req: func.HttpRequest) -> func.HttpResponse:
     replace_settles = req_body.get("settles", None)
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"settles_{kd_id}"
-    settles = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        if new_settles:
-            settles["settles"] = settles["settles"] + new_settles
-        if replace_settles != None:
-            settles["settles"] = replace_settles
-        CONTAINER.replace_item(
-            item_id,
-            settles,
-        )
+        _queue_update(item_id, "settles", new_settles, replace_settles, req_body.get("times"))
         return func.HttpResponse(
             "Kingdom settles updated.",
             status_code=200,
@@ -1399,9 +1783,12 @@ def get_mobis(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a get mobis request.')    
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"mobis_{kd_id}"
-    mobis = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
+    mobis = _queue_sorted(
+        CONTAINER.read_item(
+            item=item_id,
+            partition_key=item_id,
+        ),
+        "mobis",
     )
     try:
         return func.HttpResponse(
@@ -1423,19 +1810,8 @@ def update_mobis(req: func.HttpRequest) -> func.HttpResponse:
     replace_mobis = req_body.get("mobis", None)
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"mobis_{kd_id}"
-    mobis = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        if new_mobis:
-            mobis["mobis"] = mobis["mobis"] + new_mobis
-        if replace_mobis != None:
-            mobis["mobis"] = replace_mobis
-        CONTAINER.replace_item(
-            item_id,
-            mobis,
-        )
+        _queue_update(item_id, "mobis", new_mobis, replace_mobis, req_body.get("times"))
         return func.HttpResponse(
             "Kingdom mobis updated.",
             status_code=200,
@@ -1452,9 +1828,12 @@ def get_structures(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a get structures request.')    
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"structures_{kd_id}"
-    structures = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
+    structures = _queue_sorted(
+        CONTAINER.read_item(
+            item=item_id,
+            partition_key=item_id,
+        ),
+        "structures",
     )
     try:
         return func.HttpResponse(
@@ -1476,19 +1855,8 @@ def update_structures(req: func.HttpRequest) -> func.HttpResponse:
     replace_structures = req_body.get("structures", None)
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"structures_{kd_id}"
-    structures = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        if new_structures:
-            structures["structures"] = structures["structures"] + new_structures
-        if replace_structures != None:
-            structures["structures"] = replace_structures
-        CONTAINER.replace_item(
-            item_id,
-            structures,
-        )
+        _queue_update(item_id, "structures", new_structures, replace_structures, req_body.get("times"))
         return func.HttpResponse(
             "Kingdom structures updated.",
             status_code=200,
@@ -1505,9 +1873,12 @@ def get_missiles(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a get missiles request.')    
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"missiles_{kd_id}"
-    missiles = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
+    missiles = _queue_sorted(
+        CONTAINER.read_item(
+            item=item_id,
+            partition_key=item_id,
+        ),
+        "missiles",
     )
     try:
         return func.HttpResponse(
@@ -1529,19 +1900,8 @@ def update_missiles(req: func.HttpRequest) -> func.HttpResponse:
     replace_missiles = req_body.get("missiles", None)
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"missiles_{kd_id}"
-    missiles = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        if new_missiles:
-            missiles["missiles"] = missiles["missiles"] + new_missiles
-        if replace_missiles != None:
-            missiles["missiles"] = replace_missiles
-        CONTAINER.replace_item(
-            item_id,
-            missiles,
-        )
+        _queue_update(item_id, "missiles", new_missiles, replace_missiles, req_body.get("times"))
         return func.HttpResponse(
             "Kingdom missiles updated.",
             status_code=200,
@@ -1558,9 +1918,12 @@ def get_engineers(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a get engineers request.')    
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"engineers_{kd_id}"
-    engineers = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
+    engineers = _queue_sorted(
+        CONTAINER.read_item(
+            item=item_id,
+            partition_key=item_id,
+        ),
+        "engineers",
     )
     try:
         return func.HttpResponse(
@@ -1582,19 +1945,8 @@ def update_engineers(req: func.HttpRequest) -> func.HttpResponse:
     replace_engineers = req_body.get("engineers", None)
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"engineers_{kd_id}"
-    engineers = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        if new_engineers:
-            engineers["engineers"] = engineers["engineers"] + new_engineers
-        if replace_engineers != None:
-            engineers["engineers"] = replace_engineers
-        CONTAINER.replace_item(
-            item_id,
-            engineers,
-        )
+        _queue_update(item_id, "engineers", new_engineers, replace_engineers, req_body.get("times"))
         return func.HttpResponse(
             "Kingdom engineers updated.",
             status_code=200,
@@ -1626,56 +1978,56 @@ def get_revealed(req: func.HttpRequest) -> func.HttpResponse:
             status_code=500,
         )
         
+def _revealed_operations(revealed_info, req_body):
+    """Patch operations for a revealed update, in the order the fields used to be merged
+
+    revealed_info is only consulted for which kingdoms new_revealed already has.
+    """
+    operations = []
+    for kd_id, revealed_dict in (req_body.get("new_revealed") or {}).items():
+        if kd_id in revealed_info.get("revealed", {}):
+            operations.extend(_merge_operations(revealed_dict, "revealed", kd_id))
+        else:
+            operations.append({"op": "set", "path": _path("revealed", kd_id), "value": revealed_dict})
+    operations.extend(_merge_operations(req_body.get("new_galaxies") or {}, "galaxies"))
+    for key_list in ["revealed_galaxymates", "revealed_to_galaxymates"]:
+        operations.extend(
+            {"op": "add", "path": _path(key_list, "-"), "value": value}
+            for value in req_body.get(f"new_{key_list}") or []
+        )
+    for key_replace in ["revealed", "galaxies", "revealed_galaxymates", "revealed_to_galaxymates"]:
+        if req_body.get(key_replace) != None:
+            operations.append({"op": "set", "path": _path(key_replace), "value": req_body[key_replace]})
+    return operations
+
+def _revealed_update(item_id, req_body):
+    """Patch a revealed item, reading it first only when new_revealed needs to know what is there"""
+    if not req_body.get("new_revealed"):
+        return _patch_item(item_id, _revealed_operations({}, req_body))
+    for _ in range(LOG_PATCH_RETRIES):
+        revealed_info = CONTAINER.read_item(
+            item=item_id,
+            partition_key=item_id,
+        )
+        try:
+            return _patch_item(
+                item_id,
+                _revealed_operations(revealed_info, req_body),
+                etag=revealed_info["_etag"],
+            )
+        except exceptions.CosmosAccessConditionFailedError:
+            continue
+    raise exceptions.CosmosAccessConditionFailedError(message=f"{item_id} was modified concurrently")
+
 @APP.function_name(name="UpdateRevealed")
 @APP.route(route="kingdom/{kdId:int}/revealed", auth_level=func.AuthLevel.ADMIN, methods=["PATCH"])
 def update_revealed(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed an update revealed request.')    
     req_body = req.get_json()
-    new_revealed = req_body.get("new_revealed", None)
-    new_galaxies = req_body.get("new_galaxies", None)
-    new_revealed_galaxymates = req_body.get("new_revealed_galaxymates", None)
-    new_revealed_to_galaxymates = req_body.get("new_revealed_to_galaxymates", None)
-    revealed = req_body.get("revealed", None)
-    galaxies = req_body.get("galaxies", None)
-    revealed_galaxymates = req_body.get("revealed_galaxymates", None)
-    revealed_to_galaxymates = req_body.get("revealed_to_galaxymates", None)
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"revealed_{kd_id}"
-    revealed_info = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        if new_revealed:
-            current_revealed = revealed_info["revealed"]
-            for kd_id, revealed_dict in new_revealed.items():
-                kd_revealed = current_revealed.get(kd_id, {})
-                current_revealed[kd_id] = {
-                    **kd_revealed,
-                    **revealed_dict,
-                }
-            revealed_info["revealed"] = current_revealed
-        if new_galaxies:
-            revealed_info["galaxies"] = {
-                **revealed_info["galaxies"],
-                **new_galaxies,
-            }
-        if new_revealed_galaxymates:
-            revealed_info["revealed_galaxymates"] += new_revealed_galaxymates
-        if new_revealed_to_galaxymates:
-            revealed_info["revealed_to_galaxymates"] += new_revealed_to_galaxymates
-        if revealed != None:
-            revealed_info["revealed"] = revealed
-        if galaxies != None:
-            revealed_info["galaxies"] = galaxies
-        if revealed_galaxymates != None:
-            revealed_info["revealed_galaxymates"] = revealed_galaxymates
-        if revealed_to_galaxymates != None:
-            revealed_info["revealed_to_galaxymates"] = revealed_to_galaxymates
-        CONTAINER.replace_item(
-            item_id,
-            revealed_info,
-        )
+        _revealed_update(item_id, req_body)
         return func.HttpResponse(
             "Kingdom revealed updated.",
             status_code=200,
@@ -1715,19 +2067,8 @@ def set_shared(req: func.HttpRequest) -> func.HttpResponse:
 
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"shared_{kd_id}"
-    shared = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
-    new_shared = {
-        **shared,
-        **req_body,
-    }
     try:
-        CONTAINER.replace_item(
-            item_id,
-            new_shared,
-        )
+        _patch_item(item_id, _merge_operations(req_body))
         return func.HttpResponse(
             "Kingdom shared set.",
             status_code=200,
@@ -1746,16 +2087,11 @@ def update_shared(req: func.HttpRequest) -> func.HttpResponse:
     new_shared = req_body["shared"]
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"shared_{kd_id}"
-    shared = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        shared["shared"] = shared["shared"] + new_shared
-        CONTAINER.replace_item(
-            item_id,
-            shared,
-        )
+        _patch_item(item_id, [
+            {"op": "add", "path": "/shared/-", "value": entry}
+            for entry in new_shared
+        ])
         return func.HttpResponse(
             "Kingdom shared updated.",
             status_code=200,
@@ -1774,16 +2110,11 @@ def update_shared_requests(req: func.HttpRequest) -> func.HttpResponse:
     new_shared_requests = req_body["shared_requests"]
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"shared_requests_{kd_id}"
-    shared_requests = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        shared_requests["shared_requests"] = shared_requests["shared_requests"] + new_shared_requests
-        CONTAINER.replace_item(
-            item_id,
-            shared_requests,
-        )
+        _patch_item(item_id, [
+            {"op": "add", "path": "/shared_requests/-", "value": entry}
+            for entry in new_shared_requests
+        ])
         return func.HttpResponse(
             "Kingdom shared_requests updated.",
             status_code=200,
@@ -1855,11 +2186,8 @@ def get_spyhistory(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a get spyhistory request.')    
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"spy_history_{kd_id}"
-    spyhistory = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
+        spyhistory = _log_read(item_id, "spy_history", **_log_params(req))
         return func.HttpResponse(
             json.dumps(spyhistory),
             status_code=200,
@@ -1878,16 +2206,8 @@ def update_spy_history(req: func.HttpRequest) -> func.HttpResponse:
     new_spy_history = req_body
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"spy_history_{kd_id}"
-    spy_history = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        spy_history["spy_history"] = [new_spy_history] + spy_history["spy_history"]
-        CONTAINER.replace_item(
-            item_id,
-            spy_history,
-        )
+        _log_prepend(item_id, "spy_history", new_spy_history)
         return func.HttpResponse(
             "Kingdom spy_history updated.",
             status_code=200,
@@ -1904,11 +2224,8 @@ def get_attackhistory(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a get attackhistory request.')    
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"attack_history_{kd_id}"
-    attackhistory = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
+        attackhistory = _log_read(item_id, "attack_history", **_log_params(req))
         return func.HttpResponse(
             json.dumps(attackhistory),
             status_code=200,
@@ -1927,16 +2244,8 @@ def update_attack_history(req: func.HttpRequest) -> func.HttpResponse:
     new_attack_history = req_body
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"attack_history_{kd_id}"
-    attack_history = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        attack_history["attack_history"] = [new_attack_history] + attack_history["attack_history"]
-        CONTAINER.replace_item(
-            item_id,
-            attack_history,
-        )
+        _log_prepend(item_id, "attack_history", new_attack_history)
         return func.HttpResponse(
             "Kingdom attack_history updated.",
             status_code=200,
@@ -1953,11 +2262,8 @@ def get_missilehistory(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a get missilehistory request.')    
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"missile_history_{kd_id}"
-    missilehistory = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
+        missilehistory = _log_read(item_id, "missile_history", **_log_params(req))
         return func.HttpResponse(
             json.dumps(missilehistory),
             status_code=200,
@@ -1976,16 +2282,8 @@ def update_missile_history(req: func.HttpRequest) -> func.HttpResponse:
     new_missile_history = req_body
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"missile_history_{kd_id}"
-    missile_history = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        missile_history["missile_history"] = [new_missile_history] + missile_history["missile_history"]
-        CONTAINER.replace_item(
-            item_id,
-            missile_history,
-        )
+        _log_prepend(item_id, "missile_history", new_missile_history)
         return func.HttpResponse(
             "Kingdom missile_history updated.",
             status_code=200,
@@ -1996,17 +2294,82 @@ def update_missile_history(req: func.HttpRequest) -> func.HttpResponse:
             status_code=500,
         )
 
+HISTORY_BUCKET_POINTS = 200
+
+def _history_time(value):
+    return int(datetime.datetime.fromisoformat(value).timestamp())
+
+def _history_series(item):
+    """Time and value columns per metric, converting items stored as lists of points"""
+    if "series" in item:
+        return item["series"]
+    return {
+        key_history: {
+            "time": [_history_time(point["time"]) for point in points],
+            "value": [point["value"] for point in points],
+        }
+        for key_history, points in item.get("history", {}).items()
+    }
+
+def _history_window(series, since=None, before=None):
+    windowed = {}
+    for key_history, columns in series.items():
+        times = columns["time"]
+        i_start = bisect.bisect_left(times, since) if since is not None else 0
+        i_end = bisect.bisect_left(times, before) if before is not None else len(times)
+        windowed[key_history] = {
+            "time": times[i_start:i_end],
+            "value": columns["value"][i_start:i_end],
+        }
+    return windowed
+
+def _read_history(kd_id, since=None, before=None):
+    """History columns at or after since and before before, as epoch seconds
+
+    Only the sealed buckets that overlap the window are read.
+    """
+    item_id = f"history_{kd_id}"
+    history = CONTAINER.read_item(
+        item=item_id,
+        partition_key=item_id,
+    )
+    head_series = _history_series(history)
+    series = {
+        key_history: {"time": [], "value": []}
+        for key_history in head_series
+    }
+    for bucket in history.get("buckets", []):
+        if since is not None and bucket["end"] < since:
+            continue
+        if before is not None and bucket["start"] >= before:
+            continue
+        bucket_item = CONTAINER.read_item(
+            item=bucket["id"],
+            partition_key=bucket["id"],
+        )
+        for key_history, columns in _history_window(bucket_item["series"], since, before).items():
+            series.setdefault(key_history, {"time": [], "value": []})
+            series[key_history]["time"].extend(columns["time"])
+            series[key_history]["value"].extend(columns["value"])
+    for key_history, columns in _history_window(head_series, since, before).items():
+        series[key_history]["time"].extend(columns["time"])
+        series[key_history]["value"].extend(columns["value"])
+    return {
+        "id": item_id,
+        "kdId": history.get("kdId"),
+        "series": series,
+    }
+
 @APP.function_name(name="GetHistory")
 @APP.route(route="kingdom/{kdId:int}/history", auth_level=func.AuthLevel.ADMIN, methods=["GET"])
 def get_history(req: func.HttpRequest) -> func.HttpResponse:
+    """History columns from the "since" param up to the "before" param"""
     logging.info('Python HTTP trigger function processed a get history request.')    
     kd_id = str(req.route_params.get('kdId'))
-    item_id = f"history_{kd_id}"
     try:
-        history = CONTAINER.read_item(
-            item=item_id,
-            partition_key=item_id,
-        )
+        since = _history_time(req.params["since"]) if "since" in req.params else None
+        before = _history_time(req.params["before"]) if "before" in req.params else None
+        history = _read_history(kd_id, since, before)
         return func.HttpResponse(
             json.dumps(history),
             status_code=201,
@@ -2016,25 +2379,119 @@ def get_history(req: func.HttpRequest) -> func.HttpResponse:
             "Could not retrieve history info",
             status_code=500,
         )
+
+@APP.function_name(name="GetHistories")
+@APP.route(route="histories", auth_level=func.AuthLevel.ADMIN, methods=["POST"])
+def get_histories(req: func.HttpRequest) -> func.HttpResponse:
+    """History columns for every kingdom in the "kingdoms" list, for exports"""
+    logging.info('Python HTTP trigger function processed a get histories request.')    
+    req_body = req.get_json()
+    histories = {}
+    try:
+        since = _history_time(req_body["since"]) if req_body.get("since") else None
+        before = _history_time(req_body["before"]) if req_body.get("before") else None
+        for kd_id in req_body.get("kingdoms", []):
+            try:
+                histories[kd_id] = _read_history(kd_id, since, before)["series"]
+            except exceptions.CosmosResourceNotFoundError:
+                histories[kd_id] = None
+        return func.HttpResponse(
+            json.dumps({"histories": histories}),
+            status_code=200,
+        )
+    except:
+        return func.HttpResponse(
+            "Could not retrieve histories",
+            status_code=500,
+        )
+
+def _history_rewrite(item_id, time_history, new_values):
+    """Append to the head by replacing it, sealing the bucket once a metric is full
+
+    Returns False if the head kept changing underneath every retry.
+    """
+    for _ in range(LOG_PATCH_RETRIES):
+        history = CONTAINER.read_item(
+            item=item_id,
+            partition_key=item_id,
+        )
+        series = _history_series(history)
+        history.pop("history", None)
+        buckets = history.setdefault("buckets", [])
+        for key_history, value in new_values.items():
+            columns = series.setdefault(key_history, {"time": [], "value": []})
+            columns["time"].append(time_history)
+            columns["value"].append(value)
+        if max((len(columns["time"]) for columns in series.values()), default=0) >= HISTORY_BUCKET_POINTS:
+            bucket_id = f"{item_id}_bucket_{len(buckets)}"
+            CONTAINER.upsert_item(
+                {
+                    "id": bucket_id,
+                    "series": series,
+                }
+            )
+            buckets.append({
+                "id": bucket_id,
+                "start": min(columns["time"][0] for columns in series.values() if columns["time"]),
+                "end": max(columns["time"][-1] for columns in series.values() if columns["time"]),
+            })
+            series = {
+                key_history: {"time": [], "value": []}
+                for key_history in series
+            }
+        history["series"] = series
+        try:
+            CONTAINER.replace_item(
+                item_id,
+                history,
+                etag=history["_etag"],
+                match_condition=MatchConditions.IfNotModified,
+            )
+        except exceptions.CosmosAccessConditionFailedError:
+            continue
+        return True
+    return False
+
 @APP.function_name(name="UpdateHistory")
 @APP.route(route="kingdom/{kdId:int}/history", auth_level=func.AuthLevel.ADMIN, methods=["PATCH"])
 def update_history(req: func.HttpRequest) -> func.HttpResponse:
+    """Append the "values" per metric at "time" to the current bucket's columns
+
+    When a metric reaches HISTORY_BUCKET_POINTS the whole bucket is sealed into
+    its own item, indexed by time range in buckets, and the head starts empty.
+    Points are appended with add operations; the head is only rewritten to seal
+    a bucket, to add a new metric or to convert an item stored as points.
+    """
     logging.info('Python HTTP trigger function processed an update history request.')    
     req_body = req.get_json()
-    new_history = req_body.get("history", {})
     kd_id = str(req.route_params.get('kdId'))
     item_id = f"history_{kd_id}"
-    history = CONTAINER.read_item(
-        item=item_id,
-        partition_key=item_id,
-    )
     try:
-        for key_history, item_history in new_history.items():
-            history["history"][key_history].append(item_history)
-        CONTAINER.replace_item(
-            item_id,
-            history,
-        )
+        time_history = _history_time(req_body["time"])
+        new_values = req_body.get("values", {})
+        operations = []
+        for key_history, value in new_values.items():
+            operations.extend([
+                {"op": "add", "path": _path("series", key_history, "time", "-"), "value": time_history},
+                {"op": "add", "path": _path("series", key_history, "value", "-"), "value": value},
+            ])
+        try:
+            history = _patch_item(
+                item_id,
+                operations,
+                filter_predicate="FROM c WHERE IS_DEFINED(c.series)",
+            )
+            appended = True
+            if max((len(columns["time"]) for columns in _history_series(history).values()), default=0) >= HISTORY_BUCKET_POINTS:
+                # The points are in, so a seal that loses every race waits for the next append
+                _history_rewrite(item_id, time_history, {})
+        except (exceptions.CosmosHttpResponseError, exceptions.CosmosBatchOperationError):
+            appended = _history_rewrite(item_id, time_history, new_values)
+        if not appended:
+            return func.HttpResponse(
+                "The kingdom history was modified concurrently",
+                status_code=409,
+            )
         return func.HttpResponse(
             "Kingdom history updated.",
             status_code=200,
@@ -2043,4 +2500,153 @@ def update_history(req: func.HttpRequest) -> func.HttpResponse:
         return func.HttpResponse(
             "The kingdom history were not updated",
             status_code=500,
-        )
\ No newline at end of file
+        )
+@APP.function_name(name="BatchRead")
+@APP.route(route="batch/read", auth_level=func.AuthLevel.ADMIN, methods=["POST"])
+def batch_read(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('Python HTTP trigger function processed a batch read request.')    
+    req_body = req.get_json()
+    item_ids = req_body.get("items", [])
+    items = {}
+    for item_id in item_ids:
+        try:
+            items[item_id] = CONTAINER.read_item(
+                item=item_id,
+                partition_key=item_id,
+            )
+        except:
+            items[item_id] = None
+    try:
+        return func.HttpResponse(
+            json.dumps({"items": items}),
+            status_code=200,
+        )
+    except:
+        return func.HttpResponse(
+            "The items could not be retrieved",
+            status_code=500,
+        )
+
+@APP.function_name(name="BatchPatch")
+@APP.route(route="batch/patch", auth_level=func.AuthLevel.ADMIN, methods=["POST"])
+def batch_patch(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('Python HTTP trigger function processed a batch patch request.')    
+    req_body = req.get_json()
+    patches = req_body.get("items", [])
+    failed = []
+    for patch in patches:
+        item_id = patch["id"]
+        try:
+            new_item = _patch_item(item_id, _merge_operations(patch.get("merge", {})))
+        except:
+            failed.append(item_id)
+            continue
+        if item_id.startswith("kingdom_") and not _reschedule_kingdom(
+            item_id.removeprefix("kingdom_"),
+            new_item,
+            patch.get("merge", {}),
+        ):
+            failed.append(item_id)
+    if failed:
+        return func.HttpResponse(
+            json.dumps({"failed": failed}),
+            status_code=500,
+        )
+    return func.HttpResponse(
+        json.dumps({"failed": []}),
+        status_code=200,
+    )
+
+@APP.function_name(name="BatchCommit")
+@APP.route(route="batch/commit", auth_level=func.AuthLevel.ADMIN, methods=["POST"])
+def batch_commit(req: func.HttpRequest) -> func.HttpResponse:
+    """Apply a unit of work staged by the API in one request
+
+    Every item is its own partition, so there is no transaction to lean on.
+    items are read before any is written and patched only if unchanged since,
+    and a failed patch puts back the items already written, so either all
+    items commit or none do. An item is only put back if nothing else wrote it
+    since; any that could not be are listed in not_restored with a 500, as the
+    commit then landed in part. logs, revealed and notifs only add to their
+    items and are applied afterwards in that order as patches of their own.
+    Kingdoms that could not be rescheduled are reported in failed with them.
+    """
+    logging.info('Python HTTP trigger function processed a batch commit request.')    
+    req_body = req.get_json()
+    patches = req_body.get("items", [])
+    originals = {}
+    written = {}
+    try:
+        for patch in patches:
+            originals[patch["id"]] = CONTAINER.read_item(
+                item=patch["id"],
+                partition_key=patch["id"],
+            )
+        for patch in patches:
+            item_id = patch["id"]
+            written[item_id] = _patch_item(
+                item_id,
+                _merge_operations(patch.get("merge", {})),
+                etag=originals[item_id]["_etag"],
+            )
+    except:
+        logging.exception("Batch commit failed, restoring %s", list(written))
+        not_restored = []
+        for item_id in written:
+            try:
+                CONTAINER.replace_item(
+                    item_id,
+                    originals[item_id],
+                    etag=written[item_id]["_etag"],
+                    match_condition=MatchConditions.IfNotModified,
+                )
+            except:
+                logging.exception("Could not restore %s", item_id)
+                not_restored.append(item_id)
+        failed = [patch["id"] for patch in patches if patch["id"] not in written]
+        if not_restored:
+            return func.HttpResponse(
+                json.dumps({
+                    "committed": False,
+                    "failed": failed,
+                    "not_restored": not_restored,
+                }),
+                status_code=500,
+            )
+        return func.HttpResponse(
+            json.dumps({
+                "committed": False,
+                "failed": failed,
+            }),
+            status_code=409,
+        )
+    failed = []
+    for patch in patches:
+        if patch["id"].startswith("kingdom_") and not _reschedule_kingdom(
+            patch["id"].removeprefix("kingdom_"),
+            written[patch["id"]],
+            patch.get("merge", {}),
+        ):
+            failed.append(patch["id"])
+    for log in req_body.get("logs", []):
+        try:
+            _log_prepend(log["id"], log["key"], log["entries"])
+        except:
+            failed.append(log["id"])
+    for revealed in req_body.get("revealed", []):
+        try:
+            _revealed_update(revealed["id"], revealed)
+        except:
+            failed.append(revealed["id"])
+    for notifs in req_body.get("notifs", []):
+        try:
+            _patch_item(
+                notifs["id"],
+                _notifs_operations(notifs.get("add_categories", []), notifs.get("clear_categories", [])),
+            )
+        except:
+            failed.append(notifs["id"])
+    return func.HttpResponse(
+        json.dumps({"committed": True, "failed": failed}),
+        status_code=500 if failed else 200,
+    )
@@ -137,41 +137,6 @@ const initLoadingData = {
   'scores': true,
   'notifs': true,
 }
-const endpoints = {
-  'kingdomid': 'api/kingdomid',
-  'kingdom': 'api/kingdom',
-  'state': 'api/state',
-  'shields': 'api/shields',
-  'kingdoms': 'api/kingdoms',
-  'galaxies': 'api/galaxies',
-  'galaxies_inverted': 'api/galaxies_inverted',
-  'siphonsout': 'api/siphonsout',
-  'empires': 'api/empires',
-  'empires_inverted': 'api/empires_inverted',
-  'empirepolitics': 'api/empirepolitics',
-  'news': 'api/news',
-  'galaxynews': 'api/galaxynews',
-  'empirenews': 'api/empirenews',
-  'universenews': 'api/universenews',
-  'settle': 'api/settle',
-  'structures': 'api/structures',
-  'mobis': 'api/mobis',
-  'missiles': 'api/missiles',
-  'engineers': 'api/engineers',
-  'projects': 'api/projects',
-  'revealed': 'api/revealed',
-  'shared': 'api/shared',
-  'pinned': 'api/pinned',
-  'galaxypolitics': 'api/galaxypolitics',
-  'universepolitics': 'api/universepolitics',
-  'attackhistory': 'api/attackhistory',
-  'spyhistory': 'api/spyhistory',
-  'missilehistory': 'api/missilehistory',
-  'messages': 'api/messages',
-  'scores': 'api/scores',
-  'notifs': 'api/notifs',
-}
-
 function useInterval(callback, delay) {
   const savedCallback = useRef();
 
@@ -198,53 +163,66 @@ function Content(props) {
   const protocolPrefix = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
   const [socketUrl, setSocketUrl] = useState(protocolPrefix + '//' + hostname + port + '/ws/listen');
   const [messageHistory, setMessageHistory] = useState([]);
-  const { sendMessage, lastMessage, readyState } = useWebSocket(socketUrl);
+  const { sendMessage, lastMessage, readyState } = useWebSocket(socketUrl, {shouldReconnect: () => true});
   const [data, setData] = useState(initGlobalData);
   const [loading, setLoading] = useState(initLoadingData);
   const [initLoadComplete, setInitLoadComplete] = useState(false);
-  const [lastResolves, setLastResolves] = useState({});
+  const eventVersion = useRef(null);
   const [showNav, setShowNav] = useState(false);
   // console.log(data);
   // console.log(loading);
 
   const updateData = async (keys, depFuncs=[]) => {
-    var newValues = JSON.parse(JSON.stringify(data));
-    var newLoading = {...loading};
     var loadKeys = keys;
     if (keys.includes("all")) {
       loadKeys = Object.keys(initGlobalData);
       console.log(loadKeys);
     }
-    for (const key of loadKeys) {
-      newLoading[key] = true;
+    const setKeysLoading = (value) => {
+      setLoading(prev => {
+        var newLoading = {...prev};
+        for (const key of loadKeys) {
+          newLoading[key] = value;
+        }
+        return newLoading;
+      });
     }
-    // console.log(JSON.parse(JSON.stringify(newValues)));
-    // console.log(newLoading);
-    setLoading(newLoading);
+    setKeysLoading(true);
 
     for (const depFunc of depFuncs) {
       await depFunc();
     }
 
     const fetchData = async () => {
-      for (const key of loadKeys) {
-        await authFetch(endpoints[key], {keepalive: true}).then(
-          r => r.json()
-        ).then(r => (newValues[key] = r)).catch(
-          err => {
-            console.log('Failed to fetch ' + key);
-            console.log(err);
-          }
-        );
-        newLoading[key] = false;
-        setData(JSON.parse(JSON.stringify(newValues)));
-        setLoading(newLoading);
-      }
+      // Only the fetched keys are merged into the latest data, so changes applied
+      // by events while the request was in flight are kept
+      var fetched = {};
+      await authFetch('api/bootstrap', {
+        method: 'POST',
+        body: JSON.stringify({"keys": loadKeys}),
+        keepalive: true,
+      }).then(
+        r => r.json()
+      ).then(r => {
+        if (keys.includes("all")) {
+          eventVersion.current = r.events;
+        }
+        for (const [key, value] of Object.entries(r.data)) {
+          fetched[key] = value;
+        }
+        for (const key of r.failed) {
+          console.log('Failed to fetch ' + key);
+        }
+      }).catch(
+        err => {
+          console.log('Failed to fetch ' + loadKeys);
+          console.log(err);
+        }
+      );
+      setData(prev => ({...prev, ...fetched}));
+      setKeysLoading(false);
     }
     await fetchData();
-    
-    // console.log(JSON.parse(JSON.stringify(newValues)));
-    // console.log(JSON.parse(JSON.stringify(newLoading)));
   };
 
   const resolveKeysMap = {
@@ -259,23 +237,25 @@ function Content(props) {
     "shared": ["shared"],
     "auto_spending": ["kingdom", "settle", "structures", "mobis", "engineers"],
   }
-  const refreshData = async () => {
-    // console.log('Updating Data');
-    // console.log(data);
-    // console.log(lastResolves);
-    if (initLoadComplete) {
-      await updateData(["kingdom", "notifs"]);
-      if (Object.keys(lastResolves).length > 0) {
-        const newResolves = Object.keys(lastResolves).filter(key => lastResolves[key] != data.kingdom.next_resolve[key]);
-        // console.log(newResolves);
-        var keysToUpdate = [];
-        for (const resolve of newResolves) {
-          keysToUpdate.push(...resolveKeysMap[resolve])
-        }
-        // console.log(keysToUpdate);
-        updateData(keysToUpdate);
-        setLastResolves(data.kingdom["next_resolve"]);
-      }
+  const handleKingdomEvent = (event) => {
+    // Events are numbered per kingdom, a gap or a new stream means some were missed
+    const lastEvent = eventVersion.current;
+    if (lastEvent === null) {
+      return;
+    }
+    if (lastEvent.stream !== event.stream || event.version !== lastEvent.version + 1) {
+      eventVersion.current = null;
+      updateData(["all"]);
+      return;
+    }
+    eventVersion.current = {stream: event.stream, version: event.version};
+    setData(prev => ({...prev, kingdom: {...prev.kingdom, ...event.kingdom}}));
+    var keysToUpdate = [...event.update];
+    for (const resolve of event.resolved) {
+      keysToUpdate.push(...(resolveKeysMap[resolve] || []));
+    }
+    if (keysToUpdate.length > 0) {
+      updateData([...new Set(keysToUpdate)]);
     }
   }
 
@@ -283,6 +263,10 @@ function Content(props) {
   useEffect(() => {
     if (lastMessage !== null) {
       const jsonMessage = JSON.parse(lastMessage.data);
+      if (jsonMessage.event === "kingdom") {
+        handleKingdomEvent(jsonMessage);
+        return;
+      }
       if ((jsonMessage.update || []).length > 0) {
         updateData(jsonMessage.update);
       }
@@ -292,9 +276,8 @@ function Content(props) {
 
   useEffect(() => {
     if (props.logged) {
-      const keys = Object.keys(initGlobalData);
       const fetchData = async () => {
-        await updateData(keys);
+        await updateData(["all"]);
       }
       fetchData();
       setInitLoadComplete(true);
@@ -313,13 +296,6 @@ function Content(props) {
     }
   }, [props.logged])
 
-  useInterval(() => {
-    if (initLoadComplete) {
-      if (data.kingdomid.created !== false) {
-        refreshData()
-      }
-    }
-  }, 10000)
   useInterval(() => {
     sendMessage(
       JSON.stringify({
@@ -336,10 +312,6 @@ function Content(props) {
   }
 
   // console.log(data);
-  // console.log(lastResolves);
-  if (Object.keys(lastResolves || {}).length == 0 && data.kingdom.hasOwnProperty("next_resolve")) {
-    setLastResolves(data.kingdom.next_resolve);
-  }
 
   
   const toasts = messageHistory.map((message, index) => {
@@ -36,4 +36,17 @@ def test__make_time_splits():
         assert round(test_split, 3) == expected_split
     
     twelve_splits = app_build._make_time_splits(1, 23, 12)
-    assert twelve_splits == [13.0, 11.0, 15.0, 9.0, 17.0, 7.0, 19.0, 5.0, 21.0, 3.0, 23.0, 1.0]
\ No newline at end of file
+    assert twelve_splits == [13.0, 11.0, 15.0, 9.0, 17.0, 7.0, 19.0, 5.0, 21.0, 3.0, 23.0, 1.0]
+
+def test__get_new_mobis_bucket_times(monkeypatch):
+    bucket_seconds = 300
+    monkeypatch.setitem(app_build.uas.GAME_CONFIG, "BASE_QUEUE_BUCKET_SECONDS", bucket_seconds)
+    start_time = datetime.datetime(2030, 1, 1, 0, 0, 7, tzinfo=datetime.timezone.utc)
+
+    new_mobis, min_mobi_time = app_build._get_new_mobis({"attack": 100}, start_time)
+    for mobi in new_mobis:
+        completion_time = datetime.datetime.fromisoformat(mobi["time"])
+        assert completion_time.timestamp() % bucket_seconds == 0
+        assert completion_time >= start_time
+    assert min_mobi_time == min(mobi["time"] for mobi in new_mobis)
+    assert sum(mobi["attack"] for mobi in new_mobis) == 100
@@ -0,0 +1,42 @@
+import pytest
+import time
+from api.untitledapp.cache import TTLCache
+
+def test_ttl_cache_hit_and_copy():
+    cache = TTLCache()
+    cache.set("/state", {"state": {"game_start": "2099"}})
+
+    cached, value = cache.get("/state", ttl=60)
+    assert cached
+    assert value == {"state": {"game_start": "2099"}}
+
+    value["state"]["game_start"] = "changed"
+    _, value_again = cache.get("/state", ttl=60)
+    assert value_again["state"]["game_start"] == "2099"
+
+    stats = cache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 0
+    assert stats["hit_ratio"] == 1.0
+
+def test_ttl_cache_expiry_and_invalidate():
+    cache = TTLCache()
+    cache.set("/empires", {"empires": {}})
+    time.sleep(0.02)
+    assert cache.get("/empires", ttl=0.01) == (False, None)
+    assert cache.stats()["expired"] == 1
+
+    cache.set("/empires", {"empires": {}})
+    cache.invalidate("/empires")
+    assert cache.get("/empires", ttl=60) == (False, None)
+
+def test_ttl_cache_lru_eviction():
+    cache = TTLCache(max_entries=2)
+    cache.set("/state", 1)
+    cache.set("/galaxies", 2)
+    cache.get("/state", ttl=60)
+    cache.set("/empires", 3)
+
+    assert cache.get("/galaxies", ttl=60) == (False, None)
+    assert cache.get("/state", ttl=60) == (True, 1)
+    assert cache.stats()["evictions"] == 1
@@ -0,0 +1,47 @@
+import json
+import flask
+import pytest
+import api.untitledapp.events as app_events
+import api.untitledapp.notify as app_notify
+
+class _FakeSocket:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(json.loads(data))
+
+@pytest.fixture
+def hub():
+    app = flask.Flask(__name__)
+    hub = app_notify.create_hub("memory")
+    app.extensions["notify_hub"] = hub
+    with app.app_context():
+        yield hub
+
+def test_kingdom_changes_only_changed_fields():
+    old_kd_info = {"money": 10, "fuel": 5, "next_resolve": {"mobis": "a"}}
+    new_kd_info = {"money": 12, "fuel": 5, "next_resolve": {"mobis": "b"}, "stars": 3}
+    assert app_events.kingdom_changes(old_kd_info, new_kd_info) == {
+        "money": 12,
+        "next_resolve": {"mobis": "b"},
+        "stars": 3,
+    }
+
+def test_publish_versions_are_consecutive(hub):
+    ws = _FakeSocket()
+    connection = hub.register("1", ws)
+
+    app_events.publish_kingdom_event("1", kingdom={"money": 1})
+    assert app_events.publish_kingdom_event("1") is None
+    app_events.publish_kingdom_event("1", resolved=["mobis"])
+    hub.flush()
+    connection.send_queued(timeout=0)
+
+    assert [event["version"] for event in ws.sent] == [1, 2]
+    assert ws.sent[1]["resolved"] == ["mobis"]
+    assert ws.sent[0]["stream"] == app_events.current_version("1")["stream"]
+
+def test_publish_without_listener_still_takes_a_version(hub):
+    app_events.publish_kingdom_event("2", update=["notifs"])
+    assert app_events.current_version("2")["version"] == 1
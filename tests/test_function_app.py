@@ -0,0 +1,211 @@
+import copy
+import datetime
+import importlib.util
+import itertools
+import json
+import pathlib
+
+import pytest
+
+func = pytest.importorskip("azure.functions")
+cosmos = pytest.importorskip("azure.cosmos")
+from azure.cosmos import exceptions
+
+import api.untitledapp.storage as app_storage
+
+FUNCTION_APP_PATH = pathlib.Path(__file__).parent.parent / "funcapp" / "function_app.py"
+
+
+class FakeContainer:
+    """Items by id, with the etag, patch and query behaviour the function app relies on"""
+
+    def __init__(self):
+        self.items = {}
+        self.etags = itertools.count()
+        self.conflicts = 0
+
+    def _stored(self, item):
+        item = copy.deepcopy(item)
+        item["_etag"] = str(next(self.etags))
+        self.items[item["id"]] = item
+        return copy.deepcopy(item)
+
+    def read_item(self, item, partition_key):
+        if item not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message=item)
+        return copy.deepcopy(self.items[item])
+
+    def create_item(self, body):
+        if body["id"] in self.items:
+            raise exceptions.CosmosResourceExistsError(status_code=409, message=body["id"])
+        return self._stored(body)
+
+    def upsert_item(self, body):
+        return self._stored(body)
+
+    def replace_item(self, item, body, etag=None, match_condition=None):
+        self._check_etag(item, etag)
+        return self._stored(body)
+
+    def patch_item(self, item, partition_key, patch_operations, etag=None, match_condition=None, filter_predicate=None):
+        self._check_etag(item, etag)
+        return self._stored(app_storage._apply_operations(self.read_item(item, partition_key), patch_operations))
+
+    def query_items(self, query, parameters=None, enable_cross_partition_query=None):
+        scheduled = [
+            item
+            for item in self.items.values()
+            if item.get("type") == "kingdom" and isinstance(item.get("resolve_due"), (int, float))
+        ]
+        if "COUNT(1)" in query:
+            return iter([len(scheduled)])
+        before = parameters[0]["value"]
+        return iter([item["kdId"] for item in scheduled if item["resolve_due"] <= before])
+
+    def _check_etag(self, item_id, etag):
+        if self.conflicts:
+            self.conflicts -= 1
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412, message=item_id)
+        if etag is not None and self.items[item_id]["_etag"] != etag:
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412, message=item_id)
+
+
+@pytest.fixture
+def function_app(monkeypatch):
+    container = FakeContainer()
+
+    class FakeClient:
+        def __init__(self, url, credential):
+            pass
+
+        def create_database_if_not_exists(self, id):
+            return self
+
+        def get_container_client(self, name):
+            return container
+
+    monkeypatch.setenv("COSMOS_ENDPOINT", "https://cosmos.invalid")
+    monkeypatch.setenv("COSMOS_KEY", "key")
+    monkeypatch.setattr(cosmos, "CosmosClient", FakeClient)
+    spec = importlib.util.spec_from_file_location("function_app", FUNCTION_APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def _create_kingdom(function_app, kd_id="0", **fields):
+    return function_app.CONTAINER.create_item({"id": f"kingdom_{kd_id}", "kdId": kd_id, "type": "kingdom", **fields})
+
+def _due_kingdoms(function_app, before):
+    get_due_kingdoms = function_app.get_due_kingdoms.build().get_user_function()
+    response = get_due_kingdoms(func.HttpRequest(
+        method="GET",
+        url="/api/resolveschedule",
+        params={"before": before},
+        body=b"",
+    ))
+    return json.loads(response.get_body())
+
+def test_schedule_kingdom_keeps_due_time_on_the_kingdom(function_app):
+    due = "2030-01-01T01:00:00+00:00"
+    kd = _create_kingdom(function_app, next_resolve={"mobis": due})
+    kd = function_app._schedule_kingdom("0", kd)
+    assert kd["resolve_due"] == datetime.datetime.fromisoformat(due).timestamp()
+    _create_kingdom(function_app, "1")
+    assert _due_kingdoms(function_app, "2030-01-01T02:00:00+00:00") == {"kingdoms": ["0"], "scheduled": 1}
+    assert _due_kingdoms(function_app, "2030-01-01T00:00:00+00:00") == {"kingdoms": [], "scheduled": 1}
+
+    kd = function_app._patch_item("kingdom_0", [{"op": "set", "path": "/status", "value": "Dead"}])
+    function_app._schedule_kingdom("0", kd)
+    assert _due_kingdoms(function_app, "2030-01-01T02:00:00+00:00") == {"kingdoms": [], "scheduled": 0}
+
+def test_schedule_kingdom_recomputes_after_a_conflict(function_app):
+    stale_kd = _create_kingdom(function_app, next_resolve={"mobis": "2030-01-01T05:00:00+00:00"})
+    # Another writer moves the due time earlier after stale_kd was read
+    function_app._patch_item("kingdom_0", [{"op": "set", "path": "/next_resolve/settles", "value": "2030-01-01T01:00:00+00:00"}])
+    kd = function_app._schedule_kingdom("0", stale_kd)
+    assert kd["resolve_due"] == datetime.datetime.fromisoformat("2030-01-01T01:00:00+00:00").timestamp()
+
+def test_reschedule_kingdom_reports_failure(function_app):
+    kd = _create_kingdom(function_app, auto_rob_enabled=True)
+    assert function_app._reschedule_kingdom("0", kd, {"money": 5})
+    assert "resolve_due" not in function_app.CONTAINER.items["kingdom_0"]
+
+    function_app.CONTAINER.conflicts = function_app.RESOLVE_SCHEDULE_RETRIES
+    assert not function_app._reschedule_kingdom("0", kd, {"auto_rob_enabled": True})
+    assert "resolve_due" not in function_app.CONTAINER.items["kingdom_0"]
+    assert function_app._reschedule_kingdom("0", kd, {"auto_rob_enabled": True})
+    assert function_app.CONTAINER.items["kingdom_0"]["resolve_due"] == 0.0
+
+def _update_empire_aggression(function_app, empire_id, body):
+    update_empire_aggression = function_app.update_empire_aggression.build().get_user_function()
+    return update_empire_aggression(func.HttpRequest(
+        method="PATCH",
+        url=f"/api/empire/{empire_id}/aggression",
+        route_params={"empireId": empire_id},
+        body=json.dumps(body).encode(),
+    ))
+
+def test_empire_aggression_moves_off_the_empires_item(function_app):
+    function_app.CONTAINER.create_item({"id": "empires", "empires": {"0": {"name": "e0", "aggression": {"1": 5}}}})
+    response = _update_empire_aggression(function_app, "0", {"deltas": {"1": 2}})
+    assert response.status_code == 200
+    assert json.loads(response.get_body())["aggression"] == {"1": 7}
+    assert function_app.CONTAINER.items["empire_aggression_0"]["aggression"] == {"1": 7}
+
+def test_empire_aggression_decay_retries_on_etag_conflict(function_app):
+    function_app.CONTAINER.create_item({"id": "empire_aggression_0", "aggression": {"1": 10, "2": 1}})
+    function_app.CONTAINER.conflicts = 2
+    response = _update_empire_aggression(function_app, "0", {"deltas": {"1": 5}, "decay": 3})
+    assert response.status_code == 200
+    assert function_app.CONTAINER.conflicts == 0
+    assert function_app.CONTAINER.items["empire_aggression_0"]["aggression"] == {"1": 12, "2": 0}
+
+    function_app.CONTAINER.conflicts = function_app.AGGRESSION_PATCH_RETRIES
+    response = _update_empire_aggression(function_app, "0", {"decay": 3})
+    assert response.status_code == 409
+    assert function_app.CONTAINER.items["empire_aggression_0"]["aggression"] == {"1": 12, "2": 0}
+
+def _batch_commit(function_app, items):
+    batch_commit = function_app.batch_commit.build().get_user_function()
+    response = batch_commit(func.HttpRequest(
+        method="POST",
+        url="/api/batch/commit",
+        body=json.dumps({"items": items}).encode(),
+    ))
+    return response.status_code, json.loads(response.get_body())
+
+def _fail_patching(function_app, monkeypatch, item_id, before_failing=lambda: None):
+    patch_item = function_app.CONTAINER.patch_item
+    def failing_patch_item(item, *args, **kwargs):
+        if item == item_id:
+            before_failing()
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412, message=item)
+        return patch_item(item, *args, **kwargs)
+    monkeypatch.setattr(function_app.CONTAINER, "patch_item", failing_patch_item)
+
+def test_batch_commit_restores_written_items(function_app, monkeypatch):
+    _create_kingdom(function_app, "0", money=1)
+    _create_kingdom(function_app, "1", money=1)
+    _fail_patching(function_app, monkeypatch, "kingdom_1")
+    status_code, body = _batch_commit(function_app, [
+        {"id": "kingdom_0", "merge": {"money": 5}},
+        {"id": "kingdom_1", "merge": {"money": 5}},
+    ])
+    assert (status_code, body) == (409, {"committed": False, "failed": ["kingdom_1"]})
+    assert function_app.CONTAINER.items["kingdom_0"]["money"] == 1
+
+def test_batch_commit_reports_items_it_could_not_restore(function_app, monkeypatch):
+    _create_kingdom(function_app, "0", money=1)
+    _create_kingdom(function_app, "1", money=1)
+    def concurrent_write():
+        # Another writer lands on kingdom_0 after the commit wrote it
+        kd = function_app.CONTAINER.read_item("kingdom_0", "kingdom_0")
+        function_app.CONTAINER.upsert_item({**kd, "stars": 7})
+    _fail_patching(function_app, monkeypatch, "kingdom_1", concurrent_write)
+    status_code, body = _batch_commit(function_app, [
+        {"id": "kingdom_0", "merge": {"money": 5}},
+        {"id": "kingdom_1", "merge": {"money": 5}},
+    ])
+    assert (status_code, body) == (500, {"committed": False, "failed": ["kingdom_1"], "not_restored": ["kingdom_0"]})
+    # The other writer's change is kept rather than overwritten by the stale original
+    assert function_app.CONTAINER.items["kingdom_0"]["stars"] == 7
@@ -0,0 +1,48 @@
+import api.untitledapp.history as app_history
+
+def test_downsample_short_window_unchanged():
+    series = app_history.Series([0, 10, 20], [1, 2, 3])
+    assert series.downsample(5) == [(0, 1, 1, 1), (10, 2, 2, 2), (20, 3, 3, 3)]
+    assert series.downsample(5, since=10) == [(10, 2, 2, 2), (20, 3, 3, 3)]
+    assert series.downsample(5, before=10) == [(0, 1, 1, 1)]
+
+def test_downsample_min_max_last():
+    values = [5, 1, 9, 4, 2, 8, 3, 7]
+    series = app_history.Series(range(len(values)), values)
+    assert series.downsample(2, since=0, before=8) == [
+        (3, 1, 9, 4),
+        (7, 2, 8, 7),
+    ]
+    assert len(series.downsample(3)) == 3
+
+def test_window_bisects_times():
+    series = app_history.Series([0, 10, 20, 30], [0, 0, 0, 0])
+    assert series.window() == (0, 4)
+    assert series.window(since=5, before=30) == (1, 3)
+    assert series.window(since=40) == (4, 4)
+
+def test_chart_points():
+    series = app_history.Series([0, 3600], [1.0, 2.5])
+    assert app_history.chart_points(series, 10) == [
+        {"time": "1970-01-01T00:00:00+00:00", "value": 1, "min": 1, "max": 1},
+        {"time": "1970-01-01T01:00:00+00:00", "value": 2.5, "min": 2.5, "max": 2.5},
+    ]
+
+def test_export_rows_downsampled_to_shared_grid():
+    series_by_kd = {
+        "1": {
+            "stars": app_history.Series([0, 5, 10, 15], [100, 110, 120, 130]),
+            "networth": app_history.Series([0, 5, 10, 15], [1, 2, 3, 4]),
+        },
+        "2": {
+            "stars": app_history.Series([4, 16], [50, 60]),
+        },
+    }
+    rows = app_history.export_rows(series_by_kd, {"1": "kd1", "2": "kd2"}, ["stars", "networth"], points=2)
+    assert rows == [
+        ["1970-01-01T00:00:00+00:00", "1", "kd1", 110, 2],
+        ["1970-01-01T00:00:00+00:00", "2", "kd2", 50, None],
+        ["1970-01-01T00:00:08+00:00", "1", "kd1", 130, 4],
+        ["1970-01-01T00:00:08+00:00", "2", "kd2", 60, None],
+    ]
+    assert len(app_history.export_rows(series_by_kd, {}, ["stars"])) == 6
@@ -0,0 +1,99 @@
+import pytest
+import copy
+import datetime
+import random
+import api.untitledapp.refresh as app_refresh
+import api.untitledapp.shared as app_shared
+
+def _random_kingdom(rng, kd_id, time_now):
+    kd_info = copy.deepcopy(app_shared.INITIAL_KINGDOM_STATE["kingdom"])
+    kd_info["kdId"] = str(kd_id)
+    kd_info["race"] = rng.choice(app_shared.RACES)
+    kd_info["stars"] = rng.randint(100, 3000)
+    kd_info["population"] = rng.uniform(1000, 200000)
+    kd_info["fuel"] = rng.uniform(-20000, 200000)
+    kd_info["money"] = rng.uniform(0, 1000000)
+    kd_info["drones"] = rng.uniform(0, 100000)
+    kd_info["last_income"] = (time_now - datetime.timedelta(seconds=rng.uniform(1, 3600))).isoformat()
+    for key_structure in kd_info["structures"]:
+        kd_info["structures"][key_structure] = rng.uniform(0, kd_info["stars"] / 3)
+    for key_unit in kd_info["units"]:
+        kd_info["units"][key_unit] = rng.randint(0, 20000)
+    kd_info["generals_out"] = [
+        {
+            "attack": rng.randint(0, 5000),
+            "flex": rng.randint(0, 5000),
+            "return_time": time_now.isoformat(),
+        }
+        for _ in range(rng.randint(0, 3))
+    ]
+    for key_shield in kd_info["shields"]:
+        kd_info["shields"][key_shield] = rng.choice([0.0, rng.uniform(0, 0.1)])
+    kd_info["auto_spending_enabled"] = rng.random() < 0.5
+    for key_spending in kd_info["auto_spending"]:
+        kd_info["auto_spending"][key_spending] = rng.uniform(0, 0.25)
+    for key_project in kd_info["projects_assigned"]:
+        kd_info["projects_assigned"][key_project] = rng.randint(0, 500)
+    return kd_info
+
+def _current_bonuses(kd_info):
+    return {
+        project: project_dict.get("max_bonus", 0) * min(kd_info["projects_points"][project] / kd_info["projects_max_points"][project], 1.0)
+        for project, project_dict in app_shared.PROJECTS.items()
+        if "max_bonus" in project_dict
+    }
+
+def test_batch_income_matches_scalar(monkeypatch):
+    rng = random.Random(1234)
+    time_now = datetime.datetime.now(datetime.timezone.utc)
+    state = {"state": {"active_policies": ["Free Trade"]}}
+    kd_infos = [_random_kingdom(rng, kd_id, time_now) for kd_id in range(200)]
+    current_bonuses = [_current_bonuses(kd_info) for kd_info in kd_infos]
+
+    monkeypatch.setattr(app_refresh, "_resolve_siphons", lambda gross_income, kd_id, time_update, epoch_elapsed: (0, 0.0, []))
+    monkeypatch.setattr(app_refresh.uag, "_get_mobis_queue", lambda kd_id: [])
+    monkeypatch.setattr(app_refresh.uam, "_mark_kingdom_death", lambda kd_id: None)
+
+    scalar_kd_infos = [
+        app_refresh._kingdom_with_income(copy.deepcopy(kd_info), bonuses, state, time_now)
+        for kd_info, bonuses in zip(kd_infos, current_bonuses)
+    ]
+    batch_kd_infos = [
+        app_refresh._complete_projects(new_kd_info)
+        for new_kd_info in app_refresh.uai.kingdoms_with_income(kd_infos, current_bonuses, state, time_now)
+    ]
+
+    for scalar_kd_info, batch_kd_info in zip(scalar_kd_infos, batch_kd_infos):
+        for key in ["money", "fuel", "drones", "population"]:
+            assert batch_kd_info[key] == pytest.approx(scalar_kd_info[key], rel=1e-6, abs=1e-3)
+        assert abs(batch_kd_info["networth"] - scalar_kd_info["networth"]) <= 1
+        assert batch_kd_info["structures"] == pytest.approx(scalar_kd_info["structures"], rel=1e-6, abs=1e-6)
+        assert batch_kd_info["funding"] == pytest.approx(scalar_kd_info["funding"], rel=1e-6, abs=1e-3)
+        assert batch_kd_info["shields"] == scalar_kd_info["shields"]
+        assert batch_kd_info["completed_projects"] == scalar_kd_info["completed_projects"]
+        assert batch_kd_info["income"]["money"] == pytest.approx(scalar_kd_info["income"]["money"], rel=1e-6, abs=1e-6)
+        assert batch_kd_info["income"]["fuel"]["net"] == pytest.approx(scalar_kd_info["income"]["fuel"]["net"], rel=1e-6, abs=1e-6)
+
+def test_project_kingdom_matches_tick(monkeypatch):
+    rng = random.Random(4321)
+    time_now = datetime.datetime.now(datetime.timezone.utc)
+    state = {"state": {"active_policies": []}}
+    kd_infos = [_random_kingdom(rng, kd_id, time_now) for kd_id in range(20)]
+
+    monkeypatch.setattr(app_refresh, "_resolve_siphons", lambda gross_income, kd_id, time_update, epoch_elapsed: (0, 0.0, []))
+    monkeypatch.setattr(app_refresh.uag, "_get_mobis_queue", lambda kd_id: [])
+    monkeypatch.setattr(app_refresh.uam, "_mark_kingdom_death", lambda kd_id: None)
+
+    for kd_info in kd_infos:
+        kd_info["status"] = "Active"
+        projected_kd_info = app_refresh.uai.project_kingdom(kd_info, state, time_now)
+        tick_kd_info = app_refresh._kingdom_with_income(copy.deepcopy(kd_info), _current_bonuses(kd_info), state, time_now)
+        for key in ["money", "fuel", "drones", "population"]:
+            assert projected_kd_info[key] == pytest.approx(tick_kd_info[key], rel=1e-6, abs=1e-3)
+        assert projected_kd_info["last_income"] == time_now.isoformat()
+        assert projected_kd_info["last_siphons"] == kd_info["last_income"]
+        assert projected_kd_info["status"] == "Active"
+
+        # Settled past the tick's time, so the tick leaves the kingdom as it is
+        assert app_refresh._kingdom_with_income(projected_kd_info, _current_bonuses(kd_info), state, time_now) is projected_kd_info
+        assert app_refresh.uai.project_kingdom(projected_kd_info, state, time_now) == projected_kd_info
@@ -0,0 +1,37 @@
+import random
+import api.untitledapp.leaderboard as app_leaderboard
+
+def test_index_matches_full_sort_after_updates():
+    rng = random.Random(7)
+    index = app_leaderboard.SortedIndex()
+    values = {str(kd_id): rng.randint(0, 1000) for kd_id in range(200)}
+    index.sync(values)
+    for _ in range(500):
+        kd_id = str(rng.randint(0, 250))
+        values[kd_id] = rng.randint(0, 1000)
+        index.update(kd_id, values[kd_id])
+
+    expected = sorted(values.items(), key=lambda item: (-item[1], item[0]))
+    assert index.top() == expected
+    assert index.top(10) == expected[:10]
+
+def test_sync_only_moves_changed_ids():
+    index = app_leaderboard.SortedIndex()
+    index.sync({"1": 10, "2": 20, "3": 30})
+    assert index.sync({"1": 10, "2": 25, "3": 30}) == 1
+    assert index.sync({"1": 10, "3": 30}) == 0
+    assert index.top() == [("3", 30), ("1", 10)]
+
+def test_leaderboard_skips_sync_for_same_update():
+    leaderboard = app_leaderboard.Leaderboard()
+    scores = {
+        "last_update": "2030-01-01T00:00:00+00:00",
+        "networth": {"1": 5, "2": 7},
+        "stars": {"1": 300, "2": 200},
+        "points": {},
+        "galaxy_networth": {"1:1": 12},
+    }
+    assert leaderboard.sync(scores) == 5
+    assert leaderboard.sync({**scores, "networth": {"1": 9, "2": 7}}) == 0
+    assert leaderboard.top("networth", 1) == [("2", 7)]
+    assert leaderboard.top("stars") == [("1", 300), ("2", 200)]
@@ -0,0 +1,90 @@
+import pytest
+import threading
+import time
+import api.untitledapp.misc as app_misc
+from api.untitledapp.locks import InProcessLockManager, LockManager
+
+def test_in_process_lock_set_is_all_or_nothing():
+    manager = InProcessLockManager()
+    assert manager.acquire(["/kingdom/1", "/empires"], request_id="first")
+    assert not manager.acquire(["/kingdom/2", "/empires"], wait=0.01, request_id="second")
+    assert manager.acquire(["/kingdom/2"], request_id="second")
+
+    manager.release_id("first")
+    assert manager.acquire(["/kingdom/1", "/empires"], request_id="third")
+
+def test_incomplete_lock_manager_fails_when_constructed():
+    class AcquireOnly(LockManager):
+        def acquire(self, lock_names, wait=0, lease=20, request_id=None):
+            return True
+
+    with pytest.raises(TypeError):
+        AcquireOnly()
+
+def test_in_process_lock_lease_expires():
+    manager = InProcessLockManager()
+    assert manager.acquire(["/scores"], lease=0.02)
+    assert manager.acquire(["/scores"], wait=1)
+
+def test_in_process_lock_waiters_are_fifo():
+    manager = InProcessLockManager()
+    manager.acquire(["/empires"], request_id="holder")
+    order = []
+
+    def _waiter(request_id):
+        assert manager.acquire(["/empires"], wait=5, request_id=request_id)
+        order.append(request_id)
+        manager.release_id(request_id)
+
+    threads = []
+    for request_id in ["waiter_1", "waiter_2", "waiter_3"]:
+        thread = threading.Thread(target=_waiter, args=(request_id,))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.02)
+    manager.release_id("holder")
+    for thread in threads:
+        thread.join()
+
+    assert order == ["waiter_1", "waiter_2", "waiter_3"]
+
+def test_lock_stats_count_busy_apart_from_timeouts(app, monkeypatch):
+    monkeypatch.setattr(app_misc, "_LOCK_TELEMETRY", {})
+    monkeypatch.setattr(app_misc, "_LOCK_ACQUIRED_AT", {})
+    with app.app_context():
+        assert app_misc.acquire_lock("/kingdom/1", settle=False)
+        assert not app_misc.acquire_lock("/kingdom/1", settle=False)
+        assert not app_misc.acquire_lock("/kingdom/1", wait=0.01, settle=False)
+        assert not app_misc.acquire_locks(["/kingdom/1", "/empires"], timeout=0.01, settle=False)
+        app_misc.release_lock("/kingdom/1")
+
+    stats = app_misc._get_lock_stats()
+    assert {key: stats["/kingdom/{id}"][key] for key in ["acquired", "timeouts", "busy", "busy_responses"]} == {
+        "acquired": 1,
+        "timeouts": 2,
+        "busy": 1,
+        "busy_responses": 0,
+    }
+    assert stats["/kingdom/{id}"]["wait"]["count"] == 4
+    assert stats["/kingdom/{id}"]["hold"]["count"] == 1
+    assert stats["/empires"]["timeouts"] == 1
+
+def test_percentiles():
+    assert app_misc._percentiles([]) == {"count": 0}
+    assert app_misc._percentiles(range(100, 0, -1)) == {"count": 100, "p50": 50, "p90": 90, "p99": 99, "max": 100}
+
+def test_lock_is_released_when_settling_fails(app, monkeypatch):
+    monkeypatch.setitem(app.config, "CONTINUOUS_INCOME", True)
+    monkeypatch.setattr(app_misc.uag, "_batch_read", lambda item_ids: {item_id: {"mobis": []} for item_id in item_ids})
+    monkeypatch.setattr(app_misc.uag, "_project_kd_info", lambda kd_info, mobis_queue: {"last_income": "later", "money": 5})
+    monkeypatch.setattr(app_misc.uag, "_batch_patch", lambda patches, retries=0: list(patches))
+    with app.app_context():
+        assert not app_misc.acquire_lock("/kingdom/7")
+        assert not app_misc.acquire_locks(["/kingdom/7", "/kingdom/8"], timeout=0)
+        # Nothing is left held, so a holder that does not settle gets the locks
+        assert app_misc.acquire_locks(["/kingdom/7", "/kingdom/8"], timeout=0, settle=False)
+        app_misc.release_locks_by_name(["/kingdom/7", "/kingdom/8"])
+
+        monkeypatch.setattr(app_misc.uag, "_batch_patch", lambda patches, retries=0: [])
+        assert app_misc.acquire_lock("/kingdom/7")
+        app_misc.release_lock("/kingdom/7")
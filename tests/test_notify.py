@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+import pytest
+import api.untitledapp.notify as app_notify
+
+class _FakeSocket:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(json.loads(data))
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def test_every_connection_of_a_kingdom_receives():
+    hub = app_notify.create_hub("memory")
+    first_tab = _FakeSocket()
+    second_tab = _FakeSocket()
+    other_kd = _FakeSocket()
+    connections = [
+        hub.register("1", first_tab),
+        hub.register("1", second_tab),
+        hub.register("2", other_kd),
+    ]
+
+    hub.publish("1", {"message": "hello"})
+    hub.flush()
+    for connection in connections:
+        connection.send_queued(timeout=0)
+
+    assert first_tab.sent == [{"message": "hello"}]
+    assert second_tab.sent == [{"message": "hello"}]
+    assert other_kd.sent == []
+
+def test_unregistered_connections_stop_receiving():
+    hub = app_notify.create_hub("memory")
+    ws = _FakeSocket()
+    connection = hub.register("1", ws)
+    hub.unregister("1", connection)
+
+    hub.publish("1", {"message": "hello"})
+    hub.flush()
+    connection.send_queued(timeout=0)
+
+    assert ws.sent == []
+    assert hub.connection_count("1") == 0
+
+def test_full_connection_drops_toasts_before_events():
+    ws = _FakeSocket()
+    connection = app_notify.Connection(ws, max_queued=3)
+    connection.offer(json.dumps({"message": "first toast"}), True)
+    connection.offer(json.dumps({"event": "kingdom", "version": 1}), False)
+    connection.offer(json.dumps({"message": "second toast"}), True)
+    connection.offer(json.dumps({"event": "kingdom", "version": 2}), False)
+    connection.offer(json.dumps({"event": "kingdom", "version": 3}), False)
+
+    connection.send_queued(timeout=0)
+
+    assert [message.get("version") for message in ws.sent] == [1, 2, 3]
+    assert connection.dropped == 2
+
+def test_stale_toasts_are_not_sent(monkeypatch):
+    ws = _FakeSocket()
+    connection = app_notify.Connection(ws)
+    connection.offer(json.dumps({"message": "old news"}), True)
+    connection.offer(json.dumps({"event": "kingdom", "version": 1}), False)
+    monkeypatch.setattr(app_notify, "TOAST_MAX_AGE_SECONDS", -1)
+
+    connection.send_queued(timeout=0)
+
+    assert ws.sent == [{"event": "kingdom", "version": 1}]
+
+def test_sqlite_backplane_fans_out_across_hubs(tmp_path):
+    path = str(tmp_path / "notify.sqlite")
+    publishing_hub = app_notify.create_hub("sqlite", path)
+    listening_hub = app_notify.create_hub("sqlite", path)
+    ws = _FakeSocket()
+    connection = listening_hub.register("1", ws)
+
+    publishing_hub.publish("1", {"message": "from another worker"})
+
+    assert _wait_for(lambda: connection.send_queued(timeout=0.05) or ws.sent)
+    assert ws.sent == [{"message": "from another worker"}]
+
+def test_sqlite_versions_are_shared(tmp_path):
+    path = str(tmp_path / "notify.sqlite")
+    first_hub = app_notify.create_hub("sqlite", path)
+    second_hub = app_notify.create_hub("sqlite", path)
+
+    assert first_hub.next_version("1")["version"] == 1
+    assert second_hub.next_version("1")["version"] == 2
+    assert first_hub.current_version("1") == second_hub.current_version("1")
+
+def test_stats_count_publishes_from_every_thread():
+    hub = app_notify.create_hub("memory")
+    hub.register("1", _FakeSocket())
+
+    def _publish_many():
+        for _ in range(500):
+            hub.publish("1", {"message": "hello"})
+
+    threads = [threading.Thread(target=_publish_many) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    hub.flush()
+
+    stats = hub.stats()
+    assert stats["published"] == 4000
+    assert stats["delivered"] == 4000
+
+def test_incomplete_backplane_fails_when_constructed():
+    class PublishOnly(app_notify.Backplane):
+        def publish(self, kd_id, data):
+            pass
+
+    with pytest.raises(TypeError):
+        PublishOnly()
@@ -0,0 +1,34 @@
+import datetime
+import api.untitledapp.queues as app_queues
+
+TIME_NOW = datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc)
+
+def _entry(hours, **amounts):
+    return {"time": (TIME_NOW + datetime.timedelta(hours=hours)).isoformat(), **amounts}
+
+def test_unsorted_entries_are_sorted_once():
+    queue = app_queues.BuildQueue([_entry(3, attack=1), _entry(1, attack=2), _entry(2, attack=4)])
+    assert [entry["attack"] for entry in queue] == [2, 4, 1]
+    assert queue.times == sorted(queue.times)
+    assert queue.top(2) == [_entry(1, attack=2), _entry(2, attack=4)]
+
+def test_document_with_times_is_trusted():
+    document = {"mobis": [_entry(1, attack=2)], "times": [123.0]}
+    queue = app_queues.BuildQueue.from_document(document, "mobis")
+    assert queue.times == [123.0]
+    assert queue.to_document("mobis") == document
+
+def test_totals_before():
+    queue = app_queues.BuildQueue([_entry(1, attack=2), _entry(2, attack=4, defense=1), _entry(5, defense=3)])
+    horizon = lambda hours: (TIME_NOW + datetime.timedelta(hours=hours)).timestamp()
+    assert queue.totals_before(horizon(1), ["attack", "defense"]) == {"attack": 0, "defense": 0}
+    assert queue.totals_before(horizon(4), ["attack", "defense"]) == {"attack": 6, "defense": 1}
+    assert queue.totals_before(horizon(24), ["attack", "defense"]) == {"attack": 6, "defense": 4}
+
+def test_pop_due():
+    queue = app_queues.BuildQueue([_entry(2, amount=4), _entry(1, amount=2), _entry(5, amount=3)])
+    due, remaining = queue.pop_due((TIME_NOW + datetime.timedelta(hours=3)).timestamp())
+    assert due == [_entry(1, amount=2), _entry(2, amount=4)]
+    assert list(remaining) == [_entry(5, amount=3)]
+    assert remaining.next_time() == (TIME_NOW + datetime.timedelta(hours=5)).timestamp()
+    assert app_queues.BuildQueue().next_time() is None
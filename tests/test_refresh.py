@@ -0,0 +1,78 @@
+import datetime
+
+import pytest
+import api.untitledapp.leaderboard as app_leaderboard
+import api.untitledapp.refresh as app_refresh
+
+@pytest.fixture
+def tick_stats(monkeypatch):
+    stats = {
+        **app_refresh._TICK_STATS,
+        "lag": app_refresh.collections.deque(maxlen=app_refresh.TICK_STATS_WINDOW),
+        "seconds": app_refresh.collections.deque(maxlen=app_refresh.TICK_STATS_WINDOW),
+    }
+    monkeypatch.setattr(app_refresh, "_TICK_STATS", stats)
+    return stats
+
+# refresh reads the speed from its own copy of shared, imported as untitledapp.shared
+@pytest.fixture
+def standard_speed():
+    yield
+    app_refresh.uas.apply_game_speed(1)
+
+def _state(**fields):
+    return {"state": fields}
+
+def test_tick_lag(tick_stats):
+    cadence = app_refresh.uas.GAME_CONFIG["BASE_TICK_SECONDS"]
+    time_update = datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc)
+    assert app_refresh._tick_lag(_state(), time_update) == (0.0, False)
+
+    last_start = (time_update - datetime.timedelta(seconds=cadence * 1.5)).isoformat()
+    assert app_refresh._tick_lag(_state(last_tick_start=last_start, last_tick_seconds=cadence / 2), time_update) == (cadence / 2, False)
+
+    # A tick that overran its cadence puts the next one behind however soon it starts
+    last_start = (time_update - datetime.timedelta(seconds=cadence)).isoformat()
+    assert app_refresh._tick_lag(_state(last_tick_start=last_start, last_tick_seconds=cadence * 2), time_update) == (0.0, True)
+
+    app_refresh._record_tick(cadence / 2, 0.0, False)
+    app_refresh._record_tick(cadence * 2, 0.0, True)
+    stats = app_refresh._get_tick_stats()
+    assert stats["ticks"] == 2
+    assert stats["behind"] == 1
+    assert stats["seconds"]["max"] == cadence * 2
+
+def test_slow_trigger_does_not_defer_scores(standard_speed):
+    app_refresh.uas.apply_game_speed("hyper")
+    cadence = app_refresh.uas.GAME_CONFIG["BASE_TICK_SECONDS"]
+    time_update = datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc)
+    # Triggered every minute while the cadence is a couple of seconds
+    state = _state(
+        last_tick_start=(time_update - datetime.timedelta(seconds=60)).isoformat(),
+        last_tick_seconds=cadence / 4,
+    )
+    lag, behind = app_refresh._tick_lag(state, time_update)
+    assert lag == pytest.approx(60 - cadence)
+    assert not behind
+    history_datetime = time_update - datetime.timedelta(seconds=1)
+    assert app_refresh._deferred_work_due(history_datetime, time_update, behind) == (True, True)
+
+def test_ticks_behind_run_overdue_history(standard_speed):
+    app_refresh.uas.apply_game_speed("hyper")
+    epoch = app_refresh.uas.GAME_CONFIG["BASE_EPOCH_SECONDS"]
+    time_update = datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc)
+    history_datetime = time_update - datetime.timedelta(seconds=epoch / 2)
+    assert app_refresh._deferred_work_due(history_datetime, time_update, True) == (False, False)
+    history_datetime = time_update - datetime.timedelta(seconds=epoch)
+    assert app_refresh._deferred_work_due(history_datetime, time_update, True) == (True, True)
+    # Nothing is due yet, but scores still resolve on a tick that keeps up
+    history_datetime = time_update + datetime.timedelta(seconds=epoch)
+    assert app_refresh._deferred_work_due(history_datetime, time_update, False) == (False, True)
+
+def test_networth_winners_match_leaderboard_order():
+    networth = {"0": 50, "1": 80, "2": 50, "3": 10, "4": 80}
+    index = app_leaderboard.SortedIndex()
+    index.sync(networth)
+    assert app_refresh._networth_winners(networth, 3) == [kd_id for kd_id, _ in index.top(3)]
+    assert app_refresh._networth_winners(networth, 3) == ["1", "4", "0"]
+    assert app_refresh._networth_winners({}, 3) == []
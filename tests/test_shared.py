@@ -0,0 +1,34 @@
+import pytest
+import api.untitledapp.shared as app_shared
+
+@pytest.fixture
+def standard_speed():
+    yield
+    app_shared.apply_game_speed(1)
+
+def test_parse_game_speed():
+    assert app_shared.parse_game_speed(None) == 1.0
+    assert app_shared.parse_game_speed("hyper") == app_shared.GAME_SPEEDS["hyper"]
+    assert app_shared.parse_game_speed("2.5") == 2.5
+    with pytest.raises(ValueError):
+        app_shared.parse_game_speed(0)
+    with pytest.raises(ValueError):
+        app_shared.parse_game_speed("ludicrous")
+    assert app_shared.parse_game_speed(app_shared.MAX_GAME_SPEED) == app_shared.MAX_GAME_SPEED
+    for speed in ["inf", "1e400", "nan", "-inf", app_shared.MAX_GAME_SPEED + 1]:
+        with pytest.raises(ValueError):
+            app_shared.parse_game_speed(speed)
+
+def test_apply_game_speed_scales_durations(standard_speed):
+    standard_defense = app_shared.GAME_FUNCS["BASE_PRIMITIVES_DEFENSE_PER_STAR"](3600)
+    app_shared.apply_game_speed("hyper")
+    speed = app_shared.GAME_SPEEDS["hyper"]
+    assert app_shared.GAME_CONFIG["GAME_SPEED"] == speed
+    assert app_shared.GAME_CONFIG["BASE_EPOCH_SECONDS"] == app_shared.STANDARD_EPOCH_SECONDS / speed
+    assert app_shared.GAME_CONFIG["BASE_QUEUE_BUCKET_SECONDS"] == app_shared.STANDARD_QUEUE_BUCKET_SECONDS / speed
+    assert app_shared.GAME_CONFIG["BASE_TICK_SECONDS"] == app_shared.STANDARD_TICK_SECONDS / speed
+    # An hour of a hyper round is worth as much as speed hours of a standard one
+    assert app_shared.GAME_FUNCS["BASE_PRIMITIVES_DEFENSE_PER_STAR"](3600 / speed) == pytest.approx(standard_defense)
+
+    app_shared.apply_game_speed(None)
+    assert app_shared.GAME_CONFIG["BASE_EPOCH_SECONDS"] == app_shared.STANDARD_EPOCH_SECONDS
@@ -0,0 +1,137 @@
+import json
+import pytest
+import requests
+import api.untitledapp.storage as app_storage
+
+ENDPOINT = "http://storage/api"
+
+def _session(backend):
+    session = requests.Session()
+    session.mount(ENDPOINT, backend)
+    return session
+
+def _create_kingdom(session, name="kd0", galaxy="1:1"):
+    session.post(ENDPOINT + f"/galaxy/{galaxy}")
+    response = session.post(ENDPOINT + "/kingdom", data=json.dumps({"kingdom_name": name, "galaxy": galaxy}))
+    assert response.status_code == 201
+    return response.text
+
+def test_create_kingdom_matches_the_function_app():
+    session = _session(app_storage.create_storage("memory"))
+    kd_id = _create_kingdom(session)
+    assert kd_id == "0"
+    assert json.loads(session.get(ENDPOINT + "/galaxies").text)["galaxies"] == {"1:1": ["0"]}
+
+    session.post(ENDPOINT + "/createitem", data=json.dumps({"item": "kingdom_0", "state": {"stars": 300}}))
+    session.patch(ENDPOINT + "/kingdom/0", data=json.dumps({"money": 5}))
+    assert json.loads(session.get(ENDPOINT + "/kingdom/0").text) == {
+        "id": "kingdom_0",
+        "kdId": "0",
+        "type": "kingdom",
+        "stars": 300,
+        "money": 5,
+    }
+    assert session.get(ENDPOINT + "/kingdom/1").status_code == 500
+
+def test_queue_and_log_routes():
+    session = _session(app_storage.create_storage("memory"))
+    _create_kingdom(session)
+    session.post(ENDPOINT + "/createitem", data=json.dumps({"item": "mobis_0", "state": {"mobis": []}}))
+    session.patch(ENDPOINT + "/kingdom/0/mobis", data=json.dumps({"new_mobis": [
+        {"time": "2030-01-01T02:00:00+00:00", "attack": 5},
+        {"time": "2030-01-01T01:00:00+00:00", "attack": 1},
+        {"time": "2030-01-01T02:00:00+00:00", "attack": 2},
+    ]}))
+    mobis = json.loads(session.get(ENDPOINT + "/kingdom/0/mobis").text)
+    assert [entry["attack"] for entry in mobis["mobis"]] == [1, 7]
+
+    session.post(ENDPOINT + "/createitem", data=json.dumps({"item": "news_0", "state": {"news": []}}))
+    session.patch(ENDPOINT + "/kingdom/0/news", data=json.dumps({"news": "first"}))
+    session.patch(ENDPOINT + "/kingdom/0/news", data=json.dumps([{"news": "third"}, {"news": "second"}]))
+    news = json.loads(session.get(ENDPOINT + "/kingdom/0/news", params={"limit": 2}).text)
+    assert [(entry["seq"], entry["news"]) for entry in news["news"]] == [(3, "third"), (2, "second")]
+
+def test_resolve_schedule_follows_kingdom_patches():
+    session = _session(app_storage.create_storage("memory"))
+    _create_kingdom(session)
+    session.patch(ENDPOINT + "/kingdom/0", data=json.dumps({"next_resolve": {"mobis": "2030-01-01T01:00:00+00:00"}}))
+    due = json.loads(session.get(ENDPOINT + "/resolveschedule", params={"before": "2030-01-01T02:00:00+00:00"}).text)
+    assert due == {"kingdoms": ["0"], "scheduled": 1}
+    session.patch(ENDPOINT + "/kingdom/0", data=json.dumps({"status": "Dead"}))
+    due = json.loads(session.get(ENDPOINT + "/resolveschedule", params={"before": "2030-01-01T02:00:00+00:00"}).text)
+    assert due == {"kingdoms": [], "scheduled": 0}
+
+def test_batch_commit_applies_nothing_when_an_item_is_missing():
+    session = _session(app_storage.create_storage("memory"))
+    _create_kingdom(session)
+    response = session.post(ENDPOINT + "/batch/commit", data=json.dumps({
+        "items": [{"id": "kingdom_0", "merge": {"money": 5}}, {"id": "kingdom_9", "merge": {"money": 5}}],
+    }))
+    assert response.status_code == 409
+    assert json.loads(response.text) == {"committed": False, "failed": ["kingdom_9"]}
+    assert "money" not in json.loads(session.get(ENDPOINT + "/kingdom/0").text)
+
+def test_sqlite_items_persist_and_failed_requests_roll_back(tmp_path):
+    path = str(tmp_path / "storage.sqlite")
+    session = _session(app_storage.create_storage("sqlite", path))
+    _create_kingdom(session)
+    session.patch(ENDPOINT + "/kingdom/0", data=json.dumps({"money": 5}))
+    # The kingdom is merged before the missing log fails the request
+    response = session.post(ENDPOINT + "/batch/commit", data=json.dumps({
+        "items": [{"id": "kingdom_0", "merge": {"money": 10}}],
+        "logs": [{"id": "missing_log", "key": "news", "entries": [{"news": "lost"}]}],
+    }))
+    assert response.status_code == 500
+    assert json.loads(session.get(ENDPOINT + "/kingdom/0").text)["money"] == 5
+
+    reopened = _session(app_storage.create_storage("sqlite", path))
+    assert json.loads(reopened.get(ENDPOINT + "/kingdom/0").text)["money"] == 5
+    assert json.loads(reopened.get(ENDPOINT + "/kingdoms").text)["kingdoms"] == {"0": "kd0"}
+
+def test_unknown_storage_backend():
+    assert app_storage.create_storage("functions") is None
+    with pytest.raises(ValueError):
+        app_storage.create_storage("cosmos")
+
+def test_patch_item_applies_partial_operations():
+    session = _session(app_storage.create_storage("memory"))
+    _create_kingdom(session)
+    session.post(ENDPOINT + "/createitem", data=json.dumps({"item": "shared_0", "state": {"shared": ["a"], "counts": {"x": 1}}}))
+    response = session.patch(ENDPOINT + "/item/shared_0", data=json.dumps({"operations": [
+        {"op": "add", "path": "/shared/-", "value": "c"},
+        {"op": "add", "path": "/shared/1", "value": "b"},
+        {"op": "incr", "path": "/counts/x", "value": 2},
+        {"op": "incr", "path": "/counts/y", "value": 3},
+        {"op": "set", "path": "/counts/a~1b", "value": 0},
+        {"op": "remove", "path": "/shared/0"},
+    ]}))
+    assert response.status_code == 200
+    shared = json.loads(session.get(ENDPOINT + "/kingdom/0/shared").text)
+    assert shared["shared"] == ["b", "c"]
+    assert shared["counts"] == {"x": 3, "y": 3, "a/b": 0}
+
+    response = session.patch(ENDPOINT + "/item/shared_0", data=json.dumps({"operations": [
+        {"op": "add", "path": "/shared/-", "value": "d"},
+        {"op": "move", "path": "/shared"},
+    ]}))
+    assert response.status_code == 400
+    assert json.loads(session.get(ENDPOINT + "/kingdom/0/shared").text)["shared"] == ["b", "c"]
+
+def test_patch_item_reschedules_kingdoms():
+    session = _session(app_storage.create_storage("memory"))
+    _create_kingdom(session)
+    session.patch(ENDPOINT + "/item/kingdom_0", data=json.dumps({"operations": [
+        {"op": "set", "path": "/next_resolve", "value": {"mobis": "2030-01-01T01:00:00+00:00"}},
+    ]}))
+    due = json.loads(session.get(ENDPOINT + "/resolveschedule", params={"before": "2030-01-01T02:00:00+00:00"}).text)
+    assert due == {"kingdoms": ["0"], "scheduled": 1}
+
+def test_empire_aggression_moves_off_the_empires_item():
+    session = _session(app_storage.create_storage("memory"))
+    # An empire from before aggression was split out, without its own aggression item
+    session.patch(ENDPOINT + "/empires", data=json.dumps({"empires": {"0": {"name": "e0", "aggression": {"1": 5}}}}))
+    assert json.loads(session.get(ENDPOINT + "/empire/0/aggression").text)["aggression"] == {"1": 5}
+
+    session.patch(ENDPOINT + "/empires", data=json.dumps({"empires": {"0": {"name": "e0"}}}))
+    response = session.patch(ENDPOINT + "/empire/0/aggression", data=json.dumps({"deltas": {"1": 2}}))
+    assert json.loads(response.text)["aggression"] == {"1": 7}
@@ -0,0 +1,91 @@
+import json
+import flask
+import pytest
+import api.untitledapp.unitofwork as app_uow
+
+class _FakeResponse:
+    def __init__(self, body, status_code):
+        self.text = body if isinstance(body, str) else json.dumps(body)
+        self.status_code = status_code
+
+class _FakeSession:
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+        self.posted = []
+
+    def post(self, url, headers=None, data=None):
+        self.posted.append((url, json.loads(data)))
+        return _FakeResponse(self.body, self.status_code)
+
+@pytest.fixture
+def backend_app():
+    app = flask.Flask(__name__)
+    app.config["AZURE_FUNCTION_ENDPOINT"] = "http://backend"
+    app.config["AZURE_FUNCTION_KEY"] = "key"
+    with app.app_context():
+        yield app
+
+def test_payload_groups_staged_writes():
+    uow = app_uow.UnitOfWork()
+    uow.merge("kingdom_1", {"stars": 10})
+    uow.merge("kingdom_1", {"money": 5})
+    uow.append_log("news_2", "news", {"news": "first"})
+    uow.append_log("news_2", "news", {"news": "second"})
+    uow.reveal("3", {"new_galaxies": {"1:1": "2099-01-01T00:00:00+00:00"}})
+    uow.notifs["2"] = ["news_kingdom"]
+    assert uow.payload() == {
+        "items": [{"id": "kingdom_1", "merge": {"stars": 10, "money": 5}}],
+        "logs": [{"id": "news_2", "key": "news", "entries": [{"news": "second"}, {"news": "first"}]}],
+        "revealed": [{"id": "revealed_3", "new_galaxies": {"1:1": "2099-01-01T00:00:00+00:00"}}],
+        "notifs": [{"id": "notifs_2", "add_categories": ["news_kingdom"]}],
+    }
+
+def test_commit_runs_callbacks_only_after_success(backend_app, monkeypatch):
+    session = _FakeSession({"committed": True, "failed": []})
+    monkeypatch.setattr(app_uow, "REQUESTS_SESSION", session)
+    called = []
+    uow = app_uow.UnitOfWork()
+    uow.merge("kingdom_1", {"stars": 10})
+    uow.after_commit(called.append, "published")
+    assert uow.commit() == []
+    assert called == []
+    uow.run_after_commit()
+    assert called == ["published"]
+    assert session.posted == [("http://backend/batch/commit", uow.payload())]
+
+def test_failed_commit_drops_callbacks(backend_app, monkeypatch):
+    monkeypatch.setattr(app_uow, "REQUESTS_SESSION", _FakeSession({"committed": False, "failed": ["kingdom_1"]}))
+    called = []
+    uow = app_uow.UnitOfWork()
+    uow.merge("kingdom_1", {"stars": 10})
+    uow.after_commit(called.append, "published")
+    with pytest.raises(app_uow.CommitError):
+        uow.commit()
+    uow.run_after_commit()
+    assert called == []
+
+def test_partial_commit_is_told_apart(backend_app, monkeypatch):
+    monkeypatch.setattr(app_uow, "REQUESTS_SESSION", _FakeSession({
+        "committed": False,
+        "failed": ["kingdom_2"],
+        "not_restored": ["kingdom_1"],
+    }))
+    uow = app_uow.UnitOfWork()
+    uow.merge("kingdom_1", {"stars": 10})
+    uow.merge("kingdom_2", {"stars": 20})
+    with pytest.raises(app_uow.PartialCommitError) as excinfo:
+        uow.commit()
+    assert excinfo.value.not_restored == ["kingdom_1"]
+
+@pytest.mark.parametrize("body", ["batch/commit encountered an error", "", '"committed"'])
+def test_unexpected_commit_response_is_a_commit_error(backend_app, monkeypatch, body):
+    monkeypatch.setattr(app_uow, "REQUESTS_SESSION", _FakeSession(body, status_code=500))
+    called = []
+    uow = app_uow.UnitOfWork()
+    uow.merge("kingdom_1", {"stars": 10})
+    uow.after_commit(called.append, "published")
+    with pytest.raises(app_uow.CommitError):
+        uow.commit()
+    uow.run_after_commit()
+    assert called == []